@@ -3,9 +3,8 @@ import sys
 import django
 import logging
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from asgiref.sync import sync_to_async
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,51 +19,22 @@ sys.path.append(BASE_DIR)
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'stef.settings')
 django.setup()
 
-from stefbot.models import TelegramUser, ModelProfile, Order
+from django.conf import settings
+from stefbot.delivery import open_photo, send_media_albums, remember_preview_file_id
+from stefbot.metrics import start_metrics_server
+from stefbot.orders import ORDERS_PER_PAGE, encode_cursor
+# DB access goes through a bounded thread pool instead of the single sync_to_async thread
+from stefbot.repository import (
+    count_user_orders, create_order, get_catalog_snapshot, get_full_order_data, get_model_by_id,
+    get_model_manifest, get_or_create_user, get_order_by_id, get_order_details, get_user_orders_page,
+)
+from stefbot.updates import MAX_PENDING_UPDATES, UPDATE_CONCURRENCY, OrderedApplication
+from stefbot.utils import rate_limiter
 
 # Токен бота
-TOKEN = ""
+TOKEN = settings.TELEGRAM_TOKEN
 DEFAULT_PHOTO_URL = "https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcR-vVoi9lNzf3WaVV2cAHQSFcBqQtZu4pPWaw&s"
 
-# Функции работы с БД
-@sync_to_async
-def get_or_create_user(telegram_id, username):
-    return TelegramUser.objects.get_or_create(
-        telegram_id=telegram_id,
-        defaults={'username': username}
-    )
-
-@sync_to_async
-def get_all_models():
-    return list(ModelProfile.objects.all())
-
-@sync_to_async
-def get_model_by_id(model_id):
-    return ModelProfile.objects.filter(id=model_id).first()
-
-@sync_to_async
-def get_model_photos(model_id):
-    model = ModelProfile.objects.filter(id=model_id).first()
-    return list(model.photos.all()) if model else []
-
-@sync_to_async
-def get_user_orders(telegram_id):
-    return list(Order.objects.filter(user__telegram_id=telegram_id, status='paid'))
-
-@sync_to_async
-def create_order(user, model, amount):
-    """Создает новый заказ и сохраняет его в базе данных."""
-    return Order.objects.create(
-        user=user,
-        model=model,
-        amount=amount,
-        status='pending'
-    )
-
-@sync_to_async
-def get_order_by_id(order_id):
-    return Order.objects.filter(id=order_id).first()
-
 # Главное меню
 def main_menu():
     return InlineKeyboardMarkup([
@@ -83,52 +53,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=main_menu()
     )
 
-@sync_to_async
-def get_order_details(order_id):
-    """Get all necessary order details synchronously"""
-    try:
-        order = Order.objects.select_related('model').get(id=order_id)
-        return {
-            'id': order.id,
-            'model_name': order.model.name,
-            'amount': order.amount,
-            'created_at': order.created_at,
-            'model_id': order.model.id,
-            'status': order.status
-        }
-    except Order.DoesNotExist:
-        return None
-    except Exception as e:
-        logger.error(f"Error getting order details: {e}")
-        return None
-
-@sync_to_async
-def get_order_data(order):
-    """Synchronously get all order data including photos"""
-    try:
-        # Get order details
-        details = {
-            'id': order.id,
-            'model_name': order.model.name,
-            'amount': order.amount,
-            'created_at': order.created_at,
-        }
-        
-        # Get photo paths more efficiently
-        photo_paths = []
-        photos = order.model.photos.all()[:5]  # Limit to 5 photos per order
-        for photo in photos:
-            if photo.photo:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(photo.photo))
-                if os.path.exists(file_path) and os.path.getsize(file_path) < 5_000_000:  # Check file size < 5MB
-                    photo_paths.append(file_path)
-        
-        details['photo_paths'] = photo_paths
-        return details
-    except Exception as e:
-        logger.error(f"Error getting order data: {e}")
-        return None
-    
 from telegram.error import TimedOut   
 
 async def send_message_with_retry(message_func, max_retries=3):
@@ -145,39 +69,6 @@ async def send_message_with_retry(message_func, max_retries=3):
                 raise
             await asyncio.sleep(1)    
 
-async def create_media_group(photo_paths):
-    """Create media group from photo paths"""
-    media_group = []
-    for path in photo_paths[:10]:  # Limit to 10 photos
-        try:
-            with open(path, 'rb') as photo_file:
-                media_group.append(InputMediaPhoto(media=photo_file.read()))
-        except Exception as e:
-            logger.error(f"Error reading photo file {path}: {e}")
-            continue
-    return media_group
-
-from django.conf import settings
-
-@sync_to_async(thread_sensitive=False)
-def get_order_photos(model_id):
-    """Fetch photo file paths for a model asynchronously"""
-    try:
-        model = ModelProfile.objects.get(id=model_id)
-        photos = model.photos.all()
-        photo_paths = []
-
-        for photo in photos:
-            if photo.photo:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(photo.photo))
-                if os.path.exists(file_path):
-                    photo_paths.append(file_path)
-
-        return photo_paths
-    except Exception as e:
-        logger.error(f"Error getting photos for model {model_id}: {e}")
-        return []
-
 
 async def handle_confirm_payment(query: Update, order_id: int, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -210,34 +101,9 @@ async def handle_confirm_payment(query: Update, order_id: int, context: ContextT
         # После подтверждения оплаты отправляем и фото, и видео
         order = await get_order_by_id(order_id)
         if order and order.status == 'paid':
-            media_paths = await get_media_paths(order.model.id)
-            
-            if media_paths['photos'] or media_paths['videos']:
-                media_group = []
-                
-                # Add photos to media group
-                for path in media_paths['photos']:
-                    file_content = await read_file_sync(path)
-                    if file_content:
-                        media_group.append(InputMediaPhoto(media=file_content))
-
-                # Add videos to media group
-                for path in media_paths['videos']:
-                    file_content = await read_file_sync(path)
-                    if file_content:
-                        media_group.append(InputMediaVideo(media=file_content))
-
-                if media_group:
-                    # Send media in chunks of 10 (Telegram's limit)
-                    for i in range(0, len(media_group), 10):
-                        chunk = media_group[i:i + 10]
-                        try:
-                            await query.message.reply_media_group(media=chunk)
-                            if i + 10 < len(media_group):
-                                await asyncio.sleep(1)
-                        except Exception as e:
-                            logger.error(f"Error sending media group after payment: {e}")
-                            continue
+            manifest = await get_model_manifest(order.model_id)
+            if manifest['albums']:
+                await send_media_albums(context.bot, query.message.chat_id, manifest['albums'])
             
             # Send confirmation message
             await query.message.reply_text(
@@ -269,9 +135,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await handle_purchase(query, model_id, context)
         elif data == 'orders':  # Show first page by default
             await handle_orders(query, page=0)
-        elif data.startswith('orders_page_'):  # Handle pagination
-            page = int(data.split('_')[-1])
-            await handle_orders(query, page)
+        elif data.startswith(('orders_next_', 'orders_prev_')):  # Handle pagination
+            _, direction, page, cursor = data.split('_', 3)
+            await handle_orders(query, int(page), cursor, backwards=direction == 'prev')
+        elif data.startswith('orders_page_'):  # Buttons from older messages
+            await handle_orders(query, page=0)
         elif data.startswith('order_'):
             order_id = int(data.split('_')[1])
             await handle_order_photos(query, order_id)
@@ -287,25 +155,23 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def handle_models_list(query):
-    models = await get_all_models()
+    catalog = await get_catalog_snapshot()
 
-    if not models:
+    if not catalog['models']:
         await query.edit_message_caption(
             caption="😔 Модели не найдены",
             reply_markup=main_menu()
         )
         return
 
-    buttons = [[InlineKeyboardButton(m.name, callback_data=f'model_{m.id}')] for m in models]
-    buttons.append([InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')])
-
     await query.edit_message_media(
         media=InputMediaPhoto(media=DEFAULT_PHOTO_URL, caption="Выберите модель:"),
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=catalog['list_markup']
     )
 
 async def handle_model_details(query, model_id):
-    model = await get_model_by_id(model_id)
+    catalog = await get_catalog_snapshot()
+    model = catalog['models'].get(model_id)
 
     if not model:
         await query.edit_message_caption(
@@ -314,18 +180,24 @@ async def handle_model_details(query, model_id):
         )
         return
 
-    buttons = [
-        [InlineKeyboardButton("🛒 Купить", callback_data=f'buy_{model.id}')],
-        [InlineKeyboardButton("◀️ Назад", callback_data='models')]
-    ]
-
     try:
-        with open(model.preview_photo.path, 'rb') as photo_file:
+        if model['preview_file_id']:
             await query.message.reply_photo(
+                photo=model['preview_file_id'],
+                caption=model['caption'],
+                reply_markup=model['markup']
+            )
+            return
+        photo_file = await asyncio.to_thread(open_photo, model['preview_path'])
+        try:
+            message = await query.message.reply_photo(
                 photo=photo_file,
-                caption=f"🔥 {model.name}\n\n{model.description}\n\n💵 Цена: {model.price} RUB",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                caption=model['caption'],
+                reply_markup=model['markup']
             )
+        finally:
+            photo_file.close()
+        await remember_preview_file_id(model['id'], model['preview_name'], message)
     except FileNotFoundError:
         await query.edit_message_caption(
             caption="⚠️ Фото модели недоступно",
@@ -369,17 +241,11 @@ async def handle_purchase(query, model_id, context):
             reply_markup=main_menu()
         )
 
-ORDERS_PER_PAGE = 5  # Number of orders per page
-
-ORDERS_PER_PAGE = 5  # Number of orders per page
-
-ORDERS_PER_PAGE = 5  # How many orders to show per page
-
-async def handle_orders(query: Update, page: int = 0):
+async def handle_orders(query: Update, page: int = 0, cursor: str = None, backwards: bool = False):
     try:
         await query.answer()
         user_id = query.from_user.id
-        orders = await get_user_orders(user_id)  # Get all paid orders
+        orders, has_more = await get_user_orders_page(user_id, cursor, backwards)
 
         if not orders:
             await query.message.reply_text(
@@ -388,26 +254,27 @@ async def handle_orders(query: Update, page: int = 0):
             )
             return
 
-        total_orders = len(orders)
+        total_orders = await count_user_orders(user_id)
         total_pages = max(1, (total_orders + ORDERS_PER_PAGE - 1) // ORDERS_PER_PAGE)  # Total pages
 
-        # Ensure page is in valid range
-        page = max(0, min(page, total_pages - 1))
+        # The extra row fetched by the keyset query tells whether there is more
+        has_prev = has_more if backwards else cursor is not None
+        has_next = has_more if not backwards else True
 
-        # Get the orders for this page
-        start_idx = page * ORDERS_PER_PAGE
-        end_idx = start_idx + ORDERS_PER_PAGE
-        paginated_orders = orders[start_idx:end_idx]
+        # The counter is cached, keep the page number within it
+        page = max(0, min(page, total_pages - 1)) if has_prev else 0
 
         # Generate buttons
-        buttons = [[InlineKeyboardButton(f"📦 Заказ #{order.id}", callback_data=f"order_{order.id}")] for order in paginated_orders]
+        buttons = [[InlineKeyboardButton(f"📦 Заказ #{order_id}", callback_data=f"order_{order_id}")] for order_id, _ in orders]
 
-        # Pagination buttons
+        # Pagination buttons: the cursor is the first/last order on this page
         pagination_buttons = []
-        if page > 0:
-            pagination_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"orders_page_{page - 1}"))
-        if end_idx < total_orders:
-            pagination_buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=f"orders_page_{page + 1}"))
+        if has_prev:
+            first_cursor = encode_cursor(orders[0][1], orders[0][0])
+            pagination_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"orders_prev_{page - 1}_{first_cursor}"))
+        if has_next:
+            last_cursor = encode_cursor(orders[-1][1], orders[-1][0])
+            pagination_buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=f"orders_next_{page + 1}_{last_cursor}"))
 
         if pagination_buttons:
             buttons.append(pagination_buttons)
@@ -433,135 +300,6 @@ async def handle_orders(query: Update, page: int = 0):
             reply_markup=main_menu()
         )
 
-@sync_to_async
-def get_media_paths(model_id):
-    """Get photo and video paths synchronously"""
-    from stefbot.models import ModelProfile
-    try:
-        model = ModelProfile.objects.get(id=model_id)
-        media_paths = {
-            'photos': [],
-            'videos': []
-        }
-        
-        # Get photo paths
-        for photo in model.photos.all():
-            if photo.photo:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(photo.photo))
-                if os.path.exists(file_path):
-                    media_paths['photos'].append(str(file_path))
-                    
-        # Get video paths
-        for video in model.videos.all():
-            if video.video:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(video.video))
-                if os.path.exists(file_path):
-                    media_paths['videos'].append(str(file_path))
-                    
-        return media_paths
-    except Exception as e:
-        logger.error(f"Error getting media paths: {e}")
-        return {'photos': [], 'videos': []}
-
-@sync_to_async
-def get_full_order_data(order_id):
-    """Get order and related model data synchronously"""
-    from stefbot.models import Order
-    try:
-        order = Order.objects.select_related('model').get(id=order_id)
-        return {
-            'model_id': order.model.id,
-            'exists': True
-        }
-    except Order.DoesNotExist:
-        return {'exists': False}
-    except Exception as e:
-        logger.error(f"Error getting order data: {e}")
-        return {'exists': False}
-
-@sync_to_async
-def get_photo_paths(model_id):
-    """Get photo paths synchronously"""
-    from stefbot.models import ModelProfile
-    try:
-        model = ModelProfile.objects.get(id=model_id)
-        paths = []
-        for photo in model.photos.all():
-            if photo.photo:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(photo.photo))
-                if os.path.exists(file_path):
-                    paths.append(str(file_path))
-        return paths
-    except Exception as e:
-        logger.error(f"Error getting photo paths: {e}")
-        return []
-
-@sync_to_async
-def read_file_sync(path):
-    """Read file synchronously"""
-    try:
-        with open(path, 'rb') as f:
-            return f.read()
-    except Exception as e:
-        logger.error(f"Error reading file {path}: {e}")
-        return None      
-
-@sync_to_async(thread_sensitive=False)
-def get_order_photos(model_id):
-    """Fetch photo file paths for a model asynchronously"""
-    try:
-        model = ModelProfile.objects.get(id=model_id)  # ✅ Fetch model safely
-        photos = model.photos.all()  # ✅ Get all related photos
-
-        photo_paths = []
-        for photo in photos:
-            if photo.photo:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(photo.photo))
-                if os.path.exists(file_path):
-                    photo_paths.append(file_path)
-
-        return photo_paths
-    except Exception as e:
-        logger.error(f"Error getting photos for model {model_id}: {e}")
-        return []
-
-import pathlib
-
-@sync_to_async
-def fetch_order_photos(model_id):
-    """Asynchronously fetch photo paths for a model"""
-    from stefbot.models import ModelProfile
-    try:
-        model = ModelProfile.objects.get(id=model_id)
-        photos = model.photos.all()
-        photo_paths = []
-
-        for photo in photos:
-            if photo.photo:
-                file_path = os.path.join(settings.MEDIA_ROOT, str(photo.photo))
-                if os.path.exists(file_path):
-                    logger.info(f"✅ Found file: {file_path}")
-                    photo_paths.append(str(file_path))
-                else:
-                    logger.warning(f"❌ Missing file: {file_path}")
-
-        return photo_paths
-    except Exception as e:
-        logger.error(f"Error fetching photos for model {model_id}: {e}")
-        return []
-
-async def read_photo_file(path):
-    """Asynchronously read photo file"""
-    try:
-        path_obj = pathlib.Path(path)
-        if path_obj.exists() and path_obj.is_file():
-            # Use asyncio.to_thread for Python 3.9+ or run_in_executor for older versions
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(None, lambda: open(str(path_obj), 'rb').read())
-    except Exception as e:
-        logger.error(f"Error reading photo file {path}: {e}")
-        return None
-
 async def handle_order_photos(query, order_id):
     """Handle order photos and videos viewing"""
     try:
@@ -572,44 +310,20 @@ async def handle_order_photos(query, order_id):
             await query.answer("⚠️ Заказ не найден", show_alert=True)
             return
 
-        # Get media paths
-        media_paths = await get_media_paths(order_data['model_id'])
+        # Get media manifest: cached file_ids or local files, already split into albums
+        manifest = await get_model_manifest(order_data['model_id'])
         
-        if not media_paths['photos'] and not media_paths['videos']:
+        if not manifest['albums']:
             await query.answer("⚠️ Медиафайлы не найдены", show_alert=True)
             return
 
-        # Process photos
-        media_group = []
-        
-        # Add photos to media group
-        for path in media_paths['photos']:
-            file_content = await read_file_sync(path)
-            if file_content:
-                media_group.append(InputMediaPhoto(media=file_content))
-
-        # Add videos to media group
-        for path in media_paths['videos']:
-            file_content = await read_file_sync(path)
-            if file_content:
-                media_group.append(InputMediaVideo(media=file_content))
-
-        if not media_group:
+        # Send media in chunks of 10 (Telegram's limit)
+        sent = await send_media_albums(query.get_bot(), query.message.chat_id, manifest['albums'])
+
+        if not sent:
             await query.answer("⚠️ Не удалось загрузить медиафайлы", show_alert=True)
             return
 
-        # Send media in chunks of 10 (Telegram's limit)
-        for i in range(0, len(media_group), 10):
-            chunk = media_group[i:i + 10]
-            try:
-                await query.message.reply_media_group(media=chunk)
-                # Add small delay between chunks if needed
-                if i + 10 < len(media_group):
-                    await asyncio.sleep(1)
-            except Exception as e:
-                logger.error(f"Error sending media group: {e}")
-                continue
-
         await query.answer("✅ Медиафайлы загружены")
 
     except Exception as e:
@@ -617,11 +331,42 @@ async def handle_order_photos(query, order_id):
         await query.answer("⚠️ Произошла ошибка при загрузке медиафайлов", show_alert=True)
 
 
-# Запуск бота
-if __name__ == "__main__":
-    application = Application.builder().token(TOKEN).build()
-    
+def build_application(webhook=False, request=None, limiter=rate_limiter, concurrency=UPDATE_CONCURRENCY,
+                      base_url=None):
+    """Builds the bot Application with all handlers.
+
+    In webhook mode there is no Updater: updates are pushed into
+    application.update_queue by the Django webhook view (stefbot.webhook)
+    or fed from a shard queue by run_bot_worker. ``base_url`` points the
+    bot at another Bot API server, e.g. stefbot.fakebotapi.FakeBotAPIServer.
+    """
+    # Shared limiter: handlers, delivery worker and admin signals stay under one Telegram budget
+    builder = (
+        Application.builder()
+        .application_class(OrderedApplication, {'update_concurrency': concurrency})
+        .token(TOKEN)
+        .rate_limiter(limiter)
+        .concurrent_updates(MAX_PENDING_UPDATES)  # Real limit and per-user order live in OrderedApplication
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    else:
+        # One connection per concurrently running handler
+        builder = builder.connection_pool_size(concurrency)
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    if webhook:
+        builder = builder.updater(None)
+    application = builder.build()
+
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(handle_callback))
-    
+    return application
+
+
+# Запуск бота
+if __name__ == "__main__":
+    if settings.METRICS_PORT:
+        start_metrics_server(settings.METRICS_PORT)
+    application = build_application()
     application.run_polling()
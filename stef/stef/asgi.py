@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'stef.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    # Django не обрабатывает lifespan; он нужен, чтобы остановить бота в режиме webhook
+    if scope['type'] == 'lifespan':
+        from stefbot.webhook import lifespan
+        await lifespan(receive, send)
+        return
+    await django_application(scope, receive, send)
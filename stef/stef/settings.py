@@ -26,7 +26,7 @@ SECRET_KEY = 'django-insecure-!cc0ncr%pv_r8o39o^eai3vt6fwlb*dc-gh9uz$h#7zmi&3$s7
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', '').split()
 
 
 # Application definition
@@ -76,15 +76,97 @@ WSGI_APPLICATION = 'stef.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
+# DB_ENGINE=postgresql - PostgreSQL для продакшена, иначе SQLite (разработка,
+# один сервер). Соединения постоянные: CONN_MAX_AGE секунд, с проверкой
+# перед повторным использованием.
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', '60'))
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'stef'),
+            'USER': os.environ.get('POSTGRES_USER', 'stef'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {'connect_timeout': 5},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            # WAL, synchronous=NORMAL и BEGIN IMMEDIATE - см. stefbot/sqlite/base.py
+            'ENGINE': 'stefbot.sqlite',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {'timeout': 20},  # busy_timeout, с
+        }
+    }
+
+# Потоки, в которых асинхронный код бота выполняет запросы (stefbot.repository).
+# У каждого потока свое постоянное соединение: это пул соединений бота
+DB_THREAD_POOL_SIZE = int(os.environ.get('DB_THREAD_POOL_SIZE', '8'))
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Файловый кэш общий для процесса бота и админки: так сбросы из сигналов
+# видны обоим процессам.
+
+CACHE_DIR = os.environ.get('DJANGO_CACHE_DIR', os.path.join(BASE_DIR, 'cache'))
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR,
     }
 }
 
+# Бакеты лимитера запросов к Telegram, общие для всех процессов
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', os.path.join(CACHE_DIR, 'ratelimit.sqlite3'))
+
+# Длинная сторона копии фото для Telegram (stefbot.images): 1280 - обычное
+# качество, 2560 - HD-фото, которые Telegram показывает без пережатия
+TELEGRAM_PHOTO_MAX_SIDE = int(os.environ.get('TELEGRAM_PHOTO_MAX_SIDE', '1280'))
+
+
+TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+
+# Webhook: публичный URL вьюхи stefbot.webhook и секрет, который Telegram
+# присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+TELEGRAM_WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL', '')
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET', '')
+
+# Число шардов бота. 0 - апдейты обрабатывает сам процесс бота или webhook;
+# иначе ingress кладет их в очередь, а каждый шард читает run_bot_worker.
+BOT_SHARDS = int(os.environ.get('BOT_SHARDS', '0'))
+
+# Фабрика Application бота с обработчиками: ее вызывают webhook, run_bot_worker
+# и нагрузочные команды, поэтому пакет stefbot не импортирует скрипт бота сам
+BOT_APPLICATION_FACTORY = os.environ.get('BOT_APPLICATION_FACTORY', 'StefanBot.build_application')
+
+# Метрики Prometheus: /api/metrics/ в Django и отдельный порт у бота и воркеров.
+# /api/metrics/ отдается с "Authorization: Bearer <token>" или сотруднику из
+# админки; без авторизации - только при METRICS_PUBLIC=1
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', '') == '1'
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+
+# Трассировка апдейтов и доставок: доля записываемых трасс (0 - выключена).
+# Span пишутся в JSON-lines файл или, с TRACE_OTLP_ENDPOINT, в OTLP-коллектор
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_FILE = os.environ.get('TRACE_FILE', os.path.join(CACHE_DIR, 'traces.jsonl'))
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', '')
 
-TELEGRAM_TOKEN = ''
+# Монитор блокировок цикла событий у бота и воркера доставки: '' - выключен,
+# 'on' - лаг в метриках и стек при блокировке дольше порога, 'debug' - плюс
+# отладочный режим asyncio с именами медленных callback
+LOOP_MONITOR = os.environ.get('LOOP_MONITOR', '')
+LOOP_BLOCK_THRESHOLD = float(os.environ.get('LOOP_BLOCK_THRESHOLD', '0.1'))
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -1,14 +1,32 @@
-from django.contrib import admin
-from .models import TelegramUser, ModelProfile, ModelPhoto, Order, ModelVideo
+from django.contrib import admin, messages
+from django.utils.html import format_html
+from .dispatcher import batch_progress, forget_batch
+from .models import TelegramUser, ModelProfile, ModelPhoto, Order, ModelVideo, OrderDelivery
+from .orders import bulk_mark_paid
+
+
+def thumbnail_tag(image):
+    """Миниатюра из stefbot.images; пока ее строят, показываем прочерк."""
+    if not image:
+        return '—'
+    return format_html('<img src="{}" style="max-height: 80px">', image.url)
 
 
 class ModelPhotoInline(admin.TabularInline):
     model = ModelPhoto
     extra = 1
+    exclude = ('telegram_file_id', 'telegram_file_unique_id')
+    readonly_fields = ('thumbnail_preview',)
+
+    @admin.display(description='Миниатюра')
+    def thumbnail_preview(self, obj):
+        return thumbnail_tag(obj.thumbnail)
 
 class ModelVideoInline(admin.TabularInline):
     model = ModelVideo
     extra = 1
+    exclude = ('telegram_file_id', 'telegram_file_unique_id')
+    readonly_fields = ('duration', 'faststart', 'send_problem')
 
 @admin.register(TelegramUser)
 class TelegramUserAdmin(admin.ModelAdmin):
@@ -21,19 +39,64 @@ class TelegramUserAdmin(admin.ModelAdmin):
 class ModelProfileAdmin(admin.ModelAdmin):
     inlines = [ModelPhotoInline, ModelVideoInline]
     list_display = ('name', 'price')
+    readonly_fields = ('preview_thumbnail_tag', 'preview_file_id', 'preview_file_unique_id')
+
+    @admin.display(description='Миниатюра превью')
+    def preview_thumbnail_tag(self, obj):
+        return thumbnail_tag(obj.preview_thumbnail)
 
 @admin.register(ModelVideo)
 class ModelVideoAdmin(admin.ModelAdmin):
-    list_display = ('model', 'video')
+    list_display = ('model', 'video', 'can_send', 'duration', 'resolution', 'size_mb', 'faststart', 'send_problem')
+    list_select_related = ('model',)
     search_fields = ('model__name',)
+    readonly_fields = (
+        'telegram_file_id', 'telegram_file_unique_id',
+        'duration', 'width', 'height', 'file_size', 'faststart', 'send_problem',
+    )
+
+    @admin.display(boolean=True, description='Можно отправить')
+    def can_send(self, obj):
+        return not obj.send_problem
+
+    @admin.display(description='Разрешение')
+    def resolution(self, obj):
+        return f"{obj.width}×{obj.height}" if obj.width else '—'
+
+    @admin.display(description='Размер, МБ', ordering='file_size')
+    def size_mb(self, obj):
+        return f"{obj.file_size / 2 ** 20:.1f}" if obj.file_size is not None else '—'
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'model', 'status', 'created_at')
+    # Явно: колонка-метод с obj.user не включила бы автоматический JOIN админки
+    list_select_related = ('user', 'model')
     list_filter = ('status',)
+    ordering = ('-created_at', '-id')
     actions = ['mark_as_paid']
 
     def mark_as_paid(self, request, queryset):
-        queryset.update(status='paid')
-        # Здесь можно добавить отправку уведомлений через бота
+        batch_id, count = bulk_mark_paid(queryset)
+        self.message_user(request, f"Подтверждено заказов: {count}. Рассылка {batch_id} поставлена в очередь.")
     mark_as_paid.short_description = "Подтвердить оплату"
+
+    def changelist_view(self, request, extra_context=None):
+        # Показываем прогресс рассылок; завершенные показываем один раз
+        for batch_id, progress in batch_progress():
+            done = progress['sent'] + progress['failed']
+            self.message_user(
+                request,
+                f"📦 Рассылка {batch_id}: {done}/{progress['total']}, ошибок {progress['failed']}",
+                messages.SUCCESS if done == progress['total'] else messages.INFO,
+            )
+            if done == progress['total']:
+                forget_batch(batch_id)
+        return super().changelist_view(request, extra_context)
+
+@admin.register(OrderDelivery)
+class OrderDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('order_id', 'status', 'attempts', 'available_at', 'sent_at', 'last_error')
+    list_filter = ('status',)
+    search_fields = ('order__id', 'batch_id')
+    readonly_fields = ('locked_by', 'locked_at', 'created_at', 'sent_at')
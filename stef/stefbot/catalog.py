@@ -0,0 +1,82 @@
+import os
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from .models import ModelProfile
+
+# Компактная проекция каталога лежит в общем кэше Django, а процесс бота
+# держит поверх нее готовые клавиатуры, пока не сменилась версия.
+VERSION_KEY = 'catalog:version'
+SNAPSHOT_KEY = 'catalog:snapshot:2'  # Номер меняется вместе с полями проекции
+
+_snapshot = None
+
+
+def model_caption(name, description, price):
+    return f"🔥 {name}\n\n{description}\n\n💵 Цена: {price} RUB"
+
+
+def build_projection():
+    """Читает из БД только поля, нужные меню моделей."""
+    rows = ModelProfile.objects.order_by('id').values(
+        'id', 'name', 'description', 'price', 'preview_photo', 'preview_telegram', 'preview_file_id'
+    )
+    return {
+        'version': uuid.uuid4().hex,
+        'models': [
+            {
+                'id': row['id'],
+                'name': row['name'],
+                'price': row['price'],
+                'caption': model_caption(row['name'], row['description'], row['price']),
+                'preview_name': row['preview_photo'],
+                'preview_upload': row['preview_telegram'] or row['preview_photo'],
+                'preview_file_id': row['preview_file_id'],
+            }
+            for row in rows
+        ],
+    }
+
+
+def _render(projection):
+    models = {}
+    buttons = []
+    for entry in projection['models']:
+        models[entry['id']] = dict(
+            entry,
+            preview_path=os.path.join(settings.MEDIA_ROOT, entry['preview_upload']),
+            markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🛒 Купить", callback_data=f"buy_{entry['id']}")],
+                [InlineKeyboardButton("◀️ Назад", callback_data='models')],
+            ]),
+        )
+        buttons.append([InlineKeyboardButton(entry['name'], callback_data=f"model_{entry['id']}")])
+    buttons.append([InlineKeyboardButton("◀️ Назад", callback_data='back_to_main')])
+    return {
+        'version': projection['version'],
+        'models': models,
+        'list_markup': InlineKeyboardMarkup(buttons),
+    }
+
+
+def get_catalog():
+    """Возвращает снимок каталога; SQL выполняется только после сброса."""
+    global _snapshot
+    version = cache.get(VERSION_KEY)
+    snapshot = _snapshot
+    if snapshot is not None and version is not None and snapshot['version'] == version:
+        return snapshot
+
+    projection = cache.get(SNAPSHOT_KEY)
+    if version is None or projection is None or projection['version'] != version:
+        projection = build_projection()
+        cache.set(SNAPSHOT_KEY, projection, None)
+        cache.set(VERSION_KEY, projection['version'], None)
+    _snapshot = _render(projection)
+    return _snapshot
+
+
+def invalidate_catalog():
+    """Сбрасывает снимок каталога во всех процессах."""
+    cache.delete(VERSION_KEY)
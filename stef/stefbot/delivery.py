@@ -0,0 +1,222 @@
+import asyncio
+import contextlib
+import io
+import logging
+import os
+from django.db.models import Q
+from telegram import InputFile, InputMediaPhoto, InputMediaVideo
+from . import metrics, tracing
+from .catalog import invalidate_catalog
+from .images import TELEGRAM_PHOTO_LIMIT, telegram_jpeg
+from .models import ModelProfile, ModelPhoto, ModelVideo
+from .repository import db_async
+
+logger = logging.getLogger(__name__)
+
+PREPARE_CONCURRENCY = 4  # Сколько файлов открывается одновременно
+PREFETCH_ALBUMS = 1  # Сколько готовых альбомов ждет отправки, пока идет загрузка
+
+UPLOAD_BYTES = metrics.Histogram(
+    'stefbot_delivery_upload_bytes', "Байт, загруженных файлами за одну отправку альбомов",
+    buckets=metrics.BYTES_BUCKETS,
+)
+MEDIA_SENT = metrics.Counter(
+    'stefbot_media_sent_total', "Отправленные медиа: по file_id или загрузкой файла", ('source',),
+)
+
+# Модель -> (файловое поле, поле file_id, поле file_unique_id)
+FILE_ID_FIELDS = {
+    ModelPhoto: ('photo', 'telegram_file_id', 'telegram_file_unique_id'),
+    ModelVideo: ('video', 'telegram_file_id', 'telegram_file_unique_id'),
+    ModelProfile: ('preview_photo', 'preview_file_id', 'preview_file_unique_id'),
+}
+
+
+class StreamingInputFile(InputFile):
+    """InputFile, который не читает файл в память целиком.
+
+    Стандартный InputFile делает ``read()`` всего файла. Здесь httpx получает
+    открытый файл и отправляет его в multipart-запросе кусками по 64 КБ.
+    ``content`` - уже готовые байты вместо содержимого файла ``path``.
+    """
+
+    def __init__(self, path, attach=False, content=None):
+        file = open(path, 'rb') if content is None else io.BytesIO(content)
+        super().__init__(b'', filename=os.path.basename(path), attach=attach)
+        self.input_file_content = file
+
+    def close(self):
+        self.input_file_content.close()
+
+
+def open_photo(path, attach=False, size=None):
+    """Файл фото для отправки.
+
+    Оригинал больше лимита sendPhoto, у которого еще нет копии для Telegram,
+    пережимается в памяти: иначе Telegram отклонил бы весь альбом.
+    """
+    with tracing.span('file.open', path=path, size=size) as span:
+        if size is None:
+            size = os.path.getsize(path)
+        if size <= TELEGRAM_PHOTO_LIMIT:
+            return StreamingInputFile(path, attach=attach)
+        logger.warning(f"🖼 {path} больше лимита Telegram, пережимаем на лету")
+        if span is not None:
+            span.set('reencoded', True)
+        return StreamingInputFile(path, attach=attach, content=telegram_jpeg(path))
+
+
+def build_input_media(item, stack):
+    """Собирает InputMedia: по file_id, если он есть, иначе потоком из файла.
+
+    Открытые файлы регистрируются в ``stack`` и закрываются после отправки.
+    """
+    media = item['file_id']
+    if not media:
+        try:
+            if item['kind'] == 'photo':
+                media = open_photo(item['path'], attach=True, size=item['size'])
+            else:
+                with tracing.span('file.open', path=item['path'], size=item['size']):
+                    media = StreamingInputFile(item['path'], attach=True)
+        except OSError as e:
+            logger.error(f"Error reading file {item['path']}: {e}")
+            return None
+        stack.callback(media.close)
+    if item['kind'] == 'video':
+        # С метаданными Telegram не обрабатывает файл заново и сразу дает смотреть
+        return InputMediaVideo(
+            media=media,
+            duration=item.get('duration'),
+            width=item.get('width'),
+            height=item.get('height'),
+            supports_streaming=item.get('supports_streaming'),
+        )
+    return InputMediaPhoto(media=media)
+
+
+def _sent_file(message):
+    """Достает загруженный файл из отправленного сообщения."""
+    if message.photo:
+        return message.photo[-1]  # Самый крупный размер
+    return message.video
+
+
+def update_file_id(model, pk, name, sent_file):
+    """Сохраняет file_id, если файл строки не заменили за время отправки.
+
+    Имя файла - хэш содержимого, поэтому тот же file_id получают и другие
+    строки с этим файлом, у которых его еще нет: их не придется загружать.
+    """
+    if sent_file is None:
+        return
+    file_field, id_field, unique_field = FILE_ID_FIELDS[model]
+    rows = model.objects.filter(Q(pk=pk) | Q(**{id_field: ''}), **{file_field: name})
+    rows.update(**{
+        id_field: sent_file.file_id,
+        unique_field: sent_file.file_unique_id,
+    })
+
+
+@db_async
+def remember_file_ids(items, messages):
+    """Записывает file_id для элементов, которые были загружены файлом."""
+    for item, message in zip(items, messages):
+        if item['file_id']:
+            continue
+        model = ModelVideo if item['kind'] == 'video' else ModelPhoto
+        sent_file = _sent_file(message)
+        update_file_id(model, item['pk'], item['name'], sent_file)
+        if sent_file is not None:
+            item['file_id'] = sent_file.file_id  # Обновляем и манифест в памяти
+
+
+@db_async
+def remember_preview_file_id(model_id, name, message):
+    update_file_id(ModelProfile, model_id, name, _sent_file(message))
+    invalidate_catalog()  # В снимке каталога должен появиться новый file_id
+
+
+async def prepare_album(album, semaphore):
+    """Готовит InputMedia альбома, открывая файлы в потоках параллельно.
+
+    Возвращает (ExitStack с открытыми файлами, [(item, media), ...]) в порядке альбома.
+    """
+    stack = contextlib.ExitStack()
+
+    async def build(item):
+        async with semaphore:
+            return item, await asyncio.to_thread(build_input_media, item, stack)
+
+    try:
+        built = await asyncio.gather(*(build(item) for item in album))
+    except BaseException:
+        stack.close()
+        raise
+    return stack, [(item, media) for item, media in built if media]
+
+
+async def send_media_albums(bot, chat_id, albums, strict=False, on_album_sent=None):
+    """Отправляет заранее разбитые альбомы. Возвращает число отправленных медиа.
+
+    Подготовка идет конвейером: первый альбом уходит, как только готовы его
+    файлы, а следующие готовятся во время загрузки. Альбомы отправляются
+    строго по очереди, поэтому порядок в чате сохраняется. Ошибка отправки
+    альбома пишется в лог, а с ``strict=True`` пробрасывается вызывающему;
+    альбом, у которого не открылся какой-то файл, тогда не отправляется.
+    ``on_album_sent(n)`` ждется после каждого отправленного альбома: n - сколько
+    альбомов с начала списка уже в чате.
+    """
+    semaphore = asyncio.Semaphore(PREPARE_CONCURRENCY)
+    queue = asyncio.Queue(maxsize=PREFETCH_ALBUMS)
+
+    async def produce():
+        try:
+            for album in albums:
+                await queue.put((len(album), await prepare_album(album, semaphore)))
+        except Exception as e:
+            logger.error(f"Error preparing media: {e}")
+        await queue.put(None)  # Конец конвейера
+
+    producer = asyncio.create_task(produce())
+    saving = []
+    sent = uploaded = 0
+    try:
+        index = 0
+        while (prepared := await queue.get()) is not None:
+            size, (stack, chunk) = prepared
+            index += 1
+            with stack:
+                if strict and len(chunk) < size:
+                    raise RuntimeError(f"Не удалось открыть {size - len(chunk)} файлов альбома {index}")
+                if not chunk:
+                    continue
+                upload = sum(item['size'] or 0 for item, _ in chunk if not item['file_id'])
+                try:
+                    with tracing.span('media.album', items=len(chunk), upload_bytes=upload):
+                        messages = await bot.send_media_group(chat_id=chat_id, media=[media for _, media in chunk])
+                except Exception as e:
+                    logger.error(f"Error sending media group: {e}")
+                    if strict:
+                        raise
+                    continue
+            sent += len(messages)
+            uploaded += upload
+            for item, _ in chunk:
+                MEDIA_SENT.inc(source='file_id' if item['file_id'] else 'upload')
+            # file_id сохраняются в фоне и не задерживают следующий альбом
+            saving.append(asyncio.create_task(remember_file_ids([item for item, _ in chunk], messages)))
+            if on_album_sent is not None:
+                await on_album_sent(index)
+        await producer
+    finally:
+        producer.cancel()
+        while not queue.empty():
+            prepared = queue.get_nowait()
+            if prepared is not None:
+                prepared[1][0].close()
+        for result in await asyncio.gather(*saving, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Error saving file_ids: {result}")
+        UPLOAD_BYTES.observe(uploaded)
+    return sent
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+from datetime import timedelta
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+from telegram.error import RetryAfter
+from . import metrics, tracing
+from .delivery import send_media_albums
+from .manifest import get_manifest
+from .models import OrderDelivery
+from .repository import db_async
+from .sqlite import atomic_write
+from .utils import bot  # Темп отправки задает общий лимитер бота
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_CONCURRENCY = 8  # Сколько чатов получают заказы одновременно
+CLAIM_BATCH_SIZE = 50
+POLL_INTERVAL = 1  # Пауза воркера, когда очередь пуста
+LOCK_TIMEOUT = timedelta(minutes=10)  # Строки упавшего воркера снова берутся в работу
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30  # Секунд до второй попытки, дальше удваивается
+BATCHES_KEY = 'delivery_batches'
+BATCH_TIMEOUT = 60 * 60
+
+
+def delivery_backlog():
+    """Строки outbox, которые еще не доставлены, по статусам."""
+    counts = dict(
+        OrderDelivery.objects.filter(status__in=('pending', 'processing'))
+        .values_list('status').annotate(count=Count('id')).order_by()
+    )
+    return {(status,): counts.get(status, 0) for status in ('pending', 'processing')}
+
+
+def oldest_pending_age():
+    """Сколько секунд ждет самая старая доставка, уже доступная воркерам."""
+    now = timezone.now()
+    oldest = OrderDelivery.objects.filter(status='pending', available_at__lte=now).aggregate(
+        oldest=Min('created_at'),
+    )['oldest']
+    return (now - oldest).total_seconds() if oldest else 0
+
+
+DELIVERY_BACKLOG = metrics.Gauge(
+    'stefbot_delivery_backlog', "Доставки в outbox, ожидающие отправки", ('status',), function=delivery_backlog,
+)
+DELIVERY_OLDEST_SECONDS = metrics.Gauge(
+    'stefbot_delivery_oldest_pending_seconds', "Возраст самой старой доставки в очереди",
+    function=oldest_pending_age,
+)
+DELIVERIES = metrics.Counter(
+    'stefbot_deliveries_total', "Попытки доставки заказов: sent, retry, failed", ('outcome',),
+)
+DELIVERY_SECONDS = metrics.Histogram('stefbot_delivery_seconds', "Отправка одного заказа покупателю")
+
+
+def enqueue_deliveries(order_ids, batch_id=''):
+    """Кладет заказы в outbox. Вызывается в транзакции, меняющей их статус.
+
+    Заказ доставляется один раз: повторная постановка игнорируется. Трасса,
+    в которой заказ оплатили, продолжается в воркере доставки.
+    """
+    traceparent = tracing.traceparent()
+    OrderDelivery.objects.bulk_create(
+        [OrderDelivery(order_id=order_id, batch_id=batch_id, traceparent=traceparent) for order_id in order_ids],
+        ignore_conflicts=True,
+    )
+    if batch_id:
+        cache.set(BATCHES_KEY, cache.get(BATCHES_KEY, [])[-9:] + [batch_id], BATCH_TIMEOUT)
+
+
+def batch_progress():
+    """Прогресс последних рассылок: [(batch_id, {'total', 'sent', 'failed'}), ...]."""
+    batch_ids = cache.get(BATCHES_KEY, [])
+    progress = {batch_id: {'total': 0, 'sent': 0, 'failed': 0} for batch_id in batch_ids}
+    rows = (
+        OrderDelivery.objects.filter(batch_id__in=batch_ids)
+        .values_list('batch_id', 'status').annotate(count=Count('id')).order_by()
+    )
+    for batch_id, status, count in rows:
+        progress[batch_id]['total'] += count
+        if status in ('sent', 'failed'):
+            progress[batch_id][status] += count
+    return [(batch_id, progress[batch_id]) for batch_id in batch_ids if progress[batch_id]['total']]
+
+
+def forget_batch(batch_id):
+    cache.set(BATCHES_KEY, [b for b in cache.get(BATCHES_KEY, []) if b != batch_id], BATCH_TIMEOUT)
+
+
+def claim_deliveries(worker_id, limit=CLAIM_BATCH_SIZE):
+    """Забирает пачку доставок из outbox за воркером.
+
+    На PostgreSQL строки блокируются через SELECT ... FOR UPDATE SKIP LOCKED.
+    На SQLite блокировки строк нет: захват делает UPDATE с условием на статус,
+    и строку, которую уже перехватил другой воркер, он не обновит.
+    """
+    now = timezone.now()
+    with atomic_write():
+        candidates = OrderDelivery.objects.filter(
+            Q(status='pending', available_at__lte=now)
+            | Q(status='processing', locked_at__lt=now - LOCK_TIMEOUT)
+        ).order_by('available_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:limit])
+        OrderDelivery.objects.filter(id__in=ids).filter(
+            Q(status='pending') | Q(status='processing', locked_at__lt=now - LOCK_TIMEOUT)
+        ).update(status='processing', locked_by=worker_id, locked_at=now, attempts=F('attempts') + 1)
+
+    rows = OrderDelivery.objects.filter(id__in=ids, status='processing', locked_by=worker_id, locked_at=now)
+    return list(rows.values(
+        'id', 'order_id', 'attempts', 'traceparent', 'confirmation_sent', 'albums_sent',
+        telegram_id=F('order__user__telegram_id'), model_id=F('order__model_id'),
+    ))
+
+
+def save_progress(delivery_id, **progress):
+    """Запоминает отправленную часть доставки (confirmation_sent, albums_sent)."""
+    OrderDelivery.objects.filter(id=delivery_id).update(**progress)
+
+
+def complete_delivery(delivery_id):
+    OrderDelivery.objects.filter(id=delivery_id).update(
+        status='sent', sent_at=timezone.now(), locked_by='', last_error=''
+    )
+
+
+def retry_delivery(delivery_id, attempts, error, delay=None):
+    """Возвращает доставку в очередь с паузой или помечает ошибкой после MAX_ATTEMPTS."""
+    if attempts >= MAX_ATTEMPTS:
+        OrderDelivery.objects.filter(id=delivery_id).update(status='failed', locked_by='', last_error=error)
+        return
+    delay = delay if delay is not None else RETRY_DELAY * 2 ** (attempts - 1)
+    OrderDelivery.objects.filter(id=delivery_id).update(
+        status='pending', locked_by='', last_error=error,
+        available_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+async def deliver_order(client, job, manifest):
+    """Отправляет покупателю подтверждение и фото заказа.
+
+    Неотправленный альбом или фото - ошибка доставки: строка outbox уходит
+    на повтор, а не помечается доставленной. Отправленное сообщение и каждый
+    альбом сразу отмечаются в строке, поэтому повтор продолжает с первого
+    неотправленного альбома и покупатель не получает дубли.
+    """
+    if not job['confirmation_sent']:
+        await client.send_message(
+            chat_id=job['telegram_id'],
+            text=f"✅ Ваш заказ {job['order_id']} был оплачен успешно! Получите фото ниже:",
+        )
+        await db_async(save_progress)(job['id'], confirmation_sent=True)
+    if not manifest['photo_albums']:
+        logger.warning(f"❌ Нет доступных фото для заказа {job['order_id']}")
+        return
+    done = job['albums_sent']
+    albums = manifest['photo_albums'][done:]
+
+    async def album_sent(count):
+        await db_async(save_progress)(job['id'], albums_sent=done + count)
+
+    expected = sum(len(album) for album in albums)
+    sent = await send_media_albums(client, job['telegram_id'], albums, strict=True, on_album_sent=album_sent)
+    if sent < expected:
+        raise RuntimeError(f"Отправлено {sent} фото из {expected}")
+
+
+async def process_delivery(job, manifest):
+    with tracing.trace('delivery', parent=job.get('traceparent'), order_id=job['order_id'],
+                       attempt=job['attempts']) as span:
+        try:
+            with DELIVERY_SECONDS.time():
+                await deliver_order(bot, job, manifest)
+        except RetryAfter as e:
+            logger.warning(f"⏳ Заказ {job['order_id']}: Telegram просит подождать {e.retry_after} с")
+            DELIVERIES.inc(outcome='retry' if job['attempts'] < MAX_ATTEMPTS else 'failed')
+            if span is not None:
+                span.error = f'RetryAfter: {e}'
+            await db_async(retry_delivery)(job['id'], job['attempts'], str(e), delay=e.retry_after)
+        except Exception as e:
+            logger.error(f"Ошибка доставки заказа {job['order_id']}: {e}")
+            DELIVERIES.inc(outcome='retry' if job['attempts'] < MAX_ATTEMPTS else 'failed')
+            if span is not None:
+                span.error = f'{type(e).__name__}: {e}'
+            await db_async(retry_delivery)(job['id'], job['attempts'], str(e))
+        else:
+            DELIVERIES.inc(outcome='sent')
+            await db_async(complete_delivery)(job['id'])
+
+
+async def run_worker(worker_id, batch_size=CLAIM_BATCH_SIZE, concurrency=DELIVERY_CONCURRENCY,
+                     once=False, stop=None):
+    """Цикл воркера: забирает доставки из outbox и отправляет их параллельно.
+
+    С ``once=True`` выходит, как только очередь опустела.
+    """
+    stop = stop or asyncio.Event()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job, manifest):
+        async with semaphore:
+            await process_delivery(job, manifest)
+
+    while not stop.is_set():
+        jobs = await db_async(claim_deliveries)(worker_id, batch_size)
+        if not jobs:
+            if once:
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        # Манифест загружается один раз на модель в пачке
+        manifests = {}
+        for model_id in {job['model_id'] for job in jobs}:
+            manifests[model_id] = await db_async(get_manifest)(model_id)
+        await asyncio.gather(*(run(job, manifests[job['model_id']]) for job in jobs))
+        logger.info(f"📦 Воркер {worker_id}: обработано доставок {len(jobs)}")
@@ -0,0 +1,289 @@
+import asyncio
+import email.parser
+import email.policy
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+from telegram.error import TimedOut
+from telegram.request import BaseRequest
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Stefan', 'username': 'stefan_test_bot'}
+
+# Ошибки внедряются только в ответы на действия бота, не в getUpdates/getMe
+FAULTY_PREFIXES = ('send', 'edit', 'answer', 'copy', 'forward')
+
+
+def _user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{chat_id}'}
+
+
+def command_update(update_id, chat_id, command='/start'):
+    """Апдейт с командой от пользователя в личном чате."""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': _user(chat_id),
+            'text': command,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }
+
+
+def callback_update(update_id, chat_id, data, message_id=1):
+    """Нажатие inline-кнопки под сообщением бота с фото."""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': _user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'caption': 'menu',
+                'photo': [{'file_id': 'menu', 'file_unique_id': 'menu', 'width': 1, 'height': 1}],
+            },
+        },
+    }
+
+
+def _chat_id(value):
+    """chat_id приходит числом в памяти и строкой по HTTP."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _content_size(content):
+    """Размер части multipart: байты или открытый файл (StreamingInputFile)."""
+    if isinstance(content, bytes):
+        return len(content)
+    position = content.tell()
+    size = content.seek(0, 2) - position
+    content.seek(position)
+    return size
+
+
+class FakeBotAPI(BaseRequest):
+    """Bot API в памяти для бенчмарков: отдает апдейты и записывает ответы бота.
+
+    ``rtt`` - задержка сети туда и обратно, половина на запрос и половина на ответ.
+    Ответ считается доставленным, когда запрос дошел до "Telegram".
+    ``retry_after_rate`` и ``timeout_rate`` - доля действий бота, на которые
+    "Telegram" отвечает 429 с retry_after или не отвечает вовсе.
+    """
+
+    def __init__(self, rtt=0, retry_after_rate=0.0, timeout_rate=0.0, retry_after=1, seed=None):
+        self.rtt = rtt
+        self.retry_after_rate = retry_after_rate
+        self.timeout_rate = timeout_rate
+        self.retry_after = retry_after
+        self.timeout_delay = 1.0  # Сколько держать "зависший" запрос по HTTP
+        self.pending = []
+        self.replies = []  # (метод, chat_id, время)
+        self.calls = Counter()
+        self.faults = Counter()
+        self.uploaded = 0  # Байт в multipart-загрузках
+        self._random = random.Random(seed)
+        self._new_update = asyncio.Event()
+        self._waiters = {}
+        self._file_ids = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def push_update(self, update):
+        """Апдейт появился на стороне Telegram и ждет getUpdates."""
+        self.pending.append(update)
+        self._new_update.set()
+
+    def expect_reply(self, chat_id):
+        """Future, которая получит время первого ответа бота в чат."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        return future
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if request_data and request_data.contains_files:
+            self.uploaded += sum(_content_size(value[1]) for value in request_data.multipart_data.values())
+        status, body = await self.respond(endpoint, params)
+        if status is None:
+            raise TimedOut()
+        return status, body
+
+    async def respond(self, endpoint, params):
+        """Ответ "Telegram" с задержкой сети: (HTTP-статус, тело) или (None, None) при таймауте."""
+        self.calls[endpoint] += 1
+        await asyncio.sleep(self.rtt / 2)
+        if endpoint.startswith(FAULTY_PREFIXES):
+            roll = self._random.random()
+            if roll < self.timeout_rate:
+                self.faults['timeout'] += 1
+                return None, None
+            if roll < self.timeout_rate + self.retry_after_rate:
+                self.faults['retry_after'] += 1
+                await asyncio.sleep(self.rtt / 2)
+                return 429, json.dumps({
+                    'ok': False, 'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                }).encode()
+        result = await self.handle(endpoint, params)
+        await asyncio.sleep(self.rtt / 2)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _message(self, chat_id, **content):
+        return {'message_id': len(self.replies), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, **content}
+
+    def _media(self, kind):
+        """Загруженный файл в ответе: бот сохранит его file_id."""
+        self._file_ids += 1
+        file = {'file_id': f'file{self._file_ids}', 'file_unique_id': f'unique{self._file_ids}',
+                'width': 1280, 'height': 720}
+        if kind == 'video':
+            return {'video': dict(file, duration=1)}
+        return {'photo': [file]}
+
+    async def handle(self, endpoint, params):
+        if endpoint == 'getMe':
+            return BOT_USER
+        if endpoint == 'getUpdates':
+            return await self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        if endpoint.startswith(('send', 'edit')):
+            chat_id = _chat_id(params.get('chat_id'))
+            at = time.monotonic()
+            self.replies.append((endpoint, chat_id, at))
+            waiter = self._waiters.pop(chat_id, None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(at)
+            if endpoint == 'sendMediaGroup':
+                media = params.get('media') or []
+                if isinstance(media, str):
+                    media = json.loads(media)
+                return [self._message(chat_id, **self._media(item.get('type'))) for item in media]
+            if endpoint in ('sendPhoto', 'sendVideo'):
+                return self._message(chat_id, **self._media(endpoint[4:].lower()))
+            return self._message(chat_id, text='ok')
+        return True
+
+    async def get_updates(self, offset, timeout):
+        """Long polling: держит запрос, пока не появится апдейт или не выйдет timeout."""
+        self.pending = [update for update in self.pending if update['update_id'] >= offset]
+        if not self.pending:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.pending)
+
+
+class FakeBotAPIServer:
+    """Локальный HTTP-сервер с FakeBotAPI за ним.
+
+    Бот ходит в него настоящим HTTPXRequest (``base_url``), поэтому в нагрузку
+    входят соединения, multipart-загрузки и таймауты клиента. Зависший
+    запрос держится ``api.timeout_delay`` секунд, после чего соединение закрывается.
+    """
+
+    def __init__(self, api, host='127.0.0.1', port=0):
+        self.api = api
+        self.host = host
+        self.port = port
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}/bot'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                endpoint, content_type, body = request
+                if content_type.startswith('multipart/form-data'):
+                    # Разбор мегабайтных загрузок держал бы цикл, общий с ботом
+                    params = await asyncio.to_thread(self._parse_body, content_type, body)
+                else:
+                    params = self._parse_body(content_type, body)
+                status, payload = await self.api.respond(endpoint, params)
+                if status is None:
+                    await asyncio.sleep(self.api.timeout_delay)
+                    break
+                writer.write(
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                    f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n'.encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        target = request_line.decode('latin-1').split(' ')[1]
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while size := int((await reader.readline()).split(b';')[0], 16):
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            await reader.readline()
+            body = b''.join(chunks)
+        else:
+            body = await reader.readexactly(int(headers.get('content-length') or 0))
+        endpoint = target.split('?')[0].rsplit('/', 1)[-1]
+        return endpoint, headers.get('content-type', ''), body
+
+    def _parse_body(self, content_type, body):
+        if content_type.startswith('multipart/form-data'):
+            self.api.uploaded += len(body)
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+            )
+            return {
+                part.get_param('name', header='content-disposition'): part.get_content()
+                for part in message.iter_parts() if part.get_filename() is None
+            }
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return dict(parse_qsl(body.decode()))
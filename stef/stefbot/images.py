@@ -0,0 +1,112 @@
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+from . import metrics
+from .catalog import invalidate_catalog
+from .manifest import invalidate_manifest
+from .models import ModelPhoto, ModelProfile
+from .storage import release
+
+logger = logging.getLogger(__name__)
+
+# Сторона копии для Telegram - настройка TELEGRAM_PHOTO_MAX_SIDE (1280 или 2560 для HD)
+THUMBNAIL_MAX_SIDE = 320
+JPEG_QUALITY = 85
+TELEGRAM_PHOTO_LIMIT = 10 * 1024 * 1024  # Лимит sendPhoto
+IMAGE_WORKERS = 2
+
+# Модель -> (исходное поле, поле копии для Telegram, поле миниатюры)
+DERIVATIVE_FIELDS = {
+    ModelPhoto: ('photo', 'telegram_photo', 'thumbnail'),
+    ModelProfile: ('preview_photo', 'preview_telegram', 'preview_thumbnail'),
+}
+
+# Копии считаются в фоне: сохранение в админке не ждет Pillow
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='stefbot-images')
+IMAGE_JOBS = metrics.Gauge('stefbot_image_jobs', "Задачи построения копий фото в фоновом пуле: в очереди и в работе")
+
+
+def render_jpeg(image, max_side):
+    """Уменьшает изображение и кодирует в progressive JPEG без EXIF."""
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    # EXIF не передается в save, поэтому в файл не попадает
+    image.save(buffer, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def load_image(file):
+    """Открывает оригинал и поворачивает его по EXIF, пока тот еще есть."""
+    with Image.open(file) as image:
+        image = ImageOps.exif_transpose(image)
+        return image.convert('RGB')
+
+
+def telegram_jpeg(path):
+    """Копия для Telegram в памяти - для оригиналов, у которых ее еще нет."""
+    with open(path, 'rb') as file:
+        return render_jpeg(load_image(file), settings.TELEGRAM_PHOTO_MAX_SIDE)
+
+
+def build_derivatives(model, pk):
+    """Создает копию для Telegram и миниатюру; возвращает True, если записал.
+
+    Если оригинал успели заменить, созданные файлы удаляются: копии
+    нового оригинала построит его собственная задача.
+    """
+    source_field, telegram_field, thumbnail_field = DERIVATIVE_FIELDS[model]
+    instance = model.objects.filter(pk=pk).first()
+    source = instance and getattr(instance, source_field)
+    if not source:
+        return False
+    with source.open('rb') as file:
+        image = load_image(file)
+
+    stem = os.path.splitext(os.path.basename(source.name))[0]
+    names = {}
+    sides = ((telegram_field, settings.TELEGRAM_PHOTO_MAX_SIDE), (thumbnail_field, THUMBNAIL_MAX_SIDE))
+    for field_name, max_side in sides:
+        field = model._meta.get_field(field_name)
+        names[field_name] = field.storage.save(
+            field.generate_filename(instance, f'{stem}.jpg'),
+            ContentFile(render_jpeg(image, max_side)),
+        )
+
+    if not model.objects.filter(pk=pk, **{source_field: source.name}).update(**names):
+        release(*names.values())  # Та же копия может быть у строки с тем же оригиналом
+        return False
+    release(*(getattr(instance, field).name for field, name in names.items() if getattr(instance, field).name != name))
+    # update() не шлет сигналы, поэтому кэши сбрасываем сами
+    if model is ModelPhoto:
+        invalidate_manifest(instance.model_id)
+    else:
+        invalidate_catalog()
+    return True
+
+
+def _build_in_background(model, pk):
+    close_old_connections()
+    try:
+        if build_derivatives(model, pk):
+            logger.info(f"🖼 Копии для Telegram готовы: {model.__name__} {pk}")
+    except Exception as e:
+        logger.error(f"❌ Не удалось построить копии {model.__name__} {pk}: {e}")
+    finally:
+        IMAGE_JOBS.dec()
+        close_old_connections()
+
+
+def _submit(model, pk):
+    IMAGE_JOBS.inc()
+    _executor.submit(_build_in_background, model, pk)
+
+
+def schedule_derivatives(model, pk):
+    """Ставит построение копий в фоновый пул после коммита транзакции."""
+    transaction.on_commit(lambda: _submit(model, pk))
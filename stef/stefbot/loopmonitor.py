@@ -0,0 +1,145 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.05  # Период пробного таймера; его опоздание - это лаг цикла
+LAG_WINDOW = 1200  # Сэмплов в окне перцентилей: минута при SAMPLE_INTERVAL
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUANTILES = (0.5, 0.9, 0.99, 1.0)
+MAX_STACK_FRAMES = 30
+
+_monitors = weakref.WeakSet()
+
+
+def _lag_quantiles():
+    samples = sorted(lag for monitor in list(_monitors) for lag in list(monitor.samples))
+    if not samples:
+        return {}
+    return {(str(q),): samples[min(len(samples) - 1, int(len(samples) * q))] for q in QUANTILES}
+
+
+LOOP_LAG = metrics.Histogram(
+    'stefbot_event_loop_lag_seconds', "Опоздание таймера цикла событий", buckets=LAG_BUCKETS,
+)
+LOOP_LAG_QUANTILES = metrics.Gauge(
+    'stefbot_event_loop_lag_quantile_seconds', "Перцентили лага цикла событий за последнюю минуту",
+    ('quantile',), function=_lag_quantiles,
+)
+LOOP_BLOCKS = metrics.Counter(
+    'stefbot_event_loop_blocks_total', "Блокировки цикла дольше порога по месту в коде", ('site',),
+)
+
+
+def blocking_site(stack):
+    """Место блокировки для метки: самый глубокий кадр кода проекта, иначе самый глубокий.
+
+    Смотрим только кадры ниже Handle._run - это callback, который держит цикл;
+    выше лежат asyncio.run и точка входа, они есть в любом стеке.
+    """
+    events = os.path.join(os.path.dirname(asyncio.__file__), 'events.py')
+    start = max((i + 1 for i, frame in enumerate(stack) if frame.filename == events and frame.name == '_run'),
+                default=0)
+    callback = stack[start:] or stack
+    root = str(settings.BASE_DIR)
+    for frame in reversed(callback):
+        if frame.filename.startswith(root) and 'site-packages' not in frame.filename:
+            return f'{os.path.relpath(frame.filename, root)}:{frame.lineno}'
+    if callback:
+        return f'{os.path.basename(callback[-1].filename)}:{callback[-1].lineno}'
+    return 'unknown'
+
+
+class LoopMonitor:
+    """Следит, не держит ли кто-то цикл событий дольше ``threshold`` секунд.
+
+    Пробный таймер каждые SAMPLE_INTERVAL секунд пишет свое опоздание в
+    метрики. Сторожевой поток проверяет, давно ли таймер срабатывал, и если
+    цикл занят дольше порога, снимает стек потока цикла - прямо во время
+    блокировки, поэтому в логе видна виновная строка. С ``debug=True``
+    включается еще и отладочный режим asyncio: он называет медленные callback.
+    """
+
+    def __init__(self, threshold=None, interval=SAMPLE_INTERVAL, debug=False):
+        self.threshold = threshold if threshold is not None else settings.LOOP_BLOCK_THRESHOLD
+        self.interval = interval
+        self.debug = debug
+        self.samples = collections.deque(maxlen=LAG_WINDOW)
+        self.blocks = collections.deque(maxlen=100)  # (место, стек) последних блокировок
+        self._beat = None
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Запускает замеры на текущем цикле событий."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = loop.create_task(self._sample())
+        self._watchdog = threading.Thread(target=self._watch, name='stefbot-loop-watchdog', daemon=True)
+        self._watchdog.start()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+        _monitors.add(self)
+        logger.info(f"⏱ Монитор цикла событий: порог {self.threshold * 1000:.0f} мс")
+        return self
+
+    async def stop(self):
+        _monitors.discard(self)
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    async def _sample(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            lag = max(0.0, self._beat - started - self.interval)
+            self.samples.append(lag)
+            LOOP_LAG.observe(lag)
+
+    def _watch(self):
+        reported = None  # Удар таймера, после которого уже сняли стек
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked > self.threshold and reported != beat:
+                reported = beat
+                self._report(blocked)
+
+    def _report(self, blocked):
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame)[-MAX_STACK_FRAMES:]
+        site = blocking_site(stack)
+        self.blocks.append((site, stack))
+        LOOP_BLOCKS.inc(site=site)
+        logger.warning(
+            f"🐢 Цикл событий занят уже {blocked * 1000:.0f} мс, место: {site}\n"
+            + ''.join(traceback.format_list(stack))
+        )
+
+
+def start_loop_monitor():
+    """Монитор по настройке LOOP_MONITOR ('on' или 'debug'); None, если выключен."""
+    if settings.LOOP_MONITOR not in ('on', 'debug'):
+        return None
+    return LoopMonitor(debug=settings.LOOP_MONITOR == 'debug').start()
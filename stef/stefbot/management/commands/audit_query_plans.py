@@ -0,0 +1,190 @@
+import json
+import re
+from types import SimpleNamespace
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import Http404
+from django.test import RequestFactory, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from stefbot import repository, views
+from stefbot.catalog import build_projection
+from stefbot.delivery import update_file_id
+from stefbot.dispatcher import claim_deliveries
+from stefbot.sharding import fetch_updates
+from stefbot.manifest import build_manifest
+from stefbot.models import ModelPhoto, ModelProfile, ModelVideo, Order, TelegramUser
+from stefbot.orders import encode_cursor, paid_orders, paid_orders_page
+from stefbot.users import upsert_user
+
+# Таблицы, которые читаются целиком намеренно: каталог моделей небольшой
+SMALL_TABLES = {'stefbot_modelprofile'}
+
+EXPLAINED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE')
+
+
+class Command(BaseCommand):
+    help = (
+        "Выполняет запросы бота и API в откатываемой транзакции, строит для "
+        "каждого EXPLAIN и падает, если какой-то из них читает таблицу целиком."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true', help="Печатать план каждого запроса")
+
+    def handle(self, *args, **options):
+        failures = []
+        with transaction.atomic():
+            ids = self.sample_ids()
+            for name, scenario, allowed in self.scenarios(ids):
+                for sql, params in self.capture(scenario):
+                    plan = self.explain(sql, params)
+                    scans = self.full_scans(sql, plan) - allowed
+                    if options['verbose_plans']:
+                        self.stdout.write(f"{name}: {sql}\n  " + "\n  ".join(plan))
+                    if scans:
+                        failures.append((name, sql, scans))
+                        self.stdout.write(self.style.ERROR(f"❌ {name}: full scan of {', '.join(sorted(scans))}"))
+                    else:
+                        self.stdout.write(self.style.SUCCESS(f"✅ {name}"))
+            transaction.set_rollback(True)
+
+        if failures:
+            details = "\n".join(f"{name}: {sql}" for name, sql, _ in failures)
+            raise CommandError(f"{len(failures)} queries do a full table scan:\n{details}")
+
+    def sample_ids(self):
+        """Берет существующие id, чтобы запросы были похожи на настоящие."""
+        order = Order.objects.order_by('id').first()
+        photo = ModelPhoto.objects.values_list('id', 'photo').first()
+        return {
+            'telegram_id': TelegramUser.objects.values_list('telegram_id', flat=True).first() or 1,
+            'model_id': ModelProfile.objects.values_list('id', flat=True).first() or 1,
+            'photo': photo or (1, 'blobs/00/missing.jpg'),
+            'order_id': order.id if order else 1,
+            'cursor': encode_cursor(order.created_at, order.id) if order else '0_1',
+        }
+
+    def scenarios(self, ids):
+        """Пути доступа к БД бота, сигналов, админки и API: (имя, вызов, разрешенные сканы).
+
+        Вызываются сами хелперы, вьюхи и ChangeList админки, а не копии их
+        запросов: план проверяется у того SQL, который они выполняют сейчас.
+        """
+        telegram_id, model_id, order_id = ids['telegram_id'], ids['model_id'], ids['order_id']
+        api = APIRequestFactory()
+        superuser = User(username='audit', is_staff=True, is_superuser=True)
+
+        def bot_call(helper, *args):
+            # Без обертки db_async: она закрыла бы соединение посреди транзакции аудита
+            return lambda: helper.__wrapped__(*args)
+
+        def api_call(viewset, action, pk=None):
+            @override_settings(ALLOWED_HOSTS=['testserver'])
+            def call():
+                request = api.get('/')
+                force_authenticate(request, user=superuser)
+                kwargs = {'pk': pk} if pk is not None else {}
+                viewset.as_view({'get': action})(request, **kwargs).render()
+            return call
+
+        def changelist(model, **filters):
+            def call():
+                request = RequestFactory().get('/', filters)
+                request.user = superuser
+                admin.site._registry[model].get_changelist_instance(request)
+            return call
+
+        def create_order_view():
+            body = json.dumps({'telegram_id': telegram_id, 'model_id': model_id})
+            views.create_order(RequestFactory().post('/', body, content_type='application/json'))
+
+        return [
+            ('bot.upsert_user', lambda: upsert_user(telegram_id, None), set()),
+            ('bot.get_model_by_id', bot_call(repository.get_model_by_id, model_id), set()),
+            ('bot.catalog_projection', lambda: list(build_projection()['models']), SMALL_TABLES),
+            ('bot.media_manifest', lambda: build_manifest(model_id), set()),
+            ('bot.paid_orders_first_page', lambda: paid_orders_page(telegram_id), set()),
+            ('bot.paid_orders_next_page', lambda: paid_orders_page(telegram_id, ids['cursor']), set()),
+            ('bot.paid_orders_prev_page', lambda: paid_orders_page(telegram_id, ids['cursor'], backwards=True), set()),
+            ('bot.paid_orders_count', lambda: paid_orders(telegram_id).count(), set()),
+            ('bot.get_order_details', bot_call(repository.get_order_details, order_id), set()),
+            ('bot.get_full_order_data', bot_call(repository.get_full_order_data, order_id), set()),
+            ('bot.file_id_update', lambda: update_file_id(
+                ModelPhoto, *ids['photo'], SimpleNamespace(file_id='audit', file_unique_id='audit')), set()),
+            ('worker.claim_deliveries', lambda: claim_deliveries('audit'), set()),
+            ('worker.fetch_shard_updates', lambda: fetch_updates(0, 0, 100), set()),
+            ('admin.orders_changelist', changelist(Order), set()),
+            ('admin.orders_changelist_paid', changelist(Order, status__exact='paid'), set()),
+            ('admin.videos_changelist', changelist(ModelVideo), set()),
+            ('api.users.list', api_call(views.TelegramUserViewSet, 'list'), set()),
+            ('api.users.retrieve', api_call(views.TelegramUserViewSet, 'retrieve', 1), set()),
+            ('api.models.list', api_call(views.ModelProfileViewSet, 'list'), SMALL_TABLES),
+            ('api.models.retrieve', api_call(views.ModelProfileViewSet, 'retrieve', model_id), set()),
+            ('api.model_photos.list', api_call(views.ModelPhotoViewSet, 'list'), set()),
+            ('api.orders.list', api_call(views.OrderViewSet, 'list'), set()),
+            ('api.orders.retrieve', api_call(views.OrderViewSet, 'retrieve', order_id), set()),
+            ('api.create_order', create_order_view, set()),
+        ]
+
+    def capture(self, scenario):
+        """Выполняет сценарий и возвращает его SQL вместе с параметрами."""
+        statements = []
+
+        def wrapper(execute, sql, params, many, context):
+            if sql.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+                statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(wrapper), transaction.atomic():
+            try:
+                scenario()
+            except (Http404, ObjectDoesNotExist):
+                pass  # На пустой базе важен сам запрос, а не найденная строка
+            transaction.set_rollback(True)
+        return statements
+
+    def explain(self, sql, params):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # На маленькой базе планировщик выбирает Seq Scan и при наличии индекса
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                return [json.dumps(cursor.fetchone()[0])]
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def full_scans(self, sql, plan):
+        """Таблицы, прочитанные целиком.
+
+        Скан с условием WHERE - полный проход, даже по индексу. Без условия
+        допустимы скан под LIMIT без сортировки и COUNT(*) по покрывающему индексу.
+        """
+        if connection.vendor == 'postgresql':
+            return self._postgres_scans(json.loads(plan[0])[0]['Plan'])
+        upper = sql.upper()
+        filtered = ' WHERE ' in upper
+        bounded = ' LIMIT ' in upper and not any('TEMP B-TREE' in row for row in plan)
+        scans = set()
+        for row in plan:
+            match = re.match(r'SCAN (?:TABLE )?(\w+)(.*)', row)
+            if match and (filtered or not (bounded or 'COVERING INDEX' in match.group(2))):
+                scans.add(match.group(1))
+        return scans
+
+    def _postgres_scans(self, node, bounded=False):
+        if node['Node Type'] == 'Limit':
+            bounded = True
+        elif node['Node Type'] == 'Sort':
+            bounded = False
+        scans = set()
+        if node['Node Type'] == 'Seq Scan' and ('Filter' in node or not bounded):
+            scans.add(node['Relation Name'])
+        elif 'Index' in node['Node Type'] and 'Filter' in node and 'Index Cond' not in node:
+            scans.add(node['Relation Name'])
+        for child in node.get('Plans', []):
+            scans |= self._postgres_scans(child, bounded)
+        return scans
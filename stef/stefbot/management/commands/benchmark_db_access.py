@@ -0,0 +1,82 @@
+import asyncio
+import time
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from stefbot import repository
+from stefbot.models import ModelProfile, Order, TelegramUser
+from stefbot.repository import db_async
+from stefbot.users import upsert_user
+from .benchmark_queries import refuse_live_database
+
+FIRST_CHAT_ID = 9_000_000_000  # Пользователи бенчмарка не пересекаются с настоящими
+
+# Синхронные тела функций репозитория, без обертки и без кэша пользователей
+CALLBACK_QUERIES = (
+    (upsert_user, lambda user, order: (user, None)),
+    (repository.get_user_orders_page.func, lambda user, order: (user,)),
+    (repository.get_order_details.func, lambda user, order: (order,)),
+    (repository.get_full_order_data.func, lambda user, order: (order,)),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает пропускную способность параллельных callback'ов бота при "
+        "запросах через sync_to_async (один поток) и через пул потоков БД."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callbacks', type=int, default=400, help="Сколько callback'ов выполнить")
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--db-latency', type=float, default=0.002,
+                            help="Задержка сети до БД на запрос, с (0 - локальный SQLite как есть)")
+
+    def handle(self, *args, **options):
+        refuse_live_database()
+        chat_ids = [FIRST_CHAT_ID + i for i in range(options['users'])]
+        # Без файла превью: удаление модели не должно трогать хранилище медиа
+        model = ModelProfile.objects.create(name='benchmark', description='', price=1, preview_photo='')
+        users = TelegramUser.objects.bulk_create([TelegramUser(telegram_id=chat_id) for chat_id in chat_ids])
+        orders = Order.objects.bulk_create(
+            [Order(user=user, model=model, amount=1, status='paid') for user in users]
+        )
+        jobs = [
+            (chat_ids[i % len(chat_ids)], orders[i % len(orders)].id)
+            for i in range(options['callbacks'])
+        ]
+        try:
+            results = {
+                'sync_to_async': asyncio.run(self.run(sync_to_async, jobs, options['db_latency'])),
+                'db pool': asyncio.run(self.run(db_async, jobs, options['db_latency'])),
+            }
+        finally:
+            Order.objects.filter(model=model).delete()
+            model.delete()
+            TelegramUser.objects.filter(telegram_id__in=chat_ids).delete()
+
+        baseline = results['sync_to_async']
+        for name, throughput in results.items():
+            self.stdout.write(f"{name:14} {throughput:.0f} callbacks/s ({throughput / baseline:.2f}x)")
+
+    async def run(self, to_async, jobs, latency):
+        def network(execute, sql, params, many, context):
+            time.sleep(latency)  # Как сетевой запрос: поток ждет, GIL свободен
+            return execute(sql, params, many, context)
+
+        def with_latency(func):
+            def call(*args):
+                with connection.execute_wrapper(network):
+                    return func(*args)
+            return call
+
+        queries = [(to_async(with_latency(func)), arguments) for func, arguments in CALLBACK_QUERIES]
+
+        async def callback(user, order):
+            for query, arguments in queries:
+                await query(*arguments(user, order))
+
+        started = time.monotonic()
+        await asyncio.gather(*(callback(user, order) for user, order in jobs))
+        return len(jobs) / (time.monotonic() - started)
@@ -0,0 +1,73 @@
+import statistics
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+
+from stefbot.models import ModelProfile, Order, TelegramUser
+from stefbot.orders import bulk_mark_paid
+from .benchmark_queries import refuse_live_database
+
+FIRST_CHAT_ID = 9_000_000_000  # Пользователи бенчмарка не пересекаются с настоящими
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный тест записи: параллельные клиенты создают заказы и "
+        "подтверждают оплату. Печатает пропускную способность, задержки и "
+        "число ошибок блокировки БД. Бэкенд выбирается переменной DB_ENGINE."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=16, help="Параллельных клиентов (потоков)")
+        parser.add_argument('--orders', type=int, default=50, help="Заказов на клиента")
+
+    def handle(self, *args, **options):
+        refuse_live_database()
+        chat_ids = [FIRST_CHAT_ID + i for i in range(options['clients'])]
+        # Без файла превью: удаление модели не должно трогать хранилище медиа
+        model = ModelProfile.objects.create(name='benchmark', description='', price=1, preview_photo='')
+        users = TelegramUser.objects.bulk_create([TelegramUser(telegram_id=chat_id) for chat_id in chat_ids])
+        latencies, errors = [], []
+        try:
+            threads = [
+                threading.Thread(target=self.client, args=(user, model, options['orders'], latencies, errors))
+                for user in users
+            ]
+            started = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+        finally:
+            Order.objects.filter(model=model).delete()
+            model.delete()
+            TelegramUser.objects.filter(telegram_id__in=chat_ids).delete()
+
+        self.stdout.write(f"backend={connection.vendor} clients={options['clients']}")
+        self.stdout.write(f"orders:   {len(latencies)} ok, {len(errors)} failed ({len(latencies) / elapsed:.0f} orders/s)")
+        if latencies:
+            latencies.sort()
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            self.stdout.write(
+                f"latency:  p50={statistics.median(latencies) * 1000:.1f} ms p95={p95 * 1000:.1f} ms "
+                f"max={latencies[-1] * 1000:.1f} ms"
+            )
+        for message in sorted(set(errors)):
+            self.stdout.write(f"error:    {message} x{errors.count(message)}")
+
+    def client(self, user, model, orders, latencies, errors):
+        """Один клиент: заказ и подтверждение оплаты, как бот и админка."""
+        try:
+            for _ in range(orders):
+                started = time.monotonic()
+                try:
+                    order = Order.objects.create(user=user, model=model, amount=1, status='pending')
+                    bulk_mark_paid(Order.objects.filter(id=order.id))
+                except OperationalError as e:
+                    errors.append(str(e))
+                else:
+                    latencies.append(time.monotonic() - started)
+        finally:
+            connection.close()
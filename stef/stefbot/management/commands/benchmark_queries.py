@@ -0,0 +1,250 @@
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from stefbot import repository, views
+from stefbot.catalog import build_projection
+from stefbot.manifest import build_manifest
+from stefbot.models import ModelPhoto, ModelProfile, Order, TelegramUser
+from stefbot.orders import encode_cursor, paid_orders, paid_orders_page
+from stefbot.users import upsert_user
+
+FIRST_CHAT_ID = 9_000_000_000  # Пользователи бенчмарка не пересекаются с настоящими
+
+# Объем данных при --scale 1
+ROWS = {
+    ModelProfile: 10_000,
+    ModelPhoto: 500_000,
+    TelegramUser: 200_000,
+    Order: 2_000_000,
+}
+STATUSES = ['paid'] * 7 + ['pending'] * 2 + ['rejected']
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+BATCH_SIZE = 10_000
+
+
+def expected_rows(scale):
+    return {model: max(1, round(count * scale)) for model, count in ROWS.items()}
+
+
+def insert(model, fields, rows):
+    """Пишет строки пачками в обход ORM: 2M объектов Order через bulk_create - минуты."""
+    columns = ', '.join(connection.ops.quote_name(model._meta.get_field(name).column) for name in fields)
+    sql = (f"INSERT INTO {connection.ops.quote_name(model._meta.db_table)} ({columns}) "
+           f"VALUES ({', '.join(['%s'] * len(fields))})")
+    batch = []
+    with connection.cursor() as cursor:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                cursor.executemany(sql, batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+
+
+def refuse_live_database(models=(ModelProfile, ModelPhoto, TelegramUser, Order)):
+    """Бенчмарк пишет в базу: на базе с настоящими данными он отказывается работать."""
+    if any(model.objects.exists() for model in models):
+        raise CommandError(
+            "В базе уже есть другие данные. Укажите отдельную базу, например "
+            "SQLITE_PATH=cache/benchmark.sqlite3 python manage.py migrate"
+        )
+
+
+def generate(scale, seed):
+    """Детерминированные данные: id с 1 подряд, значения из random.Random(seed)."""
+    rng = random.Random(seed)
+    counts = expected_rows(scale)
+    models, photos, users, orders = (counts[m] for m in (ModelProfile, ModelPhoto, TelegramUser, Order))
+    date = connection.ops.adapt_datetimefield_value
+    price_field = ModelProfile._meta.get_field('price')
+    prices = [price_field.get_db_prep_save(Decimal(rng.randrange(500, 20_000, 100)), connection)
+              for _ in range(models)]
+
+    with transaction.atomic():
+        insert(ModelProfile, ('id', 'name', 'description', 'price', 'preview_photo', 'preview_telegram',
+                              'preview_thumbnail', 'preview_file_id', 'preview_file_unique_id'), (
+            (i, f'Модель {i}', f'Описание модели {i}. ' * rng.randint(1, 8), prices[i - 1],
+             f'model_previews/{i}.jpg', f'model_previews/telegram/{i}.jpg', f'model_previews/thumbs/{i}.jpg',
+             f'preview{i}', f'preview_unique{i}')
+            for i in range(1, models + 1)
+        ))
+        # У каждой модели есть фото, file_id уже получены (рабочий режим)
+        insert(ModelPhoto, ('id', 'model_id', 'photo', 'telegram_photo', 'thumbnail',
+                            'telegram_file_id', 'telegram_file_unique_id'), (
+            (i, rng.randint(1, models) if i > models else i,
+             f'model_photos/{i}.jpg', f'model_photos/telegram/{i}.jpg', f'model_photos/thumbs/{i}.jpg',
+             f'photo{i}', f'photo_unique{i}')
+            for i in range(1, photos + 1)
+        ))
+        insert(TelegramUser, ('id', 'telegram_id', 'username', 'created_at'), (
+            (i, FIRST_CHAT_ID + i, f'user{i}',
+             date(START + timedelta(seconds=i * 60)))
+            for i in range(1, users + 1)
+        ))
+        # Заказы идут по времени; покупатели и модели - случайные
+        insert(Order, ('id', 'user_id', 'model_id', 'amount', 'status', 'payment_proof', 'created_at'), (
+            (i, rng.randint(1, users), model_id, prices[model_id - 1], rng.choice(STATUSES), '',
+             date(START + timedelta(seconds=i * 7 + rng.random())))
+            for i in range(1, orders + 1)
+            for model_id in (rng.randint(1, models),)
+        ))
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), list(ROWS)):
+                cursor.execute(sql)
+
+
+class Command(BaseCommand):
+    help = (
+        "Бенчмарк запросов бота и API на больших детерминированных данных "
+        "(10k моделей, 500k фото, 200k пользователей, 2M заказов при --scale 1). "
+        "Пишет время и число запросов в JSON и сравнивает с сохраненным прогоном. "
+        "Запускать на отдельной базе: SQLITE_PATH=cache/benchmark.sqlite3 или POSTGRES_DB."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0, help="Множитель объема данных")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=20, help="Вызовов каждого запроса")
+        parser.add_argument('--save', help="Записать результаты в JSON")
+        parser.add_argument('--compare', help="Сравнить с JSON прошлого прогона и упасть при регрессии")
+        # Шум миллисекундных запросов - десятки процентов; потеря индекса дает разы
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help="Допустимый рост медианы, доля (0.5 = +50%%)")
+        parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                            help="Рост медианы меньше этого не считается регрессией")
+
+    def handle(self, *args, **options):
+        self.ensure_data(options['scale'], options['seed'])
+        rng = random.Random(options['seed'])
+        samples = self.samples(rng, options['scale'], options['repeat'] + 1)
+        results = {}
+        for name, case in self.cases(samples):
+            results[name] = self.measure(case, options['repeat'])
+
+        meta = {
+            'scale': options['scale'], 'seed': options['seed'], 'repeat': options['repeat'],
+            'vendor': connection.vendor,
+        }
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as file:
+                baseline = json.load(file)
+            if baseline['meta'] != meta:
+                self.stderr.write(f"⚠️ Другие условия прогона: {baseline['meta']} != {meta}")
+        regressions = self.report(results, baseline and baseline['results'], options)
+        if options['save']:
+            with open(options['save'], 'w') as file:
+                json.dump({'meta': meta, 'results': results}, file, indent=2, sort_keys=True)
+        if regressions:
+            raise CommandError(f"Регрессии: {', '.join(regressions)}")
+
+    def ensure_data(self, scale, seed):
+        expected = expected_rows(scale)
+        counts = {model: model.objects.count() for model in ROWS}
+        if counts == expected and not TelegramUser.objects.filter(telegram_id__lte=FIRST_CHAT_ID).exists():
+            return
+        refuse_live_database()
+        started = time.monotonic()
+        generate(scale, seed)
+        rows = ', '.join(f"{model.__name__}={count}" for model, count in expected.items())
+        self.stdout.write(f"Данные созданы за {time.monotonic() - started:.1f} s: {rows}")
+
+    def samples(self, rng, scale, count):
+        """Свои id на каждый вызов: повторный запрос той же строки мерил бы кэш БД."""
+        rows = expected_rows(scale)
+
+        def ids(model):
+            return [rng.randint(1, rows[model]) for _ in range(count)]
+
+        users = ids(TelegramUser)
+        cursors = []
+        for user_id in users:
+            page, _ = paid_orders_page(FIRST_CHAT_ID + user_id)
+            cursors.append(page and encode_cursor(page[-1][1], page[-1][0]))
+        return {
+            'model': ids(ModelProfile),
+            'user': users,
+            'order': ids(Order),
+            'telegram_id': [FIRST_CHAT_ID + user_id for user_id in users],
+            'cursor': cursors,
+            'page': [rng.randint(1, max(1, rows[Order] // 20)) for _ in range(count)],
+        }
+
+    def cases(self, samples):
+        """(имя, вызов(i)) для запросов бота и эндпоинтов API."""
+        api = APIRequestFactory()
+        admin = User(username='benchmark', is_staff=True, is_superuser=True)
+
+        def api_call(viewset, action, pk=None, page=None):
+            def call(i):
+                request = api.get('/', {'page': samples['page'][i]} if page else {})
+                force_authenticate(request, user=admin)
+                kwargs = {'pk': samples[pk][i]} if pk else {}
+                viewset.as_view({'get': action})(request, **kwargs).render()
+            return call
+
+        telegram_id = samples['telegram_id']
+        return [
+            ('bot.upsert_user', lambda i: upsert_user(telegram_id[i], f'user{telegram_id[i] - FIRST_CHAT_ID}')),
+            ('bot.catalog_projection', lambda i: build_projection()),
+            ('bot.media_manifest', lambda i: build_manifest(samples['model'][i])),
+            ('bot.paid_orders_first_page', lambda i: paid_orders_page(telegram_id[i])),
+            ('bot.paid_orders_next_page', lambda i: paid_orders_page(telegram_id[i], samples['cursor'][i])),
+            ('bot.paid_orders_count', lambda i: paid_orders(telegram_id[i]).count()),
+            ('bot.get_order_details', lambda i: repository.get_order_details.func(samples['order'][i])),
+            ('bot.get_full_order_data', lambda i: repository.get_full_order_data.func(samples['order'][i])),
+            ('api.users.list', api_call(views.TelegramUserViewSet, 'list')),
+            ('api.users.retrieve', api_call(views.TelegramUserViewSet, 'retrieve', pk='user')),
+            ('api.models.list', api_call(views.ModelProfileViewSet, 'list')),
+            ('api.models.retrieve', api_call(views.ModelProfileViewSet, 'retrieve', pk='model')),
+            ('api.model_photos.list', api_call(views.ModelPhotoViewSet, 'list')),
+            ('api.orders.list', api_call(views.OrderViewSet, 'list')),
+            ('api.orders.list_deep_page', api_call(views.OrderViewSet, 'list', page=True)),
+            ('api.orders.retrieve', api_call(views.OrderViewSet, 'retrieve', pk='order')),
+        ]
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def measure(self, case, repeat):
+        """Медиана и p95 времени вызова, число SQL-запросов одного вызова."""
+        with CaptureQueriesContext(connection) as queries:
+            case(0)  # Прогрев: кэш страниц БД и импорт сериализаторов
+        timings = []
+        for i in range(1, repeat + 1):
+            started = time.perf_counter()
+            case(i)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        return {
+            'median_ms': round(statistics.median(timings), 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+            'queries': len(queries),
+        }
+
+    def report(self, results, baseline, options):
+        regressions = []
+        for name, result in results.items():
+            line = f"{name:28} {result['median_ms']:9.2f}ms p95={result['p95_ms']:.2f}ms queries={result['queries']}"
+            base = (baseline or {}).get(name)
+            if base:
+                delta = result['median_ms'] - base['median_ms']
+                slower = (delta > options['min_delta_ms']
+                          and result['median_ms'] > base['median_ms'] * (1 + options['tolerance']))
+                more_queries = result['queries'] > base['queries']
+                line += f"  base={base['median_ms']:.2f}ms ({delta:+.2f}ms) queries {base['queries']}->{result['queries']}"
+                if slower or more_queries:
+                    regressions.append(name)
+                    line = self.style.ERROR(f"{line}  ❌")
+            self.stdout.write(line)
+        return regressions
@@ -0,0 +1,119 @@
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from stefbot.fakebotapi import FakeBotAPI, command_update
+from stefbot.models import QueuedUpdate, TelegramUser
+from stefbot.ratelimit import SharedRateLimiter
+from stefbot.sharding import enqueue_updates
+from . import run_bot_worker
+from .run_bot_worker import READY_KEY
+
+FIRST_CHAT_ID = 9_000_000_000  # Чаты бенчмарка не пересекаются с настоящими
+START_TIMEOUT = 60
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный тест шардов: прогоняет одну и ту же пачку апдейтов через "
+        "1..N процессов run_bot_worker на фейковом Bot API и печатает пропускную способность."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--updates', type=int, default=400, help="Апдейтов на прогон")
+        parser.add_argument('--users', type=int, default=200, help="Сколько разных пользователей")
+        parser.add_argument('--max-workers', type=int, default=4)
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help="Апдейтов в работе на воркер: емкость одного процесса")
+        # При малой задержке воркеры упираются в CPU, и рост зависит от числа ядер
+        parser.add_argument('--rtt', type=float, default=0.2, help="Задержка фейкового Bot API, с")
+        # Служебные: так бенчмарк запускает воркеры шардов на фейковом Bot API.
+        # В run_bot_worker фейка нет, и настоящий воркер на него не переключить.
+        parser.add_argument('--worker-shard', type=int, default=None, help=argparse.SUPPRESS)
+        parser.add_argument('--worker-shards', type=int, default=None, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker_shard'] is not None:
+            return self.run_worker(options)
+        if QueuedUpdate.objects.exists():
+            # Воркеры бенчмарка разобрали бы и настоящие апдейты, ответив в фейковый Bot API
+            raise CommandError(
+                "В очереди апдейтов есть необработанные апдейты. Остановите ingress и дождитесь "
+                "воркеров или укажите отдельную базу: SQLITE_PATH=cache/benchmark.sqlite3"
+            )
+        chat_ids = [FIRST_CHAT_ID + i for i in range(options['users'])]
+        TelegramUser.objects.bulk_create(
+            [TelegramUser(telegram_id=chat_id) for chat_id in chat_ids], ignore_conflicts=True,
+        )
+        update_ids = []
+        baseline = None
+        try:
+            for workers in range(1, options['max_workers'] + 1):
+                payloads = [
+                    command_update(workers * 10 ** 6 + i, chat_ids[i % len(chat_ids)])
+                    for i in range(options['updates'])
+                ]
+                update_ids.extend(payload['update_id'] for payload in payloads)
+                throughput = self.run(workers, payloads, options)
+                baseline = baseline or throughput
+                self.stdout.write(
+                    f"workers={workers} throughput={throughput:.0f} updates/s speedup={throughput / baseline:.2f}x"
+                )
+        finally:
+            QueuedUpdate.objects.filter(update_id__in=update_ids).delete()
+            TelegramUser.objects.filter(telegram_id__in=chat_ids).delete()
+
+    def run(self, workers, payloads, options):
+        for shard in range(workers):
+            cache.delete(READY_KEY.format(shard=shard))
+        processes = [
+            subprocess.Popen(
+                [
+                    sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'), 'benchmark_shards',
+                    '--worker-shard', str(shard), '--worker-shards', str(workers),
+                    '--concurrency', str(options['concurrency']), '--rtt', str(options['rtt']),
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+            for shard in range(workers)
+        ]
+        try:
+            self.wait_ready(workers)
+            started = time.monotonic()
+            enqueue_updates(payloads, workers)
+            update_ids = [payload['update_id'] for payload in payloads]
+            while QueuedUpdate.objects.filter(update_id__in=update_ids).exists():
+                time.sleep(0.05)
+            return len(payloads) / (time.monotonic() - started)
+        finally:
+            for process in processes:
+                process.send_signal(signal.SIGTERM)
+            for process in processes:
+                process.wait()
+
+    def wait_ready(self, workers):
+        deadline = time.monotonic() + START_TIMEOUT
+        keys = [READY_KEY.format(shard=shard) for shard in range(workers)]
+        while len(cache.get_many(keys)) < workers:
+            if time.monotonic() > deadline:
+                raise CommandError("Workers did not start in time")
+            time.sleep(0.1)
+
+    def run_worker(self, options):
+        """Воркер шарда из run_bot_worker, но с фейковым Bot API и без общего лимита."""
+        worker = run_bot_worker.Command(stdout=self.stdout, stderr=self.stderr)
+        worker_options = {
+            'shard': options['worker_shard'], 'shards': options['worker_shards'],
+            'concurrency': options['concurrency'],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            limiter = SharedRateLimiter(os.path.join(tmp, 'buckets.sqlite3'), global_limit=(10 ** 6, 1))
+            asyncio.run(worker.run(worker_options, request=FakeBotAPI(options['rtt']), limiter=limiter))
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import statistics
+import tempfile
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, override_settings
+from django.urls import reverse
+
+from stefbot import webhook
+from stefbot.fakebotapi import FakeBotAPI, command_update
+from stefbot.models import TelegramUser
+from stefbot.ratelimit import SharedRateLimiter
+from stefbot.updates import build_application
+
+FIRST_CHAT_ID = 9_000_000_000  # Чаты бенчмарка не пересекаются с настоящими
+WEBHOOK_SECRET = 'benchmark'
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает задержку от апдейта до ответа бота в режимах polling и "
+        "webhook на локальном фейковом Bot API с заданной задержкой сети."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--updates', type=int, default=200, help="Сколько апдейтов отправить")
+        parser.add_argument('--rate', type=float, default=20, help="Апдейтов в секунду")
+        parser.add_argument('--rtt', type=float, default=0.05, help="Задержка сети туда и обратно, с")
+        parser.add_argument('--mode', choices=['polling', 'webhook'], action='append',
+                            help="Какие режимы мерить (по умолчанию оба)")
+
+    def handle(self, *args, **options):
+        for mode in options['mode'] or ['polling', 'webhook']:
+            with tempfile.TemporaryDirectory() as tmp:
+                limiter = SharedRateLimiter(f'{tmp}/buckets.sqlite3')
+                latencies, elapsed = asyncio.run(self.run(mode, limiter, options))
+            self.report(mode, latencies, elapsed)
+        chat_ids = range(FIRST_CHAT_ID, FIRST_CHAT_ID + options['updates'])
+        TelegramUser.objects.filter(telegram_id__in=chat_ids).delete()
+
+    async def run(self, mode, limiter, options):
+        api = FakeBotAPI(options['rtt'])
+        application = build_application(webhook=mode == 'webhook', request=api, limiter=limiter)
+        await application.initialize()
+        if mode == 'polling':
+            await application.updater.start_polling(poll_interval=0, timeout=10)
+        await application.start()
+        webhook._application = application
+        client = AsyncClient()
+
+        async def deliver(i):
+            await asyncio.sleep(i / options['rate'])
+            chat_id = FIRST_CHAT_ID + i
+            reply = api.expect_reply(chat_id)
+            started = time.monotonic()
+            update = command_update(i + 1, chat_id)
+            if mode == 'polling':
+                api.push_update(update)
+            else:
+                await asyncio.sleep(options['rtt'] / 2)  # Telegram -> наш сервер
+                response = await client.post(reverse('telegram_webhook'), json.dumps(update),
+                                             content_type='application/json',
+                                             headers={webhook.SECRET_HEADER: WEBHOOK_SECRET})
+                if response.status_code != 200:
+                    raise CommandError(f"Webhook answered {response.status_code}")
+            return await reply - started
+
+        try:
+            started = time.monotonic()
+            with override_settings(ALLOWED_HOSTS=['testserver'], TELEGRAM_WEBHOOK_SECRET=WEBHOOK_SECRET):
+                latencies = await asyncio.gather(*(deliver(i) for i in range(options['updates'])))
+            return latencies, time.monotonic() - started
+        finally:
+            if application.updater:
+                await application.updater.stop()
+            await webhook.shutdown_application()
+
+    def report(self, mode, latencies, elapsed):
+        ms = sorted(latency * 1000 for latency in latencies)
+        p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+        self.stdout.write(
+            f"{mode:8} updates={len(ms)} p50={statistics.median(ms):.1f}ms "
+            f"p95={p95:.1f}ms max={ms[-1]:.1f}ms throughput={len(ms) / elapsed:.1f}/s"
+        )
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from stefbot.images import DERIVATIVE_FIELDS, build_derivatives
+
+
+class Command(BaseCommand):
+    help = (
+        "Строит копии для Telegram и миниатюры для фото, загруженных до "
+        "появления фонового конвейера, и печатает, сколько байт экономит отправка."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help="Перестроить и уже готовые копии")
+
+    def handle(self, *args, **options):
+        for model, (source_field, telegram_field, _) in DERIVATIVE_FIELDS.items():
+            rows = model.objects.exclude(**{source_field: ''})
+            if not options['rebuild']:
+                rows = rows.filter(**{telegram_field: ''})
+            built = failed = source_bytes = upload_bytes = 0
+            for pk in rows.values_list('pk', flat=True).iterator():
+                try:
+                    if not build_derivatives(model, pk):
+                        continue
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"❌ {model.__name__} {pk}: {e}")
+                    continue
+                instance = model.objects.get(pk=pk)
+                built += 1
+                source_bytes += getattr(instance, source_field).size
+                upload_bytes += getattr(instance, telegram_field).size
+            self.stdout.write(
+                f"{model.__name__}: built={built} failed={failed} "
+                f"{source_bytes / 2 ** 20:.1f} MB -> {upload_bytes / 2 ** 20:.1f} MB"
+            )
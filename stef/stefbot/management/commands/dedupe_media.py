@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from stefbot.catalog import invalidate_catalog
+from stefbot.manifest import invalidate_manifest
+from stefbot.models import ModelProfile
+from stefbot.storage import BLOB_DIR, MEDIA_FIELDS, blob_name, content_key, file_digest, media_storage, release
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит медиа из путей upload_to в хранилище по хэшу содержимого: "
+        "одинаковые файлы остаются на диске в одном экземпляре."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Только посчитать экономию")
+
+    def handle(self, *args, **options):
+        moved = {}  # Старое имя -> имя блоба
+        updates = []  # (модель, поле, старое имя): строки переписываются одной транзакцией
+        before = after = missing = 0
+        for label, fields in MEDIA_FIELDS.items():
+            model = apps.get_model(label)
+            for field in fields:
+                names = list(model.objects.exclude(**{field: ''}).values_list(field, flat=True).distinct())
+                for name in names:
+                    if content_key(name):
+                        continue
+                    if name not in moved:
+                        try:
+                            blob, size = self.copy(name, options['dry_run'])
+                        except FileNotFoundError:
+                            missing += 1
+                            self.stderr.write(f"❌ Нет файла {name}")
+                            continue
+                        before += size
+                        if blob not in moved.values():
+                            after += size
+                        moved[name] = blob
+                    updates.append((model, field, name))
+
+        if updates and not options['dry_run']:
+            # Старые файлы удаляются только после коммита: до него строки еще ссылаются на них
+            with transaction.atomic():
+                for model, field, name in updates:
+                    model.objects.filter(**{field: name}).update(**{field: moved[name]})
+                transaction.on_commit(lambda: self.cleanup(moved))
+        self.stdout.write(
+            f"files={len(moved)} blobs={len(set(moved.values()))} missing={missing} "
+            f"{before / 2 ** 20:.1f} MB -> {after / 2 ** 20:.1f} MB"
+        )
+
+    def copy(self, name, dry_run):
+        """Копирует файл под имя блоба, если такого блоба еще нет. Исходный файл остается.
+
+        Возвращает (имя блоба, размер файла).
+        """
+        path = media_storage.path(name)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as file:
+            blob = blob_name(file_digest(file), os.path.splitext(name)[1])
+        blob_path = media_storage.path(blob)
+        if not dry_run and not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # Копия во временный файл и rename: недописанный блоб не появится под своим именем
+            fd, tmp_path = tempfile.mkstemp(dir=media_storage.path(BLOB_DIR), prefix='.dedupe-')
+            os.close(fd)
+            try:
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, blob_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return blob, size
+
+    def cleanup(self, moved):
+        """После коммита: удаляет старые файлы и сбрасывает устаревшие пути в кэшах."""
+        release(*moved)
+        invalidate_catalog()
+        for model_id in ModelProfile.objects.values_list('id', flat=True):
+            invalidate_manifest(model_id)
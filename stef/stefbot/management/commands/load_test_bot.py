@@ -0,0 +1,189 @@
+import asyncio
+import contextlib
+import io
+import logging
+import random
+import statistics
+import tempfile
+import time
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from PIL import Image
+from telegram.request import HTTPXRequest
+
+from stefbot.catalog import invalidate_catalog
+from stefbot.fakebotapi import FakeBotAPI, FakeBotAPIServer, callback_update, command_update
+from stefbot.images import build_derivatives
+from stefbot.manifest import invalidate_manifest
+from stefbot.models import ModelPhoto, ModelProfile, Order, TelegramUser
+from stefbot.ratelimit import SharedRateLimiter
+from stefbot.updates import build_application
+
+FIRST_CHAT_ID = 9_000_000_000  # Чаты бенчмарка не пересекаются с настоящими
+NO_LIMIT = (10 ** 6, 1)  # Лимиты Telegram не мерим: бакеты подняты до потолка
+
+# Сценарий -> нажатия пользователя; {model} и {order} подставляются из засеянных данных
+SCENARIOS = {
+    'menu': ['/start', 'models', 'model_{model}', 'back_to_main'],
+    'purchase': ['/start', 'models', 'model_{model}', 'buy_{model}'],
+    'orders': ['/start', 'orders', 'order_{order}'],
+}
+# Доля сценариев в смешанном трафике
+MIX = {'menu': 0.6, 'purchase': 0.25, 'orders': 0.15}
+
+
+def sample_jpeg(seed, size):
+    """Фото "с камеры": шум не сжимается, поэтому размер файла похож на настоящий."""
+    noise = Image.effect_noise(size, 48).convert('RGB')
+    tint = Image.new('RGB', size, (seed * 37 % 256, seed * 91 % 256, seed * 53 % 256))
+    buffer = io.BytesIO()
+    Image.blend(noise, tint, 0.5).save(buffer, 'JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def percentile(ms, q):
+    return ms[min(len(ms) - 1, int(len(ms) * q))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Нагрузочный тест бота целиком: виртуальные пользователи проходят сценарии "
+        "(меню, покупка, просмотр заказа) через локальный HTTP Bot API с задержкой, "
+        "429 и таймаутами. Печатает пропускную способность, p50/p95/p99 и объем загрузок."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help="Виртуальных пользователей")
+        parser.add_argument('--iterations', type=int, default=4, help="Сценариев на пользователя")
+        parser.add_argument('--scenario', choices=[*SCENARIOS, 'mix'], action='append',
+                            help="Какие сценарии гонять (по умолчанию все и смешанный)")
+        parser.add_argument('--photos', type=int, default=12, help="Фото у тестовой модели")
+        parser.add_argument('--rtt', type=float, default=0.05, help="Задержка сети туда и обратно, с")
+        parser.add_argument('--retry-after-rate', type=float, default=0.0, help="Доля ответов 429")
+        parser.add_argument('--timeout-rate', type=float, default=0.0, help="Доля зависших запросов")
+        parser.add_argument('--read-timeout', type=float, default=5.0, help="Таймаут чтения клиента бота, с")
+        parser.add_argument('--concurrency', type=int, default=32, help="Апдейтов в работе одновременно")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        chat_ids = [FIRST_CHAT_ID + i for i in range(options['users'])]
+        with tempfile.TemporaryDirectory() as tmp, override_settings(MEDIA_ROOT=tmp):
+            model = self.seed(chat_ids, options['photos'])
+            try:
+                for n, scenario in enumerate(options['scenario'] or [*SCENARIOS, 'mix']):
+                    self.reset_file_ids(model)  # Каждый прогон начинается с холодными file_id
+                    limiter = SharedRateLimiter(f'{tmp}/buckets-{n}.sqlite3', global_limit=NO_LIMIT,
+                                                chat_limit=NO_LIMIT, group_limit=NO_LIMIT)
+                    with self.quiet_logs(options['verbosity']):
+                        result = asyncio.run(self.run(limiter, scenario, model, chat_ids, options))
+                    self.report(scenario, *result)
+            finally:
+                TelegramUser.objects.filter(telegram_id__in=chat_ids).delete()
+                model.delete()
+
+    def seed(self, chat_ids, photos):
+        """Модель с превью и фото, пользователи и по одному оплаченному заказу у каждого.
+
+        bulk_create не шлет сигналов: копии для Telegram строятся здесь же, а не в
+        фоновом пуле посреди замера, и оплата не ставит заказы в outbox доставки.
+        """
+        [model] = ModelProfile.objects.bulk_create([ModelProfile(
+            name='Load test', description='Нагрузочный тест', price=1000,
+            preview_photo=ContentFile(sample_jpeg(0, (1600, 1200)), 'preview.jpg'),
+        )])
+        build_derivatives(ModelProfile, model.pk)
+        for photo in ModelPhoto.objects.bulk_create([
+            ModelPhoto(model=model, photo=ContentFile(sample_jpeg(i, (2000, 1500)), f'{i}.jpg'))
+            for i in range(1, photos + 1)
+        ]):
+            build_derivatives(ModelPhoto, photo.pk)
+        users = TelegramUser.objects.bulk_create(
+            [TelegramUser(telegram_id=chat_id, username=f'user{chat_id}') for chat_id in chat_ids]
+        )
+        orders = Order.objects.bulk_create(
+            [Order(user=user, model=model, amount=model.price, status='paid') for user in users]
+        )
+        model.orders = {user.telegram_id: order.pk for user, order in zip(users, orders)}
+        return model
+
+    def reset_file_ids(self, model):
+        ModelProfile.objects.filter(pk=model.pk).update(preview_file_id='', preview_file_unique_id='')
+        ModelPhoto.objects.filter(model=model).update(telegram_file_id='', telegram_file_unique_id='')
+        invalidate_catalog()
+        invalidate_manifest(model.pk)
+
+    async def run(self, limiter, scenario, model, chat_ids, options):
+        api = FakeBotAPI(options['rtt'], options['retry_after_rate'], options['timeout_rate'], seed=options['seed'])
+        api.timeout_delay = options['read_timeout'] + 0.5  # Клиент бота сдается первым
+        pick = random.Random(options['seed'])
+        update_ids = iter(range(1, 10 ** 9))
+        done = {}
+
+        async with FakeBotAPIServer(api) as server:
+            request = HTTPXRequest(
+                connection_pool_size=options['concurrency'] + 1,  # + соединение getUpdates
+                read_timeout=options['read_timeout'], pool_timeout=options['read_timeout'],
+            )
+            application = build_application(request=request, limiter=limiter,
+                                            concurrency=options['concurrency'], base_url=server.base_url)
+            process_update = application.process_update
+
+            async def timed(update):
+                try:
+                    await process_update(update)
+                finally:
+                    future = done.pop(update.update_id, None)
+                    if future is not None:
+                        future.set_result(time.monotonic())
+
+            application.process_update = timed  # Конец обработки, а не первый ответ
+            await application.initialize()
+            await application.updater.start_polling(poll_interval=0, timeout=10)
+            await application.start()
+
+            async def user(chat_id):
+                latencies = []
+                for _ in range(options['iterations']):
+                    name = scenario if scenario != 'mix' else pick.choices(list(MIX), list(MIX.values()))[0]
+                    for step in SCENARIOS[name]:
+                        data = step.format(model=model.pk, order=model.orders[chat_id])
+                        update_id = next(update_ids)
+                        future = done[update_id] = asyncio.get_running_loop().create_future()
+                        started = time.monotonic()
+                        if data.startswith('/'):
+                            api.push_update(command_update(update_id, chat_id, data))
+                        else:
+                            api.push_update(callback_update(update_id, chat_id, data))
+                        latencies.append(await future - started)
+                return latencies
+
+            try:
+                started = time.monotonic()
+                latencies = await asyncio.gather(*(user(chat_id) for chat_id in chat_ids))
+                elapsed = time.monotonic() - started
+            finally:
+                await application.updater.stop()
+                await application.stop()
+                await application.shutdown()
+        return [latency for user_latencies in latencies for latency in user_latencies], elapsed, api
+
+    def report(self, scenario, latencies, elapsed, api):
+        ms = sorted(latency * 1000 for latency in latencies)
+        self.stdout.write(
+            f"{scenario:8} updates={len(ms)} throughput={len(ms) / elapsed:.1f}/s "
+            f"p50={statistics.median(ms):.1f}ms p95={percentile(ms, 0.95):.1f}ms "
+            f"p99={percentile(ms, 0.99):.1f}ms uploaded={api.uploaded / 2 ** 20:.2f}MB "
+            f"api_calls={sum(api.calls.values())} retry_after={api.faults['retry_after']} "
+            f"timeouts={api.faults['timeout']}"
+        )
+
+    @contextlib.contextmanager
+    def quiet_logs(self, verbosity):
+        """Ошибки внедренных таймаутов засыпали бы вывод трейсбеками."""
+        if verbosity < 2:
+            logging.disable(logging.ERROR)
+        try:
+            yield
+        finally:
+            logging.disable(logging.NOTSET)
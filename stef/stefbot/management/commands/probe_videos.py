@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from stefbot.manifest import invalidate_manifest
+from stefbot.models import ModelVideo
+from stefbot.video import probe_video
+
+FIELDS = ('duration', 'width', 'height', 'file_size', 'faststart', 'send_problem')
+
+
+class Command(BaseCommand):
+    help = (
+        "Читает метаданные MP4 (длительность, размеры, faststart) для видео, "
+        "загруженных до появления проверки, и печатает те, что нельзя отправить."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Перечитать и уже проверенные видео")
+
+    def handle(self, *args, **options):
+        videos = ModelVideo.objects.exclude(video='')
+        if not options['all']:
+            videos = videos.filter(file_size__isnull=True)
+        checked = 0
+        for video in videos.iterator():
+            probe_video(video)
+            # update() без сигналов: повторная проверка в pre_save не нужна
+            ModelVideo.objects.filter(pk=video.pk).update(**{field: getattr(video, field) for field in FIELDS})
+            invalidate_manifest(video.model_id)
+            checked += 1
+            if video.send_problem:
+                self.stdout.write(f"❌ {video.video.name}: {video.send_problem}")
+            elif not video.faststart:
+                self.stdout.write(f"⚠️ {video.video.name}: moov в конце файла, просмотр только после загрузки")
+        self.stdout.write(f"Проверено видео: {checked}")
@@ -0,0 +1,46 @@
+import asyncio
+import signal
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from stefbot.sharding import enqueue_updates
+from stefbot.utils import bot
+
+POLL_TIMEOUT = 30  # Long polling getUpdates, секунд
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingress шардированного бота: забирает апдейты через getUpdates и "
+        "раскладывает их по очередям шардов (BOT_SHARDS) для run_bot_worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, default=settings.BOT_SHARDS, help="Число шардов")
+
+    def handle(self, *args, **options):
+        if options['shards'] < 1:
+            raise CommandError("Set BOT_SHARDS or pass --shards")
+        self.stdout.write(f"📥 Ingress запущен, шардов: {options['shards']}")
+        asyncio.run(self.run(options['shards']))
+
+    async def run(self, shards):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:  # Windows
+                pass
+
+        async with bot:
+            await bot.delete_webhook()  # getUpdates не работает при активном webhook
+            offset = None
+            while not stop.is_set():
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+                if not updates:
+                    continue
+                # offset сдвигается только после записи: упавший ingress ничего не теряет
+                await sync_to_async(enqueue_updates)([update.to_dict() for update in updates], shards)
+                offset = updates[-1].update_id + 1
@@ -0,0 +1,52 @@
+import asyncio
+import os
+import signal
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from stefbot.metrics import start_metrics_server
+from stefbot.sharding import run_shard_worker
+from stefbot.updates import UPDATE_CONCURRENCY, build_application
+
+READY_KEY = 'bot_worker_ready:{shard}'
+
+
+class Command(BaseCommand):
+    help = (
+        "Воркер шарда бота: обрабатывает апдейты пользователей своего шарда из "
+        "очереди, которую наполняет run_bot_ingress или webhook."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, required=True, help="Номер шарда, с 0")
+        parser.add_argument('--shards', type=int, default=settings.BOT_SHARDS, help="Число шардов")
+        parser.add_argument('--concurrency', type=int, default=UPDATE_CONCURRENCY,
+                            help="Сколько апдейтов обрабатывать одновременно")
+        parser.add_argument('--metrics-port', type=int, default=settings.METRICS_PORT,
+                            help="Порт HTTP с метриками Prometheus (0 - не запускать)")
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shard'] < options['shards']:
+            raise CommandError("--shard must be in [0, shards)")
+        if options['metrics_port']:
+            start_metrics_server(options['metrics_port'])
+        asyncio.run(self.run(options))
+
+    async def run(self, options, **application_kwargs):
+        """Цикл воркера; ``application_kwargs`` уходят в build_application (бенчмарк подменяет Bot API)."""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:  # Windows
+                pass
+
+        application = build_application(webhook=True, concurrency=options['concurrency'], **application_kwargs)
+        async with application:
+            await application.start()
+            cache.set(READY_KEY.format(shard=options['shard']), os.getpid(), 60)
+            self.stdout.write(f"🤖 Воркер шарда {options['shard']}/{options['shards']} запущен")
+            await run_shard_worker(application, options['shard'], stop)
+            await application.stop()
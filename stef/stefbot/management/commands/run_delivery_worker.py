@@ -0,0 +1,54 @@
+import asyncio
+import os
+import signal
+import socket
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from stefbot.dispatcher import CLAIM_BATCH_SIZE, DELIVERY_CONCURRENCY, run_worker
+from stefbot.loopmonitor import start_loop_monitor
+from stefbot.metrics import start_metrics_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Воркер доставки оплаченных заказов: забирает строки outbox пачками и "
+        "отправляет их параллельно. Пропускная способность растет с числом воркеров."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=CLAIM_BATCH_SIZE,
+                            help="Сколько доставок забирать за раз")
+        parser.add_argument('--concurrency', type=int, default=DELIVERY_CONCURRENCY,
+                            help="Сколько доставок отправлять одновременно")
+        parser.add_argument('--once', action='store_true', help="Выйти, когда очередь опустеет")
+        parser.add_argument('--metrics-port', type=int, default=settings.METRICS_PORT,
+                            help="Порт HTTP с метриками Prometheus (0 - не запускать)")
+
+    def handle(self, *args, **options):
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stdout.write(f"🚚 Воркер доставки {worker_id} запущен")
+        if options['metrics_port']:
+            start_metrics_server(options['metrics_port'])
+        asyncio.run(self.run(worker_id, options))
+
+    async def run(self, worker_id, options):
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:  # Windows
+                pass
+        monitor = start_loop_monitor()
+        try:
+            await run_worker(
+                worker_id,
+                batch_size=options['batch_size'],
+                concurrency=options['concurrency'],
+                once=options['once'],
+                stop=stop,
+            )
+        finally:
+            if monitor is not None:
+                await monitor.stop()
@@ -0,0 +1,32 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from stefbot.utils import bot
+
+
+class Command(BaseCommand):
+    help = (
+        "Регистрирует webhook бота в Telegram (TELEGRAM_WEBHOOK_URL и "
+        "TELEGRAM_WEBHOOK_SECRET) или удаляет его для возврата к polling."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help="Удалить webhook")
+        parser.add_argument('--max-connections', type=int, default=40,
+                            help="Сколько апдейтов Telegram шлет параллельно")
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            asyncio.run(bot.delete_webhook())
+            self.stdout.write(self.style.SUCCESS("✅ Webhook удален"))
+            return
+
+        if not settings.TELEGRAM_WEBHOOK_URL or not settings.TELEGRAM_WEBHOOK_SECRET:
+            raise CommandError("TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET must be set")
+        asyncio.run(bot.set_webhook(
+            url=settings.TELEGRAM_WEBHOOK_URL,
+            secret_token=settings.TELEGRAM_WEBHOOK_SECRET,
+            max_connections=options['max_connections'],
+        ))
+        self.stdout.write(self.style.SUCCESS(f"✅ Webhook: {settings.TELEGRAM_WEBHOOK_URL}"))
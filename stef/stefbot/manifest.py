@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .models import ModelPhoto, ModelVideo
+from .video import TELEGRAM_VIDEO_LIMIT
+
+logger = logging.getLogger(__name__)
+
+ALBUM_SIZE = 10  # Лимит Telegram на количество элементов в альбоме
+
+# Манифесты живут в памяти процесса. Версия хранится в общем кэше Django,
+# поэтому изменение в админке (другой процесс) сбрасывает манифест и у бота.
+_manifests = {}
+_lock = threading.Lock()
+
+
+def _version_key(model_id):
+    return f'media_manifest:{model_id}'
+
+
+def _media_item(kind, pk, name, file_id, upload_name=''):
+    # name - оригинал (по нему сверяется замена файла), отправляется копия, если есть
+    path = os.path.join(settings.MEDIA_ROOT, upload_name or name)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        # С сохраненным file_id локальный файл уже не нужен
+        if not file_id:
+            logger.warning(f"❌ Файл {path} не найден!")
+            return None
+        size = 0
+    return {'kind': kind, 'pk': pk, 'name': name, 'path': path, 'size': size, 'file_id': file_id}
+
+
+def _albums(items):
+    return [items[i:i + ALBUM_SIZE] for i in range(0, len(items), ALBUM_SIZE)]
+
+
+def build_manifest(model_id, version=None):
+    """Собирает манифест медиа модели: фото, затем видео, по порядку id."""
+    photos = []
+    rows = ModelPhoto.objects.filter(model_id=model_id).order_by('id')
+    for pk, name, file_id, upload_name in rows.values_list('id', 'photo', 'telegram_file_id', 'telegram_photo'):
+        if name:
+            photos.append(_media_item('photo', pk, name, file_id, upload_name))
+    videos = []
+    rows = ModelVideo.objects.filter(model_id=model_id).order_by('id').values(
+        'id', 'video', 'telegram_file_id', 'file_size', 'duration', 'width', 'height', 'faststart'
+    )
+    for row in rows:
+        if not row['video']:
+            continue
+        if not row['telegram_file_id'] and (row['file_size'] or 0) > TELEGRAM_VIDEO_LIMIT:
+            # Telegram отклонил бы весь альбом; видео отмечено в админке
+            logger.warning(f"❌ Видео {row['video']} больше лимита Telegram, пропускаем")
+            continue
+        item = _media_item('video', row['id'], row['video'], row['telegram_file_id'])
+        if item:
+            item.update(
+                duration=row['duration'], width=row['width'], height=row['height'],
+                supports_streaming=bool(row['faststart']),
+            )
+        videos.append(item)
+
+    photos = [item for item in photos if item]
+    items = photos + [item for item in videos if item]
+    return {
+        'model_id': model_id,
+        'version': version,
+        'items': items,
+        'albums': _albums(items),
+        'photo_albums': _albums(photos),
+        'total_size': sum(item['size'] for item in items),
+    }
+
+
+def get_manifest(model_id):
+    """Возвращает манифест из памяти; в БД и на диск идет только после сброса."""
+    version = cache.get(_version_key(model_id))
+    manifest = _manifests.get(model_id)
+    if manifest is None or manifest['version'] != version:
+        manifest = build_manifest(model_id, version)
+        with _lock:
+            _manifests[model_id] = manifest
+    return manifest
+
+
+def invalidate_manifest(model_id):
+    """Сбрасывает манифест модели во всех процессах."""
+    with _lock:
+        _manifests.pop(model_id, None)
+    cache.set(_version_key(model_id), uuid.uuid4().hex, None)
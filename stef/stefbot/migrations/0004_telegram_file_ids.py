@@ -0,0 +1,43 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0003_modelvideo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelphoto',
+            name='telegram_file_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='modelphoto',
+            name='telegram_file_unique_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='modelprofile',
+            name='preview_file_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='modelprofile',
+            name='preview_file_unique_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='modelvideo',
+            name='telegram_file_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='modelvideo',
+            name='telegram_file_unique_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
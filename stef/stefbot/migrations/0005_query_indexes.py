@@ -0,0 +1,33 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0004_telegram_file_ids'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='modelphoto',
+            index=models.Index(fields=['model', 'id'], name='modelphoto_model_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='modelvideo',
+            index=models.Index(fields=['model', 'id'], name='modelvideo_model_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'status', 'created_at', 'id'], name='order_user_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='order_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at', 'id'], name='order_created_idx'),
+        ),
+    ]
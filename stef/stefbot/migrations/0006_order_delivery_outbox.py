@@ -0,0 +1,34 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0005_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('processing', 'Отправляется'), ('sent', 'Доставлено'), ('failed', 'Ошибка')], default='pending', max_length=20)),
+                ('batch_id', models.CharField(blank=True, db_index=True, default='', max_length=32)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_by', models.CharField(blank=True, default='', max_length=64)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='delivery', to='stefbot.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'available_at'], name='delivery_status_available_idx')],
+            },
+        ),
+    ]
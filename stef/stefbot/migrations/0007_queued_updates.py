@@ -0,0 +1,26 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0006_order_delivery_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('update_id', models.BigIntegerField(unique=True)),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['shard', 'id'], name='queuedupdate_shard_id_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0007_queued_updates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelphoto',
+            name='telegram_photo',
+            field=models.ImageField(blank=True, editable=False, upload_to='model_photos/telegram/'),
+        ),
+        migrations.AddField(
+            model_name='modelphoto',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to='model_photos/thumbs/'),
+        ),
+        migrations.AddField(
+            model_name='modelprofile',
+            name='preview_telegram',
+            field=models.ImageField(blank=True, editable=False, upload_to='model_previews/telegram/'),
+        ),
+        migrations.AddField(
+            model_name='modelprofile',
+            name='preview_thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to='model_previews/thumbs/'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.16 on 2026-10-18 15:52
+
+from django.db import migrations, models
+import stefbot.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0009_video_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='modelphoto',
+            name='photo',
+            field=models.ImageField(storage=stefbot.storage.ContentAddressedStorage(), upload_to='model_photos/'),
+        ),
+        migrations.AlterField(
+            model_name='modelphoto',
+            name='telegram_photo',
+            field=models.ImageField(blank=True, editable=False, storage=stefbot.storage.ContentAddressedStorage(), upload_to='model_photos/telegram/'),
+        ),
+        migrations.AlterField(
+            model_name='modelphoto',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, storage=stefbot.storage.ContentAddressedStorage(), upload_to='model_photos/thumbs/'),
+        ),
+        migrations.AlterField(
+            model_name='modelprofile',
+            name='preview_photo',
+            field=models.ImageField(storage=stefbot.storage.ContentAddressedStorage(), upload_to='model_previews/'),
+        ),
+        migrations.AlterField(
+            model_name='modelprofile',
+            name='preview_telegram',
+            field=models.ImageField(blank=True, editable=False, storage=stefbot.storage.ContentAddressedStorage(), upload_to='model_previews/telegram/'),
+        ),
+        migrations.AlterField(
+            model_name='modelprofile',
+            name='preview_thumbnail',
+            field=models.ImageField(blank=True, editable=False, storage=stefbot.storage.ContentAddressedStorage(), upload_to='model_previews/thumbs/'),
+        ),
+        migrations.AlterField(
+            model_name='modelvideo',
+            name='video',
+            field=models.FileField(storage=stefbot.storage.ContentAddressedStorage(), upload_to='model_videos/'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0010_content_addressed_media'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderdelivery',
+            name='traceparent',
+            field=models.CharField(blank=True, default='', max_length=55),
+        ),
+    ]
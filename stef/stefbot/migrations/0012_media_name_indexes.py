@@ -0,0 +1,21 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0011_delivery_traceparent'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='modelphoto',
+            index=models.Index(fields=['photo'], name='modelphoto_photo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='modelvideo',
+            index=models.Index(fields=['video'], name='modelvideo_video_idx'),
+        ),
+    ]
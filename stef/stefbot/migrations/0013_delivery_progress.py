@@ -0,0 +1,23 @@
+# Generated by Django 4.2.16 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stefbot', '0012_media_name_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderdelivery',
+            name='albums_sent',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='orderdelivery',
+            name='confirmation_sent',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,4 +1,7 @@
 from django.db import models
+from django.utils import timezone
+from .sqlite import atomic_write
+from .storage import media_storage  # Файлы медиа хранятся по хэшу содержимого
 
 
 class TelegramUser(models.Model):
@@ -14,21 +17,54 @@ class ModelProfile(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
-    preview_photo = models.ImageField(upload_to='model_previews/')
+    preview_photo = models.ImageField(upload_to='model_previews/', storage=media_storage)
+    # file_id превью, выданный Telegram после первой загрузки
+    preview_file_id = models.CharField(max_length=255, blank=True, default='')
+    preview_file_unique_id = models.CharField(max_length=255, blank=True, default='')
+    # Копии превью, которые строит stefbot.images после загрузки
+    preview_telegram = models.ImageField(upload_to='model_previews/telegram/', storage=media_storage, blank=True, editable=False)
+    preview_thumbnail = models.ImageField(upload_to='model_previews/thumbs/', storage=media_storage, blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
 class ModelPhoto(models.Model):
     model = models.ForeignKey(ModelProfile, on_delete=models.CASCADE, related_name='photos')
-    photo = models.ImageField(upload_to='model_photos/')
+    photo = models.ImageField(upload_to='model_photos/', storage=media_storage)
+    # Уменьшенная копия без EXIF для отправки в Telegram и миниатюра для админки
+    telegram_photo = models.ImageField(upload_to='model_photos/telegram/', storage=media_storage, blank=True, editable=False)
+    thumbnail = models.ImageField(upload_to='model_photos/thumbs/', storage=media_storage, blank=True, editable=False)
+    telegram_file_id = models.CharField(max_length=255, blank=True, default='')
+    telegram_file_unique_id = models.CharField(max_length=255, blank=True, default='')
    
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'id'], name='modelphoto_model_id_idx'),
+            # update_file_id и подсчет ссылок на блоб ищут строки по имени файла
+            models.Index(fields=['photo'], name='modelphoto_photo_idx'),
+        ]
+
     def __str__(self):
         return f"Фото для {self.model.name}"
     
 class ModelVideo(models.Model):
     model = models.ForeignKey(ModelProfile, on_delete=models.CASCADE, related_name='videos')
-    video = models.FileField(upload_to='model_videos/')
+    video = models.FileField(upload_to='model_videos/', storage=media_storage)
+    telegram_file_id = models.CharField(max_length=255, blank=True, default='')
+    telegram_file_unique_id = models.CharField(max_length=255, blank=True, default='')
+    # Метаданные из заголовков MP4 (stefbot.video), заполняются при сохранении
+    duration = models.PositiveIntegerField(null=True, blank=True, editable=False)  # Секунды
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    file_size = models.BigIntegerField(null=True, blank=True, editable=False)
+    faststart = models.BooleanField(null=True, editable=False)  # moov перед mdat
+    send_problem = models.CharField(max_length=255, blank=True, default='', editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'id'], name='modelvideo_model_id_idx'),
+            models.Index(fields=['video'], name='modelvideo_video_idx'),
+        ]
 
     def __str__(self):
         return f"Видео для {self.model.name}"
@@ -47,8 +83,24 @@ class Order(models.Model):
     payment_proof = models.ImageField(upload_to='payment_proofs/', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Оплаченные заказы пользователя по страницам (created_at, id)
+            models.Index(fields=['user', 'status', 'created_at', 'id'], name='order_user_status_created_idx'),
+            # Список заказов в админке с фильтром по статусу
+            models.Index(fields=['status', 'created_at', 'id'], name='order_status_created_idx'),
+            models.Index(fields=['created_at', 'id'], name='order_created_idx'),
+        ]
+
     def __str__(self):
         return f"Заказ {self.id} - {self.user} - {self.status}"
+
+    def save(self, *args, **kwargs):
+        if self.pk is None or self.status != 'paid':
+            return super().save(*args, **kwargs)
+        # Сигнал notify_user_on_payment пишет outbox: он коммитится вместе со статусом или не пишется совсем
+        with atomic_write():
+            super().save(*args, **kwargs)
     
     def set_status_to_paid(self):
         if self.status == 'pending':  # Only update if it's in a pending state
@@ -57,3 +109,54 @@ class Order(models.Model):
 
     def __str__(self):
         return f"Заказ {self.id} - {self.user} - {self.status}"
+
+
+class OrderDelivery(models.Model):
+    """Outbox доставки оплаченного заказа: пишется в одной транзакции со сменой статуса."""
+    STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('processing', 'Отправляется'),
+        ('sent', 'Доставлено'),
+        ('failed', 'Ошибка'),
+    ]
+
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='delivery')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    batch_id = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # Что уже в чате покупателя: повтор доставки продолжает с этого места
+    confirmation_sent = models.BooleanField(default=False)
+    albums_sent = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    traceparent = models.CharField(max_length=55, blank=True, default='')  # Трасса, оплатившая заказ
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Выборка очереди воркером
+            models.Index(fields=['status', 'available_at'], name='delivery_status_available_idx'),
+        ]
+
+    def __str__(self):
+        return f"Доставка заказа {self.order_id} - {self.status}"
+
+
+class QueuedUpdate(models.Model):
+    """Апдейт Telegram в очереди шарда: ingress пишет, воркер шарда удаляет после обработки."""
+    update_id = models.BigIntegerField(unique=True)  # Повторная доставка от Telegram не дублируется
+    shard = models.PositiveSmallIntegerField()
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Выборка шарда воркером по порядку поступления
+            models.Index(fields=['shard', 'id'], name='queuedupdate_shard_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"Апдейт {self.update_id} (шард {self.shard})"
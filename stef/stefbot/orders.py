@@ -0,0 +1,112 @@
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from .models import Order, TelegramUser
+from .sqlite import atomic_write
+
+ORDERS_PER_PAGE = 5  # How many orders to show per page
+COUNT_TIMEOUT = 300  # Счетчик живет 5 минут, даже если сброс не дошел
+
+_pending_resets = threading.local()  # user_id, чьи счетчики сбросить после коммита
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(created_at, order_id):
+    """Курсор (created_at, id) для callback_data: микросекунды и id."""
+    return f"{(created_at - _EPOCH) // timedelta(microseconds=1)}_{order_id}"
+
+
+def decode_cursor(value):
+    micros, order_id = value.split('_')
+    return _EPOCH + timedelta(microseconds=int(micros)), int(order_id)
+
+
+def paid_orders(telegram_id):
+    return Order.objects.filter(user__telegram_id=telegram_id, status='paid')
+
+
+def paid_orders_page(telegram_id, cursor=None, backwards=False):
+    """Страница оплаченных заказов по ключу (created_at, id).
+
+    Читает из БД ORDERS_PER_PAGE + 1 строк: лишняя строка показывает,
+    есть ли заказы дальше курсора. Возвращает ([(id, created_at), ...], has_more).
+    """
+    orders = paid_orders(telegram_id)
+    if cursor:
+        created_at, order_id = decode_cursor(cursor)
+        if backwards:
+            orders = orders.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=order_id))
+        else:
+            orders = orders.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=order_id))
+    ordering = ('-created_at', '-id') if backwards else ('created_at', 'id')
+    rows = list(orders.order_by(*ordering).values_list('id', 'created_at')[:ORDERS_PER_PAGE + 1])
+    has_more = len(rows) > ORDERS_PER_PAGE
+    rows = rows[:ORDERS_PER_PAGE]
+    if backwards:
+        rows.reverse()
+    return rows, has_more
+
+
+def _count_key(telegram_id):
+    return f'paid_orders_count:{telegram_id}'
+
+
+def paid_orders_count(telegram_id):
+    """Число оплаченных заказов пользователя из кэша; COUNT(*) только при промахе."""
+    count = cache.get(_count_key(telegram_id))
+    if count is None:
+        count = paid_orders(telegram_id).count()
+        cache.set(_count_key(telegram_id), count, COUNT_TIMEOUT)
+    return count
+
+
+def invalidate_paid_orders_count(*telegram_ids):
+    cache.delete_many([_count_key(telegram_id) for telegram_id in telegram_ids])
+
+
+def _reset_counts_of_users(user_ids):
+    telegram_ids = TelegramUser.objects.filter(pk__in=user_ids).values_list('telegram_id', flat=True)
+    invalidate_paid_orders_count(*telegram_ids)
+
+
+def _flush_count_resets():
+    _reset_counts_of_users(_pending_resets.__dict__.pop('user_ids', ()))
+
+
+def schedule_count_reset(user_id):
+    """Сбрасывает счетчик по user_id без запроса на каждую строку.
+
+    Внутри транзакции id копятся и после коммита переводятся в telegram_id
+    одним запросом: каскадное удаление тысяч заказов не делает тысячу SELECT.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        _reset_counts_of_users([user_id])
+        return
+    # После отката колбэк пропадает из очереди - тогда начинаем новый набор
+    if not any(callback is _flush_count_resets for _, callback, _ in connection.run_on_commit):
+        _pending_resets.user_ids = set()
+        transaction.on_commit(_flush_count_resets)
+    _pending_resets.user_ids.add(user_id)
+
+
+def bulk_mark_paid(queryset):
+    """Переводит заказы в 'paid' одним UPDATE и в той же транзакции кладет их в outbox.
+
+    Уже оплаченные заказы пропускаются, чтобы не доставить их второй раз.
+    Возвращает (id рассылки, число подтвержденных заказов).
+    """
+    from .dispatcher import enqueue_deliveries
+
+    batch_id = uuid.uuid4().hex[:8]
+    with atomic_write():
+        rows = list(queryset.select_for_update().exclude(status='paid').values_list('id', 'user__telegram_id'))
+        order_ids = [order_id for order_id, _ in rows]
+        updated = Order.objects.filter(id__in=order_ids).update(status='paid')
+        enqueue_deliveries(order_ids, batch_id)
+        invalidate_paid_orders_count(*{telegram_id for _, telegram_id in rows})
+    return batch_id, updated
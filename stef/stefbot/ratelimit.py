@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from django.conf import settings
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from . import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+# Бакеты в виде (емкость, период в секундах). Лимиты Telegram: ~30 сообщений
+# в секунду на бота, 1 в секунду в один чат и 20 в минуту в группу.
+GLOBAL_LIMIT = (25, 1)
+CHAT_LIMIT = (1, 1)
+GROUP_LIMIT = (20, 60)
+MAX_RETRIES = 3  # Сколько раз повторять запрос после RetryAfter
+LOCK_TIMEOUT = 5  # Секунд ждать, пока другой процесс держит файл бакетов
+
+GLOBAL_KEY = 'global'
+
+# Все запросы к Bot API проходят через лимитер, поэтому и замеряются здесь
+TELEGRAM_REQUEST_SECONDS = metrics.Histogram(
+    'stefbot_telegram_request_seconds', "Запрос к Bot API без ожидания лимитера", ('endpoint',),
+)
+TELEGRAM_ERRORS = metrics.Counter(
+    'stefbot_telegram_errors_total', "Ошибки запросов к Bot API по классу исключения", ('endpoint', 'error'),
+)
+RATE_LIMIT_WAIT_SECONDS = metrics.Histogram(
+    'stefbot_ratelimit_wait_seconds', "Ожидание токена лимитера перед запросом к Bot API", ('endpoint',),
+)
+
+
+def _is_message(endpoint):
+    """Лимиты чата относятся к сообщениям, а не к правкам и ответам на кнопки."""
+    return endpoint.startswith('send') or endpoint in ('copyMessage', 'forwardMessage')
+
+
+def bucket_keys(endpoint, data):
+    """Ключи бакетов, через которые проходит запрос."""
+    keys = [GLOBAL_KEY]
+    chat_id = data.get('chat_id')
+    if chat_id is not None and _is_message(endpoint):
+        # У групп и каналов id отрицательный или вида @name
+        if not str(chat_id).isdigit():
+            keys.append(f'group:{chat_id}')
+        else:
+            keys.append(f'chat:{chat_id}')
+    return keys
+
+
+class SharedRateLimiter(BaseRateLimiter):
+    """Token bucket для всех запросов к Bot API, общий для процессов.
+
+    Состояние бакетов лежит в маленькой SQLite-базе: захват токена идет в
+    транзакции BEGIN IMMEDIATE, поэтому бот, воркер доставки и админка
+    делят один лимит. RetryAfter от Telegram ставит на паузу бакет чата или
+    группы запроса во всех процессах (глобальный - только у запросов без
+    чата), а запрос повторяется после паузы: остальные чаты не ждут.
+    """
+
+    def __init__(self, path=None, global_limit=GLOBAL_LIMIT, chat_limit=CHAT_LIMIT,
+                 group_limit=GROUP_LIMIT, max_retries=MAX_RETRIES):
+        self.path = path or settings.RATE_LIMIT_DB
+        self.limits = {'global': global_limit, 'chat': chat_limit, 'group': group_limit}
+        self.max_retries = max_retries
+        self._ready = False
+
+    async def initialize(self):
+        await asyncio.to_thread(lambda: self._connect().close())
+
+    async def shutdown(self):
+        pass
+
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        if not self._ready:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                "updated REAL NOT NULL, blocked_until REAL NOT NULL DEFAULT 0)"
+            )
+            self._ready = True
+        return connection
+
+    def _limit(self, key):
+        capacity, period = self.limits[key.split(':')[0]]
+        return capacity, capacity / period
+
+    def try_acquire(self, keys):
+        """Берет по токену из каждого бакета или возвращает, сколько ждать.
+
+        Токены списываются только если их хватает во всех бакетах сразу.
+        Время берется из time.time(): оно одно для всех процессов.
+        """
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            wait = 0
+            state = {}
+            for key in keys:
+                capacity, rate = self._limit(key)
+                row = connection.execute(
+                    "SELECT tokens, updated, blocked_until FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated, blocked_until = row or (capacity, now, 0)
+                tokens = min(capacity, tokens + max(0, now - updated) * rate)
+                state[key] = (tokens, blocked_until)
+                wait = max(wait, blocked_until - now, (1 - tokens) / rate)
+            if wait <= 0:
+                connection.executemany(
+                    "INSERT INTO buckets (key, tokens, updated, blocked_until) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                    [(key, tokens - 1, now, blocked_until) for key, (tokens, blocked_until) in state.items()],
+                )
+            connection.execute("COMMIT")
+            return max(wait, 0)
+        finally:
+            connection.close()
+
+    def block(self, key, seconds):
+        """Ставит бакет на паузу для всех процессов."""
+        connection = self._connect()
+        try:
+            now = time.time()
+            connection.execute(
+                "INSERT INTO buckets (key, tokens, updated, blocked_until) VALUES (?, 0, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET blocked_until = MAX(blocked_until, excluded.blocked_until)",
+                (key, now, now + seconds),
+            )
+        finally:
+            connection.close()
+
+    async def acquire(self, keys):
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, keys)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        keys = bucket_keys(endpoint, data)
+        with tracing.span(f'telegram.{endpoint}', chat_id=data.get('chat_id')) as span:
+            for attempt in range(self.max_retries + 1):
+                with tracing.span('ratelimit.wait'), RATE_LIMIT_WAIT_SECONDS.time(endpoint=endpoint):
+                    await self.acquire(keys)
+                if span is not None:
+                    span.set('attempts', attempt + 1)
+                try:
+                    with TELEGRAM_REQUEST_SECONDS.time(endpoint=endpoint):
+                        return await callback(*args, **kwargs)
+                except Exception as e:
+                    TELEGRAM_ERRORS.inc(endpoint=endpoint, error=type(e).__name__)
+                    if not isinstance(e, RetryAfter) or attempt == self.max_retries:
+                        raise
+                    logger.warning(f"⏳ {endpoint}: Telegram просит подождать {e.retry_after} с")
+                    # Последний ключ - бакет чата или группы; без них только глобальный
+                    await asyncio.to_thread(self.block, keys[-1], e.retry_after)
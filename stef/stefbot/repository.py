@@ -0,0 +1,176 @@
+import contextlib
+import contextvars
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+from . import tracing
+from .catalog import get_catalog
+from .manifest import get_manifest
+from .models import ModelProfile, Order
+from .orders import paid_orders_count, paid_orders_page
+from .users import cached_user, upsert_user
+
+logger = logging.getLogger(__name__)
+
+# Запросы к БД из асинхронного кода идут в отдельный пул потоков. С
+# sync_to_async(thread_sensitive=True) - и с async-ORM Django 4.2, которая
+# делает то же самое, - все запросы всех пользователей шли в один поток.
+# У каждого потока пула свое соединение с БД, поэтому размер пула - это
+# и предел соединений процесса.
+_executor = ThreadPoolExecutor(max_workers=settings.DB_THREAD_POOL_SIZE, thread_name_prefix='stefbot-db')
+
+# Счетчик времени в БД текущего апдейта: [секунды]. sync_to_async копирует
+# контекст в поток пула, поэтому вызовы видят счетчик своего апдейта.
+_db_time = contextvars.ContextVar('stefbot_db_time', default=None)
+_submitted = contextvars.ContextVar('stefbot_db_submitted', default=None)  # Когда вызов встал в очередь пула
+
+
+@contextlib.contextmanager
+def track_db_time():
+    """Считает время в пуле БД внутри блока: ``with track_db_time() as spent``."""
+    spent = [0.0]
+    token = _db_time.set(spent)
+    try:
+        yield spent
+    finally:
+        _db_time.reset(token)
+
+
+def _trace_query(execute, sql, params, many, context):
+    with tracing.span('db.query', statement=sql[:200], many=many):
+        return execute(sql, params, many, context)
+
+
+def db_async(func):
+    """Как ``sync_to_async``, но выполняет функцию в пуле потоков БД.
+
+    Перед вызовом, как Django перед запросом, закрывает соединение потока,
+    если оно старше CONN_MAX_AGE или сломано; иначе соединение переиспользуется
+    (с проверкой при CONN_HEALTH_CHECKS). Время вызова идет в счетчик
+    ``track_db_time`` апдейта, если он запущен. В трассе вызов - span
+    ``db.<имя>`` с временем ожидания потока пула и span на каждый SQL-запрос.
+    Синхронная функция с этими обертками доступна как ``.func``.
+    """
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with tracing.span(f'db.{func.__name__}') as span:
+                if span is None:
+                    close_old_connections()
+                    return func(*args, **kwargs)
+                submitted = _submitted.get()
+                if submitted is not None:
+                    span.set('pool_wait_ms', round((started - submitted) * 1000, 3))
+                close_old_connections()
+                with connection.execute_wrapper(_trace_query):
+                    return func(*args, **kwargs)
+        finally:
+            spent = _db_time.get()
+            if spent is not None:
+                spent[0] += time.perf_counter() - started
+
+    run = sync_to_async(call, thread_sensitive=False, executor=_executor)
+
+    @functools.wraps(func)
+    async def submit(*args, **kwargs):
+        token = _submitted.set(time.perf_counter())
+        try:
+            return await run(*args, **kwargs)
+        finally:
+            _submitted.reset(token)
+
+    submit.func = call
+    return submit
+
+
+async def get_or_create_user(telegram_id, username):
+    """Пользователь бота; при попадании в кэш - без похода в пул БД."""
+    user = cached_user(telegram_id, username)
+    if user is not None:
+        return user, False
+    return await db_async(upsert_user)(telegram_id, username)
+
+
+@db_async
+def get_catalog_snapshot():
+    """Снимок каталога с готовыми клавиатурами; SQL только после сброса."""
+    return get_catalog()
+
+
+@db_async
+def get_model_by_id(model_id):
+    return ModelProfile.objects.filter(id=model_id).first()
+
+
+@db_async
+def get_user_orders_page(telegram_id, cursor=None, backwards=False):
+    """Страница оплаченных заказов по ключу (created_at, id)."""
+    return paid_orders_page(telegram_id, cursor, backwards)
+
+
+@db_async
+def count_user_orders(telegram_id):
+    return paid_orders_count(telegram_id)
+
+
+@db_async
+def create_order(user, model, amount):
+    """Создает новый заказ и сохраняет его в базе данных."""
+    return Order.objects.create(
+        user=user,
+        model=model,
+        amount=amount,
+        status='pending'
+    )
+
+
+@db_async
+def get_order_by_id(order_id):
+    return Order.objects.filter(id=order_id).first()
+
+
+@db_async
+def get_model_manifest(model_id):
+    """Манифест медиа модели из кэша; БД и диск только после сброса."""
+    return get_manifest(model_id)
+
+
+@db_async
+def get_order_details(order_id):
+    """Данные заказа для уведомления администратора."""
+    try:
+        order = Order.objects.select_related('model').get(id=order_id)
+        return {
+            'id': order.id,
+            'model_name': order.model.name,
+            'amount': order.amount,
+            'created_at': order.created_at,
+            'model_id': order.model.id,
+            'status': order.status
+        }
+    except Order.DoesNotExist:
+        return None
+    except Exception as e:
+        logger.error(f"Error getting order details: {e}")
+        return None
+
+
+@db_async
+def get_full_order_data(order_id):
+    """Модель заказа без загрузки самого заказа."""
+    try:
+        model_id = Order.objects.filter(id=order_id).values_list('model_id', flat=True).first()
+        if model_id is None:
+            return {'exists': False}
+        return {
+            'model_id': model_id,
+            'exists': True
+        }
+    except Exception as e:
+        logger.error(f"Error getting order data: {e}")
+        return {'exists': False}
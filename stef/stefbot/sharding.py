@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from telegram import Update
+from .models import QueuedUpdate
+from .repository import db_async
+from .updates import update_key
+
+logger = logging.getLogger(__name__)
+
+FETCH_BATCH_SIZE = 100  # Сколько апдейтов шарда держать в работе одновременно
+POLL_INTERVAL = 0.05  # Пауза воркера, когда очередь шарда пуста
+
+
+def shard_for(payload, shards):
+    """Шард апдейта по пользователю: все апдейты одного пользователя идут в один шард."""
+    key = update_key(Update.de_json(payload, None))
+    return (key or 0) % shards
+
+
+def enqueue_updates(payloads, shards):
+    """Кладет апдейты (JSON от Telegram) в очереди шардов."""
+    QueuedUpdate.objects.bulk_create(
+        [
+            QueuedUpdate(update_id=payload['update_id'], shard=shard_for(payload, shards), payload=payload)
+            for payload in payloads
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def fetch_updates(shard, after_id, limit):
+    """Следующие апдейты шарда после ``after_id`` в порядке поступления."""
+    return list(
+        QueuedUpdate.objects.filter(shard=shard, id__gt=after_id)
+        .order_by('id').values_list('id', 'payload')[:limit]
+    )
+
+
+def ack_updates(ids):
+    QueuedUpdate.objects.filter(id__in=ids).delete()
+
+
+async def run_shard_worker(application, shard, stop, batch_size=FETCH_BATCH_SIZE):
+    """Читает очередь шарда и отдает апдейты в Application.
+
+    Строка удаляется только после обработки апдейта, поэтому после рестарта
+    воркер продолжит с необработанных апдейтов своего шарда; другие шарды
+    в это время работают. Порядок внутри пользователя сохраняет
+    OrderedApplication: задачи создаются в порядке id.
+    """
+    last_id = 0
+    processed = []
+    in_flight = set()
+
+    async def process(row_id, payload):
+        try:
+            await application.process_update(Update.de_json(payload, application.bot))
+        finally:
+            processed.append(row_id)
+
+    while not stop.is_set():
+        if processed:
+            ids, processed[:] = list(processed), []
+            await db_async(ack_updates)(ids)
+
+        room = batch_size - len(in_flight)
+        if room <= 0:
+            await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            continue
+
+        rows = await db_async(fetch_updates)(shard, last_id, room)
+        for row_id, payload in rows:
+            task = asyncio.create_task(process(row_id, payload))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            last_id = row_id
+        if not rows:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    if in_flight:
+        await asyncio.wait(in_flight)
+    if processed:
+        await db_async(ack_updates)(processed)
@@ -1,64 +1,152 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.db import transaction
 from django.dispatch import receiver
 from django.conf import settings
-from .models import Order, ModelPhoto
-import asyncio
-import threading
+from .models import Order, ModelPhoto, ModelVideo, ModelProfile, TelegramUser
 import logging
 import os
-from telegram import InputMediaPhoto
-from .utils import send_telegram_message, bot  # Используем `bot` для отправки сообщений напрямую
+from .delivery import FILE_ID_FIELDS
+from .catalog import invalidate_catalog
+from .dispatcher import enqueue_deliveries
+from .images import DERIVATIVE_FIELDS, schedule_derivatives
+from .manifest import invalidate_manifest
+from .orders import invalidate_paid_orders_count, schedule_count_reset
+from .storage import MEDIA_FIELDS, release
+from .users import user_cache
+from .video import probe_video
 
 logger = logging.getLogger(__name__)
 
-# Глобальный event loop для фоновых задач
-loop = asyncio.new_event_loop()
-threading.Thread(target=loop.run_forever, daemon=True).start()
-
 def get_local_photo_path(photo):
     """Возвращает полный путь к файлу изображения."""
     if not photo:
         return None
     return os.path.join(settings.MEDIA_ROOT, str(photo))  # Абсолютный путь к файлу
 
-async def send_order_confirmation(telegram_id, message, photo_paths):
-    """Асинхронно отправляет сообщение и фото (все сразу одним сообщением)."""
-    try:
-        await send_telegram_message(telegram_id, message)
-
-        media_group = []
-        for photo_path in photo_paths:
-            if os.path.exists(photo_path):  # Проверяем, существует ли файл
-                with open(photo_path, "rb") as photo_file:
-                    media_group.append(InputMediaPhoto(media=photo_file.read()))
-            else:
-                logger.warning(f"❌ Файл {photo_path} не найден!")
-
-        if media_group:
-            await bot.send_media_group(chat_id=telegram_id, media=media_group)
-        else:
-            logger.warning("❌ Нет доступных фото для отправки.")
-    
-    except Exception as e:
-        logger.error(f"Ошибка отправки фото: {e}")
+@receiver(pre_save, sender=ModelPhoto)
+@receiver(pre_save, sender=ModelVideo)
+@receiver(pre_save, sender=ModelProfile)
+def reset_file_id_on_replace(sender, instance, **kwargs):
+    """Сбрасывает сохраненный file_id, если файл заменили в админке."""
+    file_field, id_field, unique_field = FILE_ID_FIELDS[sender]
+    if instance.pk is None or not getattr(instance, id_field):
+        return
+    field_file = getattr(instance, file_field)
+    stored_name = sender.objects.filter(pk=instance.pk).values_list(file_field, flat=True).first()
+    if not field_file._committed or field_file.name != stored_name:
+        setattr(instance, id_field, '')
+        setattr(instance, unique_field, '')
 
-@receiver(post_save, sender=Order)
-def notify_user_on_payment(sender, instance, created, **kwargs):
-    """Отправляет пользователю подтверждение оплаты и фото заказа."""
-    if instance.status == 'paid' and not created:
-        telegram_user = instance.user
-        message = f"✅ Ваш заказ {instance.id} был оплачен успешно! Получите фото ниже:"
+@receiver(pre_save, sender=ModelPhoto)
+@receiver(pre_save, sender=ModelProfile)
+def reset_derivatives_on_upload(sender, instance, **kwargs):
+    """Отмечает новую загрузку: копии для Telegram надо построить заново."""
+    source_field, telegram_field, thumbnail_field = DERIVATIVE_FIELDS[sender]
+    field_file = getattr(instance, source_field)
+    stored_name = None
+    if instance.pk is not None:
+        stored_name = sender.objects.filter(pk=instance.pk).values_list(source_field, flat=True).first()
+    instance._upload_pending = bool(field_file) and not field_file._committed
+    if instance._upload_pending or (instance.pk is not None and field_file.name != stored_name):
+        setattr(instance, telegram_field, '')
+        setattr(instance, thumbnail_field, '')
+
+@receiver(pre_save, sender=ModelPhoto)
+@receiver(pre_save, sender=ModelVideo)
+@receiver(pre_save, sender=ModelProfile)
+def remember_stored_media(sender, instance, **kwargs):
+    """Запоминает файлы строки до сохранения, чтобы освободить замененные."""
+    instance._stored_media = {}
+    if instance.pk is not None:
+        fields = MEDIA_FIELDS[sender._meta.label]
+        instance._stored_media = sender.objects.filter(pk=instance.pk).values(*fields).first() or {}
+
+@receiver(post_save, sender=ModelPhoto)
+@receiver(post_save, sender=ModelVideo)
+@receiver(post_save, sender=ModelProfile)
+def release_replaced_media(sender, instance, **kwargs):
+    """Удаляет замененные файлы, если на них больше никто не ссылается."""
+    stored = getattr(instance, '_stored_media', {})
+    names = [name for field, name in stored.items() if name != getattr(instance, field).name]
+    if names:
+        transaction.on_commit(lambda: release(*names))
+
+@receiver(post_delete, sender=ModelPhoto)
+@receiver(post_delete, sender=ModelVideo)
+@receiver(post_delete, sender=ModelProfile)
+def release_deleted_media(sender, instance, **kwargs):
+    """Удаляет файлы удаленной строки, если другие строки их не используют."""
+    names = [getattr(instance, field).name for field in MEDIA_FIELDS[sender._meta.label]]
+    transaction.on_commit(lambda: release(*names))
+
+@receiver(pre_save, sender=ModelVideo)
+def probe_video_on_upload(sender, instance, **kwargs):
+    """Читает длительность, размеры и faststart видео из заголовков MP4."""
+    if not instance.video:
+        return
+    stored_name = None
+    if instance.pk is not None:
+        stored_name = sender.objects.filter(pk=instance.pk).values_list('video', flat=True).first()
+    if not instance.video._committed or instance.video.name != stored_name or instance.file_size is None:
+        probe_video(instance)
+        if instance.send_problem:
+            logger.warning(f"🎬 Видео {instance.video.name}: {instance.send_problem}")
+
+@receiver(post_save, sender=ModelPhoto)
+@receiver(post_save, sender=ModelProfile)
+def build_derivatives_after_upload(sender, instance, **kwargs):
+    """Строит копию для Telegram и миниатюру в фоне, после коммита."""
+    if getattr(instance, '_upload_pending', False):
+        instance._upload_pending = False
+        schedule_derivatives(sender, instance.pk)
 
-        logger.info(f"📩 Отправка уведомления пользователю {telegram_user.telegram_id}")
+@receiver(post_save, sender=ModelPhoto)
+@receiver(post_save, sender=ModelVideo)
+@receiver(post_delete, sender=ModelPhoto)
+@receiver(post_delete, sender=ModelVideo)
+def refresh_media_manifest(sender, instance, **kwargs):
+    """Сбрасывает манифест медиа модели при изменении ее фото или видео.
 
-        # Получаем фото модели и их локальные пути
-        photos = ModelPhoto.objects.filter(model=instance.model)
-        photo_paths = [get_local_photo_path(photo.photo.name) for photo in photos if photo.photo]
+    После коммита: иначе бот, пересобравший манифест до коммита, сохранил
+    бы старые строки под новой версией.
+    """
+    model_id = instance.model_id
+    transaction.on_commit(lambda: invalidate_manifest(model_id))
 
-        if not photo_paths:
-            logger.warning(f"❌ Нет доступных фото для заказа {instance.id}")
+@receiver(post_save, sender=ModelProfile)
+@receiver(post_delete, sender=ModelProfile)
+def refresh_profile_caches(sender, instance, **kwargs):
+    """Сбрасывает снимок каталога и манифест медиа измененной модели после коммита."""
+    model_id = instance.pk
 
-        # Запускаем задачу в фоновом event loop
-        asyncio.run_coroutine_threadsafe(
-            send_order_confirmation(telegram_user.telegram_id, message, photo_paths), loop
-        )
+    def invalidate():
+        invalidate_catalog()
+        invalidate_manifest(model_id)
+
+    transaction.on_commit(invalidate)
+
+@receiver(post_save, sender=TelegramUser)
+@receiver(post_delete, sender=TelegramUser)
+def evict_cached_user(sender, instance, **kwargs):
+    """Убирает пользователя из кэша бота, если его изменили в этом процессе."""
+    user_cache.discard(instance.telegram_id)
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def refresh_paid_orders_count(sender, instance, created=False, **kwargs):
+    """Сбрасывает счетчик оплаченных заказов, если статус мог измениться."""
+    if created and instance.status != 'paid':
+        return
+    if Order.user.is_cached(instance):
+        telegram_id = instance.user.telegram_id
+        transaction.on_commit(lambda: invalidate_paid_orders_count(telegram_id))
+    else:
+        # instance.user подгружался бы отдельным запросом на каждую строку
+        schedule_count_reset(instance.user_id)
+
+@receiver(post_save, sender=Order)
+def notify_user_on_payment(sender, instance, created, **kwargs):
+    """Кладет доставку оплаченного заказа в outbox; отправляет ее воркер."""
+    if instance.status == 'paid' and not created:
+        logger.info(f"📩 Заказ {instance.id} оплачен, ставим доставку в очередь")
+        enqueue_deliveries([instance.id])
@@ -0,0 +1,20 @@
+from contextlib import contextmanager
+from django.db import transaction
+
+
+@contextmanager
+def atomic_write(using=None):
+    """transaction.atomic() для блока, который пишет в базу.
+
+    На SQLite внешняя транзакция такого блока открывается через BEGIN
+    IMMEDIATE, остальные - обычным BEGIN и не мешают друг другу читать.
+    На других бэкендах это обычный atomic().
+    """
+    connection = transaction.get_connection(using)
+    previous = getattr(connection, 'begin_immediate', False)
+    connection.begin_immediate = True
+    try:
+        with transaction.atomic(using=using):
+            yield
+    finally:
+        connection.begin_immediate = previous
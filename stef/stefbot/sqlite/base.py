@@ -0,0 +1,30 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """SQLite, настроенный на параллельную запись бота, воркеров и админки.
+
+    - WAL: чтения не ждут записи, а запись не ждет чтений;
+    - synchronous=NORMAL: в WAL не теряет целостность, fsync только на checkpoint;
+    - busy_timeout (OPTIONS['timeout']): ждать блокировку, а не падать сразу;
+    - BEGIN IMMEDIATE в atomic_write: блокировка записи берется в начале
+      транзакции. С обычным BEGIN транзакция, которая сначала читает, а потом
+      пишет, при конкурентной записи сразу получает "database is locked" -
+      SQLite не ждет busy_timeout, чтобы не словить взаимную блокировку.
+      Блоки atomic(), которые только читают, открываются обычным BEGIN и не
+      выстраиваются в очередь за писателями.
+
+    Режим WAL хранится в самом файле базы: первое подключение переводит
+    db.sqlite3 в WAL, дальше PRAGMA ничего не меняет.
+    """
+
+    begin_immediate = False  # Выставляет atomic_write на время входа в блок
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE' if self.begin_immediate else 'BEGIN')
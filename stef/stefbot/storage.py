@@ -0,0 +1,95 @@
+import hashlib
+import os
+import re
+import tempfile
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db.models import Q
+
+BLOB_DIR = 'blobs'
+BLOB_NAME = re.compile(rf'^{BLOB_DIR}/[0-9a-f]{{2}}/([0-9a-f]{{64}})(\.\w+)?$')
+
+# Поля с медиа, которые ссылаются на блобы: модель -> файловые поля
+MEDIA_FIELDS = {
+    'stefbot.ModelPhoto': ('photo', 'telegram_photo', 'thumbnail'),
+    'stefbot.ModelVideo': ('video',),
+    'stefbot.ModelProfile': ('preview_photo', 'preview_telegram', 'preview_thumbnail'),
+}
+
+
+def blob_name(digest, ext):
+    return f'{BLOB_DIR}/{digest[:2]}/{digest}{ext.lower()}'
+
+
+def content_key(name):
+    """SHA-256 содержимого по имени блоба или None для старых путей upload_to."""
+    match = BLOB_NAME.match(name or '')
+    return match and match.group(1)
+
+
+def file_digest(file):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранит каждый файл один раз под SHA-256 его содержимого.
+
+    Путь из upload_to дает только расширение: одинаковые загрузки в разные
+    модели получают одно имя ``blobs/ab/<sha256>.jpg``. Файл пишется во
+    временный файл с подсчетом хэша за один проход и переименовывается;
+    если такой блоб уже есть, временный файл просто удаляется.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name  # Имя определяет содержимое, суффиксы не нужны
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1]
+        directory = os.path.join(self.location, BLOB_DIR)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            name = blob_name(digest.hexdigest(), ext)
+            path = self.path(name)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp_path, self.file_permissions_mode)
+                # Одновременная загрузка тех же байт перезапишет файл тем же содержимым
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return name
+
+
+media_storage = ContentAddressedStorage()
+
+
+def references(name):
+    """Сколько строк медиа ссылаются на файл."""
+    count = 0
+    for label, fields in MEDIA_FIELDS.items():
+        condition = Q()
+        for field in fields:
+            condition |= Q(**{field: name})
+        count += apps.get_model(label).objects.filter(condition).count()
+    return count
+
+
+def release(*names):
+    """Удаляет файлы, на которые больше не ссылается ни одна строка."""
+    for name in set(names):
+        if name and not references(name):
+            media_storage.delete(name)
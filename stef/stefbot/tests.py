@@ -1,3 +1,1709 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import http.server
+import hashlib
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from telegram import Bot, InputFile, Update
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
+
+from . import loopmonitor, metrics, repository, tracing, webhook
+from .catalog import get_catalog, invalidate_catalog
+from .delivery import build_input_media, open_photo, send_media_albums, update_file_id
+from .dispatcher import batch_progress, claim_deliveries, enqueue_deliveries, run_worker
+from .fakebotapi import FakeBotAPI, FakeBotAPIServer, callback_update, command_update
+from .images import _build_in_background, build_derivatives
+from .management.commands.benchmark_queries import generate
+from .manifest import get_manifest, invalidate_manifest
+from .models import ModelPhoto, ModelProfile, ModelVideo, Order, OrderDelivery, QueuedUpdate, TelegramUser
+from .orders import bulk_mark_paid, encode_cursor, paid_orders_count, paid_orders_page
+from .ratelimit import SharedRateLimiter, bucket_keys
+from .repository import db_async, get_or_create_user
+from .sharding import enqueue_updates, run_shard_worker, shard_for
+from .sqlite import atomic_write
+from .storage import content_key
+from .updates import UPDATE_DB_SECONDS, UPDATE_SECONDS, UserOrderedScheduler, update_kind
+from .users import UserCache, cached_user, upsert_user, user_cache
+from .video import probe_mp4
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class NoBackgroundDerivativesMixin:
+    """Не отдает построение копий фото в фоновый пул после коммита.
+
+    Иначе поток пула пишет в тестовую БД одновременно с тестом, и результат
+    зависит от того, кто успел первым.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        patcher = mock.patch('stefbot.images._submit')
+        patcher.start()
+        cls.addClassCleanup(patcher.stop)
+
+
+class MultipartSinkRequest(BaseRequest):
+    """Вместо сети прогоняет multipart-тело через httpx и отбрасывает его."""
+
+    def __init__(self):
+        self.uploaded = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        request = httpx.Request(
+            method, url,
+            data=request_data.json_parameters,
+            files=request_data.multipart_data,
+        )
+        async for chunk in request.stream:
+            self.uploaded += len(chunk)
+        media = json.loads(request_data.json_parameters['media'])
+        messages = [
+            {
+                'message_id': i, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                'photo': [{'file_id': f'f{i}', 'file_unique_id': f'u{i}', 'width': 1, 'height': 1}],
+            }
+            for i in range(len(media))
+        ]
+        return 200, json.dumps({'ok': True, 'result': messages}).encode()
+
+
+class StreamingDeliveryTests(TestCase):
+    FILE_SIZE = 4 * 1024 * 1024
+    FILE_COUNT = 10
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.items = []
+        for i in range(self.FILE_COUNT):
+            path = os.path.join(self.tmp.name, f'{i}.jpg')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(self.FILE_SIZE))
+            self.items.append({'kind': 'photo', 'pk': 0, 'name': '', 'path': path, 'size': self.FILE_SIZE, 'file_id': ''})
+
+    def test_album_upload_memory_is_bounded_by_chunk_not_album(self):
+        request = MultipartSinkRequest()
+        bot = Bot(token='123:abc', request=request)
+
+        tracemalloc.start()
+        try:
+            sent = asyncio.run(send_media_albums(bot, 1, [self.items]))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(sent, self.FILE_COUNT)
+        self.assertGreater(request.uploaded, self.FILE_SIZE * self.FILE_COUNT)
+        # Весь альбом - 40 МБ; потоковая отправка держит в памяти лишь куски
+        self.assertLess(peak, self.FILE_SIZE)
+
+
+class SlowInputFile(InputFile):
+    """Файл, открытие которого занимает время, как на медленном диске."""
+
+    opened = []
+
+    def __init__(self, path, attach=False):
+        time.sleep(0.02)
+        super().__init__(b'', filename=os.path.basename(path), attach=attach)
+        self.opened.append(time.monotonic())
+
+    def close(self):
+        pass
+
+
+class RecordingBot:
+
+    def __init__(self):
+        self.albums = []
+
+    async def send_media_group(self, chat_id, media):
+        self.albums.append((time.monotonic(), [item.media.filename for item in media]))
+        await asyncio.sleep(0.05)  # Загрузка альбома
+        return [SimpleNamespace(photo=None, video=None) for _ in media]
+
+
+class MediaPipelineTests(TestCase):
+
+    def setUp(self):
+        SlowInputFile.opened = []
+        patcher = mock.patch('stefbot.delivery.StreamingInputFile', SlowInputFile)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        items = [
+            {'kind': 'photo', 'pk': 0, 'name': '', 'path': f'/media/{i}.jpg', 'size': 1, 'file_id': ''}
+            for i in range(40)
+        ]
+        self.albums = [items[i:i + 10] for i in range(0, 40, 10)]
+
+    def test_first_album_is_sent_before_all_files_are_ready(self):
+        bot = RecordingBot()
+        sent = asyncio.run(send_media_albums(bot, 1, self.albums))
+
+        self.assertEqual(sent, 40)
+        self.assertLess(bot.albums[0][0], max(SlowInputFile.opened))
+        # Следующий альбом готовится во время загрузки: последовательно пауза была бы 0.25 с
+        starts = [at for at, _ in bot.albums]
+        self.assertLess(max(b - a for a, b in zip(starts, starts[1:])), 0.15)
+        # Порядок альбомов и файлов в чате совпадает с манифестом
+        self.assertEqual(sum((names for _, names in bot.albums), []), [f'{i}.jpg' for i in range(40)])
+
+
+class UploadRecordingBot:
+    """Запоминает, что ушло в альбоме: файл или file_id, и выдает file_id как Telegram."""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_media_group(self, chat_id, media):
+        self.sent.extend(item.media if isinstance(item.media, str) else 'upload' for item in media)
+        return [
+            SimpleNamespace(photo=[SimpleNamespace(file_id=f'F{i}', file_unique_id=f'U{i}')], video=None)
+            for i in range(len(media))
+        ]
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FileIdReuseTests(NoBackgroundDerivativesMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.tmp.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        os.makedirs(os.path.join(self.tmp.name, 'model_photos'))
+        with open(os.path.join(self.tmp.name, 'model_photos/1.jpg'), 'wb') as f:
+            f.write(b'photo')
+        self.model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+        self.photo = ModelPhoto.objects.create(model=self.model, photo='model_photos/1.jpg')
+
+    def send(self):
+        bot = UploadRecordingBot()
+        asyncio.run(send_media_albums(bot, 42, get_manifest(self.model.id)['photo_albums']))
+        return bot.sent
+
+    def test_first_send_uploads_and_stores_file_id(self):
+        self.assertEqual(self.send(), ['upload'])
+
+        self.photo.refresh_from_db()
+        self.assertEqual((self.photo.telegram_file_id, self.photo.telegram_file_unique_id), ('F0', 'U0'))
+
+    def test_second_send_reuses_stored_file_id(self):
+        self.send()
+        self.assertEqual(self.send(), ['F0'])
+
+        invalidate_manifest(self.model.id)  # Манифест пересобран из БД, как в другом процессе
+        self.assertEqual(self.send(), ['F0'])
+
+    def test_file_id_is_reset_when_file_is_replaced_in_admin(self):
+        self.send()
+        self.photo.refresh_from_db()
+        self.photo.save()  # Сохранение без замены файла
+        self.photo.refresh_from_db()
+        self.assertEqual(self.photo.telegram_file_id, 'F0')
+
+        self.photo.photo = SimpleUploadedFile('new.jpg', b'new photo')
+        self.photo.save()
+        self.photo.refresh_from_db()
+        self.assertEqual((self.photo.telegram_file_id, self.photo.telegram_file_unique_id), ('', ''))
+        self.assertEqual(self.send(), ['upload'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MediaManifestTests(NoBackgroundDerivativesMixin, TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.tmp.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.model = ModelProfile.objects.create(
+            name='Model', description='', price=100,
+            preview_photo=SimpleUploadedFile('preview.jpg', b'preview'),
+        )
+        for i in range(12):
+            ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile(f'{i}.jpg', b'x' * 10))
+        ModelVideo.objects.create(model=self.model, video=SimpleUploadedFile('clip.mp4', b'v' * 20))
+
+    def test_manifest_is_ordered_and_chunked_into_albums(self):
+        manifest = get_manifest(self.model.id)
+
+        self.assertEqual([item['kind'] for item in manifest['items']], ['photo'] * 12 + ['video'])
+        self.assertEqual([len(album) for album in manifest['albums']], [10, 3])
+        self.assertEqual([len(album) for album in manifest['photo_albums']], [10, 2])
+        self.assertEqual(manifest['total_size'], 12 * 10 + 20)
+
+    def test_steady_state_costs_no_queries(self):
+        get_manifest(self.model.id)
+        with self.assertNumQueries(0):
+            get_manifest(self.model.id)
+
+    def test_media_changes_refresh_manifest(self):
+        first = get_manifest(self.model.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            ModelPhoto.objects.filter(model=self.model).first().delete()
+            # До коммита версия прежняя: пересборка не запишет старые строки под новую
+            self.assertEqual(get_manifest(self.model.id), first)
+
+        self.assertIsNot(get_manifest(self.model.id), first)
+        self.assertEqual(len(get_manifest(self.model.id)['items']), 12)
+
+
+def camera_jpeg(size=(2800, 2100)):
+    """JPEG как с камеры: крупный, с EXIF и поворотом на 90 градусов."""
+    image = Image.effect_noise(size, 40).convert('RGB')
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: повернуть на 90
+    exif[0x010F] = 'Camera'
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=95, exif=exif)
+    return buffer.getvalue()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ImageDerivativeTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.tmp.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+
+    def test_upload_schedules_derivatives_after_commit(self):
+        with mock.patch('stefbot.images._executor') as executor, \
+                self.captureOnCommitCallbacks(execute=True):
+            photo = ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile('a.jpg', b'x'))
+        executor.submit.assert_called_once_with(_build_in_background, ModelPhoto, photo.pk)
+
+    def test_derivative_is_small_progressive_and_without_exif(self):
+        original = camera_jpeg()
+        photo = ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile('a.jpg', original))
+
+        self.assertTrue(build_derivatives(ModelPhoto, photo.pk))
+        photo.refresh_from_db()
+        with Image.open(photo.telegram_photo.path) as derivative:
+            self.assertEqual(derivative.size, (960, 1280))  # Повернуто по EXIF
+            self.assertTrue(derivative.info.get('progressive'))
+            self.assertEqual(len(derivative.getexif()), 0)
+        with Image.open(photo.thumbnail.path) as thumbnail:
+            self.assertEqual(max(thumbnail.size), 320)
+        self.assertIn(photo.telegram_photo.path, [item['path'] for item in get_manifest(self.model.id)['items']])
+
+    @override_settings(TELEGRAM_PHOTO_MAX_SIDE=2560)
+    def test_hd_derivative_side_comes_from_settings(self):
+        photo = ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile('a.jpg', camera_jpeg()))
+
+        build_derivatives(ModelPhoto, photo.pk)
+        photo.refresh_from_db()
+        with Image.open(photo.telegram_photo.path) as derivative:
+            self.assertEqual(derivative.size, (1920, 2560))
+
+    def test_replaced_original_discards_stale_derivatives(self):
+        photo = ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile('a.jpg', camera_jpeg((64, 48))))
+        build_derivatives(ModelPhoto, photo.pk)
+        photo.refresh_from_db()
+        photo.photo = SimpleUploadedFile('b.jpg', camera_jpeg((64, 48)))
+        photo.save()
+
+        photo.refresh_from_db()
+        self.assertEqual(photo.telegram_photo.name, '')
+        self.assertEqual(photo.thumbnail.name, '')
+
+    def test_oversized_original_is_recompressed_instead_of_skipped(self):
+        photo = ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile('a.jpg', camera_jpeg((3000, 2000))))
+        with mock.patch('stefbot.delivery.TELEGRAM_PHOTO_LIMIT', 1024):
+            media = open_photo(photo.photo.path)
+        self.addCleanup(media.close)
+        with Image.open(media.input_file_content) as image:
+            self.assertEqual(max(image.size), 1280)
+
+
+def box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def mp4_bytes(duration=12.4, size=(1920, 1080), rotated=False, faststart=True, media=b'\0' * 64):
+    """Минимальный MP4: ftyp, moov с видеотреком и mdat."""
+    timescale = 1000
+    identity = (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    rotation = (0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+    mvhd = box(b'mvhd', struct.pack('>4xIII', 0, 0, timescale) + struct.pack('>I', int(duration * timescale)) + bytes(80))
+    tkhd = box(b'tkhd', bytes(40) + struct.pack('>9i', *(rotation if rotated else identity))
+               + struct.pack('>II', size[0] << 16, size[1] << 16))
+    hdlr = box(b'hdlr', bytes(8) + b'vide' + bytes(12) + b'Video\0')
+    moov = box(b'moov', mvhd + box(b'trak', tkhd + box(b'mdia', hdlr)))
+    # mdat с 64-битным размером, как у больших файлов
+    mdat = struct.pack('>I4sQ', 1, b'mdat', 16 + len(media)) + media
+    ftyp = box(b'ftyp', b'isom' + bytes(4) + b'isommp42')
+    return ftyp + (moov + mdat if faststart else mdat + moov)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class VideoProbeTests(NoBackgroundDerivativesMixin, TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.tmp.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+
+    def test_probe_reads_headers_of_faststart_and_trailing_moov_files(self):
+        data = mp4_bytes()
+        self.assertEqual(
+            probe_mp4(io.BytesIO(data), len(data)),
+            {'duration': 12.4, 'width': 1920, 'height': 1080, 'size': len(data), 'faststart': True},
+        )
+        data = mp4_bytes(rotated=True, faststart=False)
+        meta = probe_mp4(io.BytesIO(data), len(data))
+        self.assertEqual((meta['width'], meta['height'], meta['faststart']), (1080, 1920, False))
+
+    def test_upload_stores_metadata_and_delivery_sends_it(self):
+        video = ModelVideo.objects.create(model=self.model, video=SimpleUploadedFile('clip.mp4', mp4_bytes()))
+        video.refresh_from_db()
+        self.assertEqual((video.duration, video.width, video.height, video.faststart), (12, 1920, 1080, True))
+        self.assertEqual(video.send_problem, '')
+        self.assertEqual(video.video.read(), mp4_bytes())  # Проверка не сдвинула загрузку
+
+        item = get_manifest(self.model.id)['items'][0]
+        with contextlib.ExitStack() as stack:
+            media = build_input_media(item, stack)
+        self.assertEqual((media.duration, media.width, media.height, media.supports_streaming), (12, 1920, 1080, True))
+
+    def test_unsendable_videos_are_flagged_and_oversized_ones_skipped(self):
+        broken = ModelVideo.objects.create(model=self.model, video=SimpleUploadedFile('clip.avi', b'RIFF' * 8))
+        self.assertTrue(broken.send_problem)
+        with mock.patch('stefbot.video.TELEGRAM_VIDEO_LIMIT', 100), mock.patch('stefbot.manifest.TELEGRAM_VIDEO_LIMIT', 100):
+            big = ModelVideo.objects.create(model=self.model, video=SimpleUploadedFile('big.mp4', mp4_bytes()))
+            names = [item['name'] for item in get_manifest(self.model.id)['items']]
+        self.assertIn('больше лимита', big.send_problem)
+        self.assertNotIn(big.video.name, names)
+        self.assertIn(broken.video.name, names)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ContentAddressedStorageTests(NoBackgroundDerivativesMixin, TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.tmp.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.model = ModelProfile.objects.create(
+            name='Model', description='', price=100, preview_photo=SimpleUploadedFile('preview.JPG', b'same'),
+        )
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.tmp.name)
+            for root, _, names in os.walk(self.tmp.name) for name in names
+        )
+
+    def test_same_bytes_are_stored_once_under_their_digest(self):
+        photo = ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile('copy.jpg', b'same'))
+
+        self.assertEqual(photo.photo.name, self.model.preview_photo.name)
+        self.assertEqual(content_key(photo.photo.name), hashlib.sha256(b'same').hexdigest())
+        self.assertEqual(self.stored_files(), [photo.photo.name])
+
+    def test_blob_is_deleted_with_its_last_reference(self):
+        photo = ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile('copy.jpg', b'same'))
+        with self.captureOnCommitCallbacks(execute=True):
+            photo.delete()
+        self.assertEqual(len(self.stored_files()), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.model.preview_photo = SimpleUploadedFile('new.jpg', b'new')
+            self.model.save()
+        self.assertEqual(self.stored_files(), [self.model.preview_photo.name])
+
+    def test_file_id_is_shared_by_rows_with_the_same_blob(self):
+        first, second = (
+            ModelPhoto.objects.create(model=self.model, photo=SimpleUploadedFile(f'{i}.jpg', b'same')) for i in range(2)
+        )
+        update_file_id(ModelPhoto, first.pk, first.photo.name, SimpleNamespace(file_id='F', file_unique_id='U'))
+        second.refresh_from_db()
+        self.assertEqual(second.telegram_file_id, 'F')
+
+    def test_dedupe_moves_legacy_files_into_blobs(self):
+        for name in ('model_photos/a.jpg', 'model_photos/b.jpg', 'model_previews/p.jpg'):
+            os.makedirs(os.path.dirname(os.path.join(self.tmp.name, name)), exist_ok=True)
+            with open(os.path.join(self.tmp.name, name), 'wb') as f:
+                f.write(b'dup' if name != 'model_previews/p.jpg' else b'other')
+        ModelPhoto.objects.bulk_create([
+            ModelPhoto(model=self.model, photo='model_photos/a.jpg'),
+            ModelPhoto(model=self.model, photo='model_photos/b.jpg'),
+        ])
+        ModelProfile.objects.filter(pk=self.model.pk).update(preview_photo='model_previews/p.jpg')
+
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_media', stdout=out)
+
+        names = set(ModelPhoto.objects.values_list('photo', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertTrue(content_key(names.pop()))
+        self.assertTrue(content_key(ModelProfile.objects.get().preview_photo.name))
+        self.assertEqual(len(self.stored_files()), 3)  # dup, other и preview.JPG из setUp
+        self.assertIn('files=3 blobs=2', out.getvalue())
+
+    def test_dedupe_keeps_legacy_files_when_rows_are_not_updated(self):
+        path = os.path.join(self.tmp.name, 'model_photos/a.jpg')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'dup')
+        ModelPhoto.objects.create(model=self.model, photo='model_photos/a.jpg')
+
+        with mock.patch('django.db.models.query.QuerySet.update', side_effect=DatabaseError('disk full')):
+            with self.assertRaises(DatabaseError), self.captureOnCommitCallbacks(execute=True):
+                call_command('dedupe_media', stdout=io.StringIO())
+
+        self.assertEqual(ModelPhoto.objects.get().photo.name, 'model_photos/a.jpg')
+        self.assertTrue(os.path.exists(path))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CatalogSnapshotTests(TestCase):
+
+    def setUp(self):
+        self.model = ModelProfile.objects.create(
+            name='Model', description='Описание', price=100, preview_photo='model_previews/p.jpg',
+        )
+
+    def test_menu_navigation_costs_no_queries(self):
+        get_catalog()
+        with self.assertNumQueries(0):
+            catalog = get_catalog()
+
+        self.assertEqual(catalog['models'][self.model.id]['name'], 'Model')
+        buttons = catalog['list_markup'].inline_keyboard
+        self.assertEqual(buttons[0][0].callback_data, f'model_{self.model.id}')
+        self.assertEqual(buttons[-1][0].callback_data, 'back_to_main')
+
+    def test_model_save_refreshes_snapshot(self):
+        get_catalog()
+        self.model.price = 250
+        with self.captureOnCommitCallbacks(execute=True):
+            self.model.save()
+
+        entry = get_catalog()['models'][self.model.id]
+        self.assertEqual(entry['price'], 250)
+        self.assertIn('250', entry['caption'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaidOrdersPaginationTests(TestCase):
+
+    def setUp(self):
+        user = TelegramUser.objects.create(telegram_id=42)
+        model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.orders = [
+                Order.objects.create(user=user, model=model, amount=100, status='paid').id
+                for _ in range(12)
+            ]
+        Order.objects.create(user=user, model=model, amount=100, status='pending')
+
+    def walk_forward(self):
+        pages, cursor = [], None
+        while True:
+            rows, has_more = paid_orders_page(42, cursor)
+            pages.append([order_id for order_id, _ in rows])
+            if not has_more:
+                return pages
+            cursor = encode_cursor(rows[-1][1], rows[-1][0])
+
+    def test_pages_cover_every_paid_order_once(self):
+        pages = self.walk_forward()
+
+        self.assertEqual([len(page) for page in pages], [5, 5, 2])
+        self.assertEqual(sum(pages, []), self.orders)
+
+    def test_backwards_page_returns_previous_rows_in_order(self):
+        rows, _ = paid_orders_page(42)
+        rows, _ = paid_orders_page(42, encode_cursor(rows[-1][1], rows[-1][0]))
+        back, has_more = paid_orders_page(42, encode_cursor(rows[0][1], rows[0][0]), backwards=True)
+
+        self.assertEqual([order_id for order_id, _ in back], self.orders[:5])
+        self.assertFalse(has_more)
+
+    def test_count_is_cached_and_reset_on_payment(self):
+        self.assertEqual(paid_orders_count(42), 12)
+        with self.assertNumQueries(0):
+            paid_orders_count(42)
+
+        order = Order.objects.get(status='pending')
+        order.status = 'paid'
+        with self.captureOnCommitCallbacks(execute=True):
+            order.save()
+        self.assertEqual(paid_orders_count(42), 13)
+
+    def test_bulk_delete_resets_count_with_one_user_lookup(self):
+        self.assertEqual(paid_orders_count(42), 12)
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            Order.objects.filter(status='paid').delete()
+
+        lookups = [query['sql'] for query in queries if 'FROM "stefbot_telegramuser"' in query['sql']]
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(paid_orders_count(42), 0)
+
+
+class RepositoryTests(TestCase):
+
+    def test_queries_of_different_callbacks_run_in_parallel(self):
+        # В одном потоке sync_to_async второй вызов ждал бы первого и барьер бы не сработал
+        barrier = threading.Barrier(2, timeout=5)
+
+        def query():
+            barrier.wait()
+            return threading.current_thread().name
+
+        async def callbacks():
+            return await asyncio.gather(db_async(query)(), db_async(query)())
+
+        self.assertEqual(len(set(asyncio.run(callbacks()))), 2)
+
+    def test_pool_thread_drops_expired_connection_before_query(self):
+        with mock.patch('stefbot.repository.close_old_connections') as close_old_connections:
+            asyncio.run(db_async(lambda: None)())
+        close_old_connections.assert_called_once_with()
+
+
+class SQLiteBackendTests(TestCase):
+
+    def test_connection_is_tuned_for_concurrent_writes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+
+class SQLiteTransactionTests(TransactionTestCase):
+
+    def test_atomic_write_takes_write_lock_up_front(self):
+        with CaptureQueriesContext(connection) as queries, atomic_write():
+            TelegramUser.objects.count()
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+    def test_read_only_atomic_does_not_take_write_lock(self):
+        with CaptureQueriesContext(connection) as queries, transaction.atomic():
+            TelegramUser.objects.count()
+        self.assertEqual(queries[0]['sql'], 'BEGIN')
+
+    def test_payment_takes_write_lock_up_front(self):
+        user = TelegramUser.objects.create(telegram_id=42)
+        model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+        order = Order.objects.create(user=user, model=model, amount=100)
+        with CaptureQueriesContext(connection) as queries:
+            order.set_status_to_paid()
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+
+class UserCacheTests(TestCase):
+
+    def setUp(self):
+        user_cache.clear()
+
+    def test_changed_username_is_written_through(self):
+        upsert_user(42, 'alice')
+        self.assertIsNone(cached_user(42, 'bob'))
+        with self.assertNumQueries(2):
+            user, created = upsert_user(42, 'bob')
+        self.assertFalse(created)
+        self.assertEqual(TelegramUser.objects.get(telegram_id=42).username, 'bob')
+        self.assertEqual(cached_user(42, 'bob').pk, user.pk)
+
+    def test_entries_expire_and_size_is_bounded(self):
+        cache = UserCache(maxsize=2, ttl=60)
+        for telegram_id in (1, 2, 3):
+            cache.set(telegram_id, telegram_id, None)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(3), (3, None))
+        with mock.patch('stefbot.users.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get(3))
+
+    def test_user_created_by_another_process_is_reused(self):
+        # Другой шард успел создать пользователя между промахом кэша и INSERT
+        existing = TelegramUser.objects.create(telegram_id=42, username='alice')
+        with mock.patch.object(TelegramUser.objects, 'get', side_effect=[TelegramUser.DoesNotExist, existing]):
+            user, created = upsert_user(42, 'alice')
+        self.assertFalse(created)
+        self.assertEqual(user.pk, existing.pk)
+        self.assertEqual(TelegramUser.objects.filter(telegram_id=42).count(), 1)
+
+    def test_deleted_user_is_evicted(self):
+        user, _ = upsert_user(42, 'alice')
+        user.delete()
+        self.assertIsNone(cached_user(42, 'alice'))
+
+
+class UserCacheRepositoryTests(TransactionTestCase):
+
+    def test_repeat_contact_skips_database(self):
+        user_cache.clear()
+        asyncio.run(get_or_create_user(42, 'alice'))  # Промах: запись через пул БД
+        with mock.patch('stefbot.repository.upsert_user') as upsert:
+            user, created = asyncio.run(get_or_create_user(42, 'alice'))
+        upsert.assert_not_called()
+        self.assertFalse(created)
+        self.assertEqual(user.pk, TelegramUser.objects.get(telegram_id=42).pk)
+
+
+class QueryPlanAuditTests(TestCase):
+
+    def test_bot_and_api_queries_use_indexes(self):
+        call_command('audit_query_plans', stdout=io.StringIO())
+
+
+# Бюджеты на холодных кэшах: (запросов к БД, мс). Запросы считаются точно -
+# лишний запрос уже регрессия; время с запасом, ловит только порядок величины.
+HANDLER_BUDGETS = {
+    'start': (1, 500),
+    'handle_models_list': (1, 500),
+    'handle_model_details_upload': (2, 1000),
+    'handle_model_details': (1, 500),
+    'handle_back_to_main': (0, 500),
+    'handle_purchase': (3, 500),
+    'handle_orders': (2, 500),
+    'handle_orders_next_page': (2, 500),
+    'handle_order_photos': (3, 500),
+    'handle_confirm_payment': (4, 500),
+}
+API_BUDGETS = {
+    'telegramuser-list': (2, 500),
+    'telegramuser-detail': (1, 500),
+    'telegramuser-create': (2, 500),
+    'telegramuser-partial_update': (2, 500),
+    'telegramuser-destroy': (5, 500),
+    'modelprofile-list': (2, 500),
+    'modelprofile-detail': (1, 500),
+    'modelphoto-list': (2, 500),
+    'modelphoto-detail': (1, 500),
+    'order-list': (2, 500),
+    'order-detail': (1, 500),
+    'order-create': (3, 500),
+    'order-partial_update': (2, 500),
+    'order-destroy': (3, 500),
+    'admin:stefbot_order_changelist': (6, 1000),
+    'admin:stefbot_modelvideo_changelist': (5, 1000),
+    'admin:stefbot_orderdelivery_changelist': (5, 1000),
+    'admin:stefbot_telegramuser_changelist': (5, 1000),
+    'admin:stefbot_modelprofile_changelist': (5, 1000),
+}
+
+
+@contextlib.contextmanager
+def capture_queries():
+    """SQL этого потока и потоков пула БД (stefbot.repository)."""
+    captured = []
+    connections_seen = []
+
+    def record(execute, sql, params, many, context):
+        captured.append(sql)
+        return execute(sql, params, many, context)
+
+    def install():
+        thread_connection = connections['default']
+        if record not in thread_connection.execute_wrappers:
+            thread_connection.execute_wrappers.append(record)
+            connections_seen.append(thread_connection)
+
+    close_old_connections = repository.close_old_connections
+
+    def close_and_install():
+        close_old_connections()
+        install()
+
+    install()
+    try:
+        with mock.patch.object(repository, 'close_old_connections', close_and_install):
+            yield captured
+    finally:
+        for thread_connection in connections_seen:
+            thread_connection.execute_wrappers.remove(record)
+
+
+class QueryBudgetMixin:
+
+    @contextlib.contextmanager
+    def assert_budget(self, budgets, name):
+        max_queries, max_ms = budgets[name]
+        with capture_queries() as captured:
+            started = time.perf_counter()
+            yield
+            elapsed = (time.perf_counter() - started) * 1000
+        sql = '\n'.join(f'  {statement}' for statement in captured)
+        self.assertLessEqual(len(captured), max_queries,
+                             f"{name}: {len(captured)} queries, budget {max_queries}:\n{sql}")
+        self.assertLessEqual(elapsed, max_ms, f"{name}: {elapsed:.0f} ms, budget {max_ms} ms:\n{sql}")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class HandlerQueryBudgetTests(QueryBudgetMixin, TransactionTestCase):
+    """Каждый handle_* из StefanBot.py через Application и фейковый Bot API."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.tmp.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        os.makedirs(os.path.join(self.tmp.name, 'model_previews'))
+        with open(os.path.join(self.tmp.name, 'model_previews', 'p.jpg'), 'wb') as file:
+            file.write(camera_jpeg((640, 480)))
+
+        self.model = ModelProfile.objects.create(
+            name='Model', description='Описание', price=100, preview_photo='model_previews/p.jpg',
+        )
+        ModelPhoto.objects.bulk_create([
+            ModelPhoto(model=self.model, photo=f'model_photos/{i}.jpg', telegram_file_id=f'photo{i}')
+            for i in range(12)
+        ])
+        user = TelegramUser.objects.create(telegram_id=42, username='user42')
+        self.orders = Order.objects.bulk_create([
+            Order(user=user, model=self.model, amount=100, status='paid') for _ in range(7)
+        ])
+
+    def reset_caches(self):
+        cache.clear()
+        user_cache.clear()
+        invalidate_catalog()
+        invalidate_manifest(self.model.pk)
+
+    async def test_handlers_stay_within_query_budgets(self):
+        from StefanBot import build_application
+
+        api = FakeBotAPI()
+        application = build_application(request=api, limiter=None)
+        await application.initialize()
+        page, _ = await sync_to_async(paid_orders_page)(42)
+        cursor = encode_cursor(page[-1][1], page[-1][0])
+        order_id = self.orders[0].pk
+        cases = [
+            ('start', command_update(1, 42), 'sendPhoto'),
+            ('handle_models_list', 'models', 'editMessageMedia'),
+            ('handle_model_details_upload', f'model_{self.model.pk}', 'sendPhoto'),
+            ('handle_model_details', f'model_{self.model.pk}', 'sendPhoto'),
+            ('handle_back_to_main', 'back_to_main', 'editMessageMedia'),
+            ('handle_purchase', f'buy_{self.model.pk}', 'editMessageCaption'),
+            ('handle_orders', 'orders', 'editMessageText'),
+            ('handle_orders_next_page', f'orders_next_1_{cursor}', 'editMessageText'),
+            ('handle_order_photos', f'order_{order_id}', 'sendMediaGroup'),
+            ('handle_confirm_payment', f'confirm_payment_{order_id}', 'sendMediaGroup'),
+        ]
+        try:
+            for update_id, (name, payload, reply) in enumerate(cases, start=2):
+                if isinstance(payload, str):
+                    payload = callback_update(update_id, 42, payload)
+                await sync_to_async(self.reset_caches)()
+                calls = api.calls[reply]
+                with self.subTest(name), self.assertNoLogs(level='ERROR'):
+                    with self.assert_budget(HANDLER_BUDGETS, name):
+                        await application.process_update(Update.de_json(payload, application.bot))
+                    self.assertGreater(api.calls[reply], calls, f"{name} did not answer with {reply}")
+        finally:
+            await application.shutdown()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ALLOWED_HOSTS=['testserver'])
+class APIQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Действия viewset'ов и списки админки; строк больше одной, чтобы N+1 было видно."""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+        users = TelegramUser.objects.bulk_create([TelegramUser(telegram_id=i) for i in range(1, 6)])
+        self.orders = Order.objects.bulk_create([Order(user=user, model=self.model, amount=100) for user in users])
+        photos = ModelPhoto.objects.bulk_create([ModelPhoto(model=self.model, photo=f'{i}.jpg') for i in range(5)])
+        ModelVideo.objects.bulk_create([ModelVideo(model=self.model, video=f'{i}.mp4') for i in range(5)])
+        bulk_mark_paid(Order.objects.filter(pk__in=[order.pk for order in self.orders[:3]]))
+        self.ids = {'telegramuser': users[0].pk, 'modelprofile': self.model.pk,
+                    'modelphoto': photos[0].pk, 'order': self.orders[-1].pk}
+        self.api = APIClient()
+        self.api.force_authenticate(self.admin)
+        self.client.force_login(self.admin)
+
+    def test_api_actions_stay_within_query_budgets(self):
+        requests = {
+            'create': lambda url, data: self.api.post(url, data, format='json'),
+            'partial_update': lambda url, data: self.api.patch(url, data, format='json'),
+            'destroy': lambda url, data: self.api.delete(url),
+        }
+        bodies = {
+            'telegramuser-create': {'telegram_id': 100, 'username': 'new'},
+            'telegramuser-partial_update': {'username': 'renamed'},
+            'order-create': {'user': self.orders[1].user_id, 'model': self.model.pk, 'status': 'pending'},
+            'order-partial_update': {'status': 'rejected'},
+        }
+        for name in API_BUDGETS:
+            if name.startswith('admin:'):
+                url, call = reverse(name), lambda url, data: self.client.get(url)
+            else:
+                basename, action = name.split('-')
+                if action in ('list', 'create'):
+                    url = reverse(f'{basename}-list')
+                else:
+                    url = reverse(f'{basename}-detail', args=[self.ids[basename]])
+                call = requests.get(action, lambda url, data: self.api.get(url))
+            with self.subTest(name):
+                with self.assert_budget(API_BUDGETS, name):
+                    response = call(url, bodies.get(name))
+                self.assertLess(response.status_code, 300, f"{name}: {response.status_code}")
+
+
+class QueryBenchmarkTests(TestCase):
+
+    def run_benchmark(self, **options):
+        out = io.StringIO()
+        call_command('benchmark_queries', scale=0.0005, repeat=2, stdout=out, stderr=io.StringIO(), **options)
+        return out.getvalue()
+
+    def test_generated_data_is_deterministic(self):
+        def snapshot():
+            return list(Order.objects.order_by('id').values_list('user_id', 'model_id', 'status', 'created_at'))
+
+        generate(0.0005, seed=7)
+        first = snapshot()
+        for model in (Order, ModelPhoto, ModelProfile, TelegramUser):
+            model.objects.all().delete()
+        generate(0.0005, seed=7)
+
+        self.assertEqual(len(first), 1000)
+        self.assertEqual(snapshot(), first)
+
+    def test_run_is_compared_to_saved_baseline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline = os.path.join(tmp, 'baseline.json')
+            self.run_benchmark(save=baseline)
+            with open(baseline) as file:
+                results = json.load(file)['results']
+            self.assertEqual(results['bot.get_order_details']['queries'], 1)
+
+            # Пока запросов не больше, чем в базовом прогоне, регрессий нет
+            self.assertIn('queries 1->1', self.run_benchmark(compare=baseline))
+
+            results['bot.get_order_details']['queries'] = 0
+            with open(baseline, 'w') as file:
+                json.dump({'meta': {}, 'results': results}, file)
+            with self.assertRaisesMessage(CommandError, 'bot.get_order_details'):
+                self.run_benchmark(compare=baseline)
+
+    def test_refuses_to_seed_a_database_with_real_data(self):
+        TelegramUser.objects.create(telegram_id=42)
+
+        with self.assertRaises(CommandError):
+            self.run_benchmark()
+        self.assertEqual(Order.objects.count(), 0)
+
+
+class DBAccessBenchmarkTests(TransactionTestCase):
+
+    def test_runs_on_an_empty_database_and_removes_its_rows(self):
+        out = io.StringIO()
+        call_command('benchmark_db_access', callbacks=4, users=2, db_latency=0, stdout=out)
+
+        self.assertEqual([line.split()[0] for line in out.getvalue().splitlines()], ['sync_to_async', 'db'])
+        self.assertFalse(ModelProfile.objects.exists())
+        self.assertFalse(TelegramUser.objects.exists())
+
+    def test_refuses_to_run_over_real_data(self):
+        TelegramUser.objects.create(telegram_id=42)
+
+        with self.assertRaises(CommandError):
+            call_command('benchmark_db_access', callbacks=4, users=2, stdout=io.StringIO())
+        self.assertFalse(ModelProfile.objects.exists())
+
+
+class OrderWritesBenchmarkTests(TransactionTestCase):
+
+    def test_refuses_to_run_over_real_data(self):
+        TelegramUser.objects.create(telegram_id=42)
+
+        with self.assertRaises(CommandError):
+            call_command('benchmark_order_writes', clients=2, orders=1, stdout=io.StringIO())
+        self.assertFalse(ModelProfile.objects.exists())
+
+
+class FakeApplication:
+
+    def __init__(self):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+
+
+@override_settings(TELEGRAM_WEBHOOK_SECRET='secret', CACHES=LOCMEM_CACHES)
+class WebhookTests(TestCase):
+
+    def setUp(self):
+        self.application = FakeApplication()
+        patcher = mock.patch('stefbot.webhook.get_application', mock.AsyncMock(return_value=self.application))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse('telegram_webhook')
+        self.body = json.dumps(command_update(1, 42))
+
+    async def test_update_is_queued_for_the_application(self):
+        response = await self.async_client.post(
+            self.url, self.body, content_type='application/json',
+            headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        update = self.application.update_queue.get_nowait()
+        self.assertEqual(update.effective_chat.id, 42)
+
+    async def test_wrong_secret_is_rejected(self):
+        response = await self.async_client.post(
+            self.url, self.body, content_type='application/json',
+            headers={'X-Telegram-Bot-Api-Secret-Token': 'guess'},
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(self.application.update_queue.empty())
+
+
+class StartableApplication(FakeApplication):
+
+    def __init__(self, webhook=False):
+        super().__init__()
+        self.webhook = webhook
+        self.running = False
+
+    async def initialize(self):
+        pass
+
+    async def start(self):
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+
+    async def shutdown(self):
+        pass
+
+
+class WebhookApplicationTests(TestCase):
+
+    @override_settings(BOT_APPLICATION_FACTORY='stefbot.tests.StartableApplication')
+    async def test_application_comes_from_the_configured_factory(self):
+        application = await webhook.get_application()
+        try:
+            self.assertIsInstance(application, StartableApplication)
+            self.assertTrue(application.webhook)
+            self.assertTrue(application.running)
+        finally:
+            await webhook.shutdown_application()
+        self.assertFalse(application.running)
+
+
+class UserOrderedSchedulerTests(TestCase):
+
+    def run_updates(self, scheduler, updates):
+        """updates: [(пользователь, длительность)]; возвращает журнал начала и конца."""
+        log = []
+
+        def process(n, user, duration):
+            async def handler():
+                log.append(('start', n, user, scheduler.running))
+                await asyncio.sleep(duration)
+                log.append(('end', n, user))
+            return handler
+
+        async def main():
+            await asyncio.gather(*(
+                scheduler.run(user, process(n, user, duration))
+                for n, (user, duration) in enumerate(updates)
+            ))
+
+        asyncio.run(main())
+        return log
+
+    def test_updates_of_one_user_keep_their_order(self):
+        scheduler = UserOrderedScheduler(limit=4)
+        log = self.run_updates(scheduler, [(1, 0.05), (1, 0), (2, 0), (1, 0)])
+
+        self.assertEqual([n for event, n, *_ in log if event == 'start' and n != 2], [0, 1, 3])
+        # Второй пользователь не ждет медленный апдейт первого
+        self.assertLess(log.index(('end', 2, 2)), log.index(('end', 0, 1)))
+        self.assertEqual(scheduler.stats(), {'running': 0, 'waiting': 0, 'users': 0, 'processed': 4})
+
+    def test_concurrency_is_capped_and_waiting_users_hold_no_slot(self):
+        scheduler = UserOrderedScheduler(limit=2)
+        log = self.run_updates(scheduler, [(1, 0.02)] * 5 + [(user, 0.02) for user in range(2, 6)])
+
+        self.assertLessEqual(max(entry[3] for entry in log if entry[0] == 'start'), 2)
+        # Очередь пользователя 1 не занимает второй слот, пока ждет
+        starts = [entry[1] for entry in log if entry[0] == 'start']
+        self.assertEqual(starts[:2], [0, 5])
+
+
+class RecordingApplication:
+
+    def __init__(self):
+        self.bot = None
+        self.processed = []
+
+    async def process_update(self, update):
+        self.processed.append(update.update_id)
+
+
+class ShardWorkerTests(TransactionTestCase):
+
+    def setUp(self):
+        # Пользователи 10 и 12 попадают в шард 0, пользователь 11 - в шард 1
+        enqueue_updates([command_update(n, 10 + n % 3) for n in range(1, 10)], shards=2)
+
+    def test_updates_of_one_user_always_land_in_one_shard(self):
+        shards = {}
+        for payload in QueuedUpdate.objects.values_list('payload', flat=True):
+            shards.setdefault(payload['message']['from']['id'], set()).add(shard_for(payload, 2))
+        self.assertEqual(shards, {10: {0}, 11: {1}, 12: {0}})
+
+    def test_worker_drains_only_its_shard_in_order(self):
+        application = RecordingApplication()
+
+        async def main():
+            stop = asyncio.Event()
+            worker = asyncio.create_task(run_shard_worker(application, 0, stop))
+            while len(application.processed) < 6:
+                await asyncio.sleep(0.01)
+            stop.set()
+            await worker
+
+        asyncio.run(main())
+        self.assertEqual(application.processed, [n for n in range(1, 10) if (10 + n % 3) % 2 == 0])
+        self.assertEqual(set(QueuedUpdate.objects.values_list('shard', flat=True)), {1})
+
+    def test_redelivered_update_is_queued_once(self):
+        enqueue_updates([command_update(1, 11)], shards=2)
+        self.assertEqual(QueuedUpdate.objects.filter(update_id=1).count(), 1)
+
+    def test_benchmark_refuses_to_run_over_a_live_queue(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_shards', max_workers=1, stdout=io.StringIO())
+        self.assertEqual(QueuedUpdate.objects.count(), 9)
+        self.assertFalse(TelegramUser.objects.exists())
+
+    def test_production_worker_has_no_fake_api_option(self):
+        with self.assertRaises(CommandError):
+            call_command('run_bot_worker', '--shard', '0', '--fake-api-rtt', '0.1', stdout=io.StringIO())
+
+    @override_settings(BOT_SHARDS=2, TELEGRAM_WEBHOOK_SECRET='secret', ALLOWED_HOSTS=['testserver'])
+    async def test_sharded_webhook_writes_to_the_shard_queue(self):
+        # Запись идет из пула потоков БД, поэтому тест не в транзакции TestCase
+        response = await self.async_client.post(
+            reverse('telegram_webhook'), json.dumps(command_update(100, 42)), content_type='application/json',
+            headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await QueuedUpdate.objects.filter(update_id=100).values_list('shard', flat=True).aget(), 0)
+
+
+class UpdateLatencyBenchmarkTests(TransactionTestCase):
+
+    def test_polling_and_webhook_answer_every_update(self):
+        out = io.StringIO()
+        call_command('benchmark_update_latency', updates=5, rate=100, rtt=0, stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual([line.split()[0] for line in lines], ['polling', 'webhook'])
+        self.assertTrue(all('updates=5' in line for line in lines))
+        self.assertFalse(TelegramUser.objects.exists())
+
+
+class FakeBotAPIServerTests(TestCase):
+
+    async def test_server_records_uploads_and_injects_retry_after(self):
+        api = FakeBotAPI(retry_after_rate=1.0)
+        async with FakeBotAPIServer(api) as server:
+            async with Bot('123:abc', base_url=server.base_url, request=HTTPXRequest()) as bot:
+                with self.assertRaises(RetryAfter):
+                    await bot.send_photo(42, b'\xff\xd8' + b'\0' * 4096)
+                api.retry_after_rate = 0
+                message = await bot.send_photo(42, b'\xff\xd8' + b'\0' * 4096)
+
+        self.assertEqual(message.photo[0].file_id, 'file1')
+        self.assertEqual(api.calls['sendPhoto'], 2)
+        self.assertEqual(api.faults['retry_after'], 1)
+        self.assertGreater(api.uploaded, 2 * 4096)
+        self.assertEqual(api.replies[0][:2], ('sendPhoto', 42))
+
+
+class LoadTestBotTests(NoBackgroundDerivativesMixin, TransactionTestCase):
+
+    def test_every_scenario_is_measured_and_seed_data_removed(self):
+        out = io.StringIO()
+        call_command('load_test_bot', users=2, iterations=1, photos=2, rtt=0, stdout=out)
+
+        lines = {line.split()[0]: line for line in out.getvalue().splitlines()}
+        self.assertEqual(list(lines), ['menu', 'purchase', 'orders', 'mix'])
+        self.assertIn('updates=6 ', lines['orders'])  # /start, orders, order_N на пользователя
+        self.assertNotIn('uploaded=0.00MB', lines['orders'])  # Альбом ушел файлами
+        self.assertFalse(TelegramUser.objects.exists())
+        self.assertFalse(ModelProfile.objects.exists())
+
+
+class FakeClient:
+    """Записывает вызовы API вместо отправки в Telegram."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, chat_id, text):
+        self.calls.append(('message', chat_id))
+
+    async def send_media_group(self, chat_id, media):
+        self.calls.append(('album', chat_id, len(media)))
+        photo = [SimpleNamespace(file_id='f', file_unique_id='u')]
+        return [SimpleNamespace(photo=photo, video=None) for _ in media]
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BulkMarkPaidTests(TestCase):
+
+    def setUp(self):
+        user = TelegramUser.objects.create(telegram_id=42)
+        model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+        self.pending = [
+            Order.objects.create(user=user, model=model, amount=100).id
+            for _ in range(3)
+        ]
+        self.paid = Order.objects.create(user=user, model=model, amount=100, status='paid').id
+
+    def test_bulk_update_writes_outbox_rows_for_unpaid_orders_only(self):
+        batch_id, count = bulk_mark_paid(Order.objects.all())
+
+        self.assertEqual(count, 3)
+        self.assertFalse(Order.objects.exclude(status='paid').exists())
+        deliveries = OrderDelivery.objects.filter(batch_id=batch_id)
+        self.assertEqual(sorted(deliveries.values_list('order_id', flat=True)), self.pending)
+        self.assertEqual(batch_progress(), [(batch_id, {'total': 3, 'sent': 0, 'failed': 0})])
+
+    def test_order_is_queued_once(self):
+        order = Order.objects.get(id=self.pending[0])
+        order.status = 'paid'
+        order.save()
+        order.save()
+
+        self.assertEqual(OrderDelivery.objects.filter(order=order).count(), 1)
+
+
+class FailingClient(FakeClient):
+
+    async def send_message(self, chat_id, text):
+        raise RuntimeError('network down')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DeliveryWorkerTests(NoBackgroundDerivativesMixin, TransactionTestCase):
+
+    def setUp(self):
+        user = TelegramUser.objects.create(telegram_id=42)
+        model = ModelProfile.objects.create(name='Model', description='', price=100, preview_photo='p.jpg')
+        ModelPhoto.objects.create(model=model, photo='model_photos/1.jpg', telegram_file_id='cached')
+        orders = [Order.objects.create(user=user, model=model, amount=100) for _ in range(5)]
+        bulk_mark_paid(Order.objects.filter(id__in=[order.id for order in orders]))
+
+    def test_worker_delivers_outbox_and_marks_rows_sent(self):
+        client = FakeClient()
+        with mock.patch('stefbot.dispatcher.bot', client):
+            asyncio.run(run_worker('w1', once=True))
+
+        self.assertEqual(len([c for c in client.calls if c[0] == 'message']), 5)
+        self.assertEqual(len([c for c in client.calls if c[0] == 'album']), 5)
+        self.assertEqual(OrderDelivery.objects.filter(status='sent').count(), 5)
+
+    def test_failed_delivery_is_retried_later(self):
+        with mock.patch('stefbot.dispatcher.bot', FailingClient()):
+            asyncio.run(run_worker('w1', once=True))
+
+        delivery = OrderDelivery.objects.first()
+        self.assertEqual(delivery.status, 'pending')
+        self.assertEqual(delivery.attempts, 1)
+        self.assertIn('network down', delivery.last_error)
+        self.assertEqual(claim_deliveries('w2'), [])  # Ждет своей очереди
+
+    def test_failed_album_keeps_delivery_pending(self):
+        class AlbumFailingClient(FakeClient):
+            async def send_media_group(self, chat_id, media):
+                raise RuntimeError('Bad Request: wrong file identifier')
+
+        with mock.patch('stefbot.dispatcher.bot', AlbumFailingClient()), \
+                self.assertLogs('stefbot', level='ERROR'):
+            asyncio.run(run_worker('w1', once=True))
+
+        self.assertFalse(OrderDelivery.objects.filter(status='sent').exists())
+        delivery = OrderDelivery.objects.first()
+        self.assertEqual((delivery.status, delivery.attempts), ('pending', 1))
+        self.assertIn('wrong file identifier', delivery.last_error)
+
+    def test_retry_resumes_after_the_last_sent_album(self):
+        model = ModelProfile.objects.get()
+        ModelPhoto.objects.bulk_create([
+            ModelPhoto(model=model, photo=f'model_photos/{i}.jpg', telegram_file_id=f'cached{i}') for i in range(2, 16)
+        ])
+        invalidate_manifest(model.id)  # 15 фото - альбомы из 10 и 5
+
+        class SecondAlbumFailsOnce(FakeClient):
+            failed = False
+
+            async def send_media_group(self, chat_id, media):
+                if len(media) == 5 and not self.failed:
+                    self.failed = True
+                    raise RuntimeError('Timed out')
+                return await super().send_media_group(chat_id, media)
+
+        client = SecondAlbumFailsOnce()
+        with mock.patch('stefbot.dispatcher.bot', client), self.assertLogs('stefbot', level='ERROR'):
+            asyncio.run(run_worker('w1', once=True))
+            self.assertEqual(OrderDelivery.objects.filter(status='pending').count(), 1)
+            OrderDelivery.objects.update(available_at=timezone.now())
+            asyncio.run(run_worker('w1', once=True))
+
+        self.assertEqual(OrderDelivery.objects.filter(status='sent').count(), 5)
+        self.assertEqual(len([c for c in client.calls if c[0] == 'message']), 5)
+        self.assertEqual(sorted(c[2] for c in client.calls if c[0] == 'album'), [5] * 5 + [10] * 5)
+
+    def test_status_change_is_rolled_back_when_outbox_write_fails(self):
+        order = Order.objects.create(user=TelegramUser.objects.get(), model=ModelProfile.objects.get(), amount=100)
+        with mock.patch('stefbot.signals.enqueue_deliveries', side_effect=DatabaseError('disk I/O error')):
+            with self.assertRaises(DatabaseError):
+                order.set_status_to_paid()
+
+        self.assertEqual(Order.objects.get(id=order.id).status, 'pending')
+
+    def test_workers_do_not_claim_the_same_rows(self):
+        first = claim_deliveries('w1', limit=3)
+        second = claim_deliveries('w2', limit=3)
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({job['id'] for job in first} & {job['id'] for job in second})
+
+
+class SharedRateLimiterTests(TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'buckets.sqlite3')
+        self.calls = []
+
+    def limiter(self):
+        return SharedRateLimiter(self.path, global_limit=(100, 1), chat_limit=(1, 0.1))
+
+    async def send(self, limiter, chat_id, callback=None):
+        async def record():
+            self.calls.append((chat_id, time.monotonic()))
+            return True
+        return await limiter.process_request(
+            callback or record, (), {}, 'sendMessage', {'chat_id': chat_id}, None
+        )
+
+    def test_chat_bucket_is_shared_between_limiters(self):
+        # Два экземпляра с одним файлом - как бот и воркер в разных процессах
+        first, second = self.limiter(), self.limiter()
+
+        async def burst():
+            await asyncio.gather(*(self.send(limiter, 42) for limiter in (first, second) * 2))
+            await self.send(first, 7)
+
+        asyncio.run(burst())
+        times = sorted(at for chat_id, at in self.calls if chat_id == 42)
+        self.assertGreaterEqual(times[-1] - times[0], 0.25)
+        # Другой чат не ждет очереди чата 42
+        self.assertLess(self.calls[-1][1] - times[-1], 0.1)
+
+    def test_retry_after_pauses_the_chat_in_every_limiter(self):
+        first, second = self.limiter(), self.limiter()
+        attempts = []
+
+        async def flaky():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(1)
+            return True
+
+        async def run():
+            task = asyncio.create_task(self.send(first, 42, flaky))
+            await asyncio.sleep(0.1)
+            self.assertGreater(second.try_acquire(['chat:42']), 0.5)
+            return await task
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertGreaterEqual(attempts[1] - attempts[0], 1)
+
+    def test_retry_after_in_one_chat_does_not_delay_another(self):
+        limiter = self.limiter()
+        attempts = []
+
+        async def flaky():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(1)
+            return True
+
+        async def run():
+            task = asyncio.create_task(self.send(limiter, 42, flaky))
+            await asyncio.sleep(0.1)
+            started = time.monotonic()
+            await self.send(limiter, 7)
+            self.assertLess(time.monotonic() - started, 0.2)
+            return await task
+
+        self.assertTrue(asyncio.run(run()))
+        self.assertEqual([chat_id for chat_id, _ in self.calls], [7])
+
+    def test_groups_and_chats_use_separate_buckets(self):
+        self.assertEqual(bucket_keys('sendMessage', {'chat_id': 42}), ['global', 'chat:42'])
+        self.assertEqual(bucket_keys('sendMessage', {'chat_id': -100}), ['global', 'group:-100'])
+        self.assertEqual(bucket_keys('editMessageText', {'chat_id': 42}), ['global'])
+
+
+class MetricsRegistryTests(TestCase):
+
+    def test_renders_prometheus_text_format(self):
+        registry = metrics.Registry()
+        requests = metrics.Counter('test_requests_total', "Запросы", ('endpoint',), registry=registry)
+        latency = metrics.Histogram('test_seconds', "Время", buckets=(0.1, 1), registry=registry)
+        depth = metrics.Gauge('test_depth', "Очередь", ('state',), registry=registry,
+                              function=lambda: {('waiting',): 3})
+        requests.inc(endpoint='send"Message')
+        requests.inc(2, endpoint='send"Message')
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_requests_total counter', lines)
+        self.assertIn('test_requests_total{endpoint="send\\"Message"} 3', lines)
+        self.assertEqual(
+            [line for line in lines if line.startswith('test_seconds')],
+            ['test_seconds_bucket{le="0.1"} 1', 'test_seconds_bucket{le="1"} 2',
+             'test_seconds_bucket{le="+Inf"} 3', 'test_seconds_sum 5.55', 'test_seconds_count 3'],
+        )
+        self.assertIn('test_depth{state="waiting"} 3', lines)
+        with self.assertRaises(ValueError):
+            depth.set(1, kind='other')
+
+    def test_broken_gauge_does_not_break_scrape(self):
+        registry = metrics.Registry()
+        metrics.Gauge('test_broken', "Сломан", registry=registry, function=lambda: 1 / 0)
+        metrics.Gauge('test_ok', "Работает", registry=registry, function=lambda: 1)
+        with self.assertLogs('stefbot.metrics', level='ERROR'):
+            self.assertEqual(registry.render(), '# HELP test_ok Работает\n# TYPE test_ok gauge\ntest_ok 1\n')
+
+    def test_update_kind_has_bounded_labels(self):
+        self.assertEqual(update_kind(Update.de_json(callback_update(1, 42, 'model_7'), None)), 'model')
+        self.assertEqual(update_kind(Update.de_json(callback_update(1, 42, 'orders_next_2_abc'), None)), 'orders_next')
+        self.assertEqual(update_kind(Update.de_json(callback_update(1, 42, 'whatever_1'), None)), 'other')
+        self.assertEqual(update_kind(Update.de_json(command_update(1, 42, '/start'), None)), 'start')
+        self.assertEqual(update_kind(Update.de_json(command_update(1, 42, '/random'), None)), 'command')
+
+    def test_rate_limiter_counts_telegram_errors(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        limiter = SharedRateLimiter(os.path.join(tmp.name, 'buckets.sqlite3'), global_limit=(100, 1))
+        errors = metrics.registry.get('stefbot_telegram_errors_total')
+        before = errors.value(endpoint='sendMessage', error='RetryAfter')
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RetryAfter(0)
+            return True
+
+        asyncio.run(limiter.process_request(flaky, (), {}, 'sendMessage', {'chat_id': 42}, None))
+        self.assertEqual(errors.value(endpoint='sendMessage', error='RetryAfter'), before + 1)
+
+    @override_settings(ALLOWED_HOSTS=['testserver'], METRICS_TOKEN='secret')
+    def test_django_endpoint_requires_token(self):
+        OrderDelivery.objects.create(order=Order.objects.create(
+            user=TelegramUser.objects.create(telegram_id=42),
+            model=ModelProfile.objects.create(name='M', description='', price=1, preview_photo='p.jpg'),
+            amount=1, status='paid',
+        ))
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn('stefbot_delivery_backlog{status="pending"} 1', response.content.decode().splitlines())
+
+    @override_settings(ALLOWED_HOSTS=['testserver'], METRICS_TOKEN='', METRICS_PUBLIC=False)
+    def test_django_endpoint_is_closed_without_token(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with override_settings(METRICS_PUBLIC=True):
+            self.client.logout()
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_bot_listener_serves_registry(self):
+        server = metrics.start_metrics_server(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        response = httpx.get(f'http://127.0.0.1:{server.server_address[1]}/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE stefbot_update_seconds histogram', response.text)
+
+
+class UpdateMetricsTests(NoBackgroundDerivativesMixin, TransactionTestCase):
+
+    async def test_update_latency_and_db_time_by_kind(self):
+        from StefanBot import build_application
+
+        await sync_to_async(ModelProfile.objects.create)(
+            name='Model', description='', price=100, preview_photo='model_previews/p.jpg',
+        )
+        await sync_to_async(invalidate_catalog)()
+        application = build_application(request=FakeBotAPI(), limiter=None)
+        await application.initialize()
+        _, count = UPDATE_SECONDS.value(kind='models')
+        db_time, _ = UPDATE_DB_SECONDS.value(kind='models')
+        try:
+            await application.process_update(Update.de_json(callback_update(1, 42, 'models'), application.bot))
+        finally:
+            await application.shutdown()
+        self.assertEqual(UPDATE_SECONDS.value(kind='models')[1], count + 1)
+        self.assertGreater(UPDATE_DB_SECONDS.value(kind='models')[0], db_time)
+
+
+class RecordingExporter:
+    """Собирает законченные span в память вместо файла или коллектора."""
+
+    def __init__(self):
+        self.spans = []
+
+    def submit(self, span):
+        self.spans.append(span)
+
+    def named(self, name):
+        return [span for span in self.spans if span.name == name]
+
+
+class TracingTests(TestCase):
+
+    def setUp(self):
+        self.exporter = RecordingExporter()
+        tracing.set_exporter(self.exporter)
+        self.addCleanup(tracing.set_exporter, None)
+
+    @override_settings(TRACE_SAMPLE_RATE=0)
+    def test_unsampled_trace_records_nothing(self):
+        with tracing.trace('update') as root, tracing.span('db.query') as child:
+            self.assertIsNone(root)
+            self.assertIsNone(child)
+            self.assertEqual(tracing.traceparent(), '')
+        self.assertEqual(self.exporter.spans, [])
+
+    @override_settings(TRACE_SAMPLE_RATE=1)
+    def test_spans_nest_and_record_errors(self):
+        with self.assertRaises(ValueError):
+            with tracing.trace('update', kind='models') as root:
+                with tracing.span('db.query'):
+                    pass
+                raise ValueError('boom')
+        child, = self.exporter.named('db.query')
+        self.assertEqual((child.trace_id, child.parent_id), (root.trace_id, root.span_id))
+        self.assertEqual(root.error, 'ValueError: boom')
+        self.assertEqual(root.attributes, {'kind': 'models'})
+
+    def test_exporter_without_write_fails_on_creation(self):
+        class Misconfigured(tracing.BatchExporter):
+            pass
+
+        with self.assertRaises(TypeError):
+            Misconfigured()
+
+    def test_json_lines_exporter_writes_a_span_per_line(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'traces', 'spans.jsonl')
+        exporter = tracing.JsonLinesExporter(path)
+        tracing.set_exporter(exporter)
+        with override_settings(TRACE_SAMPLE_RATE=1), tracing.trace('delivery', order_id=7):
+            with tracing.span('telegram.sendMessage'):
+                pass
+        exporter.flush()
+        with open(path, encoding='utf-8') as file:
+            spans = [json.loads(line) for line in file]
+        self.assertEqual([span['name'] for span in spans], ['telegram.sendMessage', 'delivery'])
+        self.assertEqual(spans[1]['attributes'], {'order_id': 7})
+        self.assertEqual(spans[0]['parent_id'], spans[1]['span_id'])
+
+    def test_otlp_exporter_posts_to_collector(self):
+        received = []
+
+        class Collector(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append((self.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Collector)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        exporter = tracing.OTLPExporter(f'http://127.0.0.1:{server.server_address[1]}')
+        tracing.set_exporter(exporter)
+        with override_settings(TRACE_SAMPLE_RATE=1), tracing.trace('update', update_id=1):
+            pass
+        exporter.flush()
+
+        (path, payload), = received
+        self.assertEqual(path, '/v1/traces')
+        span, = payload['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual(span['name'], 'update')
+        self.assertEqual(span['attributes'], [{'key': 'update_id', 'value': {'intValue': '1'}}])
+        self.assertEqual(len(span['traceId']), 32)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TRACE_SAMPLE_RATE=1)
+class EndToEndTracingTests(NoBackgroundDerivativesMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.exporter = RecordingExporter()
+        tracing.set_exporter(self.exporter)
+        self.addCleanup(tracing.set_exporter, None)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media_root = override_settings(MEDIA_ROOT=self.tmp.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        os.makedirs(os.path.join(self.tmp.name, 'model_previews'))
+        with open(os.path.join(self.tmp.name, 'model_previews', 'p.jpg'), 'wb') as file:
+            file.write(camera_jpeg((640, 480)))
+        self.model = ModelProfile.objects.create(
+            name='Model', description='', price=100, preview_photo='model_previews/p.jpg',
+        )
+        ModelPhoto.objects.create(model=self.model, photo='model_photos/1.jpg', telegram_file_id='cached')
+
+    async def test_update_trace_covers_db_files_and_bot_api(self):
+        from StefanBot import build_application
+
+        await sync_to_async(invalidate_catalog)()
+        limiter = SharedRateLimiter(os.path.join(self.tmp.name, 'buckets.sqlite3'),
+                                    global_limit=(10 ** 6, 1), chat_limit=(10 ** 6, 1))
+        application = build_application(request=FakeBotAPI(), limiter=limiter)
+        await application.initialize()
+        try:
+            update = callback_update(1, 42, f'model_{self.model.pk}')
+            await application.process_update(Update.de_json(update, application.bot))
+        finally:
+            await application.shutdown()
+
+        root, = self.exporter.named('update')
+        self.assertEqual(root.attributes['kind'], 'model')
+        self.assertEqual({span.trace_id for span in self.exporter.spans}, {root.trace_id})
+        names = {span.name for span in self.exporter.spans}
+        self.assertLessEqual({
+            'db.get_catalog_snapshot', 'db.query', 'file.open', 'ratelimit.wait',
+            'telegram.answerCallbackQuery', 'telegram.sendPhoto', 'db.remember_preview_file_id',
+        }, names)
+        send, = self.exporter.named('telegram.sendPhoto')
+        self.assertEqual(send.parent_id, root.span_id)
+        self.assertIn('pool_wait_ms', self.exporter.named('db.get_catalog_snapshot')[0].attributes)
+
+    def test_payment_trace_continues_in_delivery_worker(self):
+        user = TelegramUser.objects.create(telegram_id=42)
+        order = Order.objects.create(user=user, model=self.model, amount=100, status='paid')
+        with tracing.trace('update') as root:
+            enqueue_deliveries([order.id])
+        self.assertEqual(OrderDelivery.objects.get(order=order).traceparent, root.traceparent)
+
+        # Решение о сэмплировании приходит вместе с трассой, а не из настроек воркера
+        with override_settings(TRACE_SAMPLE_RATE=0), mock.patch('stefbot.dispatcher.bot', FakeClient()):
+            asyncio.run(run_worker('w1', once=True))
+
+        delivery, = self.exporter.named('delivery')
+        self.assertEqual((delivery.trace_id, delivery.parent_id), (root.trace_id, root.span_id))
+        self.assertEqual(delivery.attributes['order_id'], order.id)
+        self.assertTrue(self.exporter.named('media.album'))
+
+
+def blocking_handler():
+    time.sleep(0.3)  # Синхронный вызов посреди обработчика
+
+
+class LoopMonitorTests(TestCase):
+
+    def test_blocked_loop_is_reported_with_offending_stack(self):
+        async def run():
+            monitor = loopmonitor.LoopMonitor(threshold=0.05, interval=0.01).start()
+            await asyncio.sleep(0.05)
+            blocking_handler()
+            await asyncio.sleep(0.05)
+            quantiles = loopmonitor._lag_quantiles()
+            await monitor.stop()
+            return monitor, quantiles
+
+        with self.assertLogs('stefbot.loopmonitor', level='WARNING') as logs:
+            monitor, quantiles = asyncio.run(run())
+
+        site, stack = monitor.blocks[0]
+        self.assertEqual(stack[-1].name, 'blocking_handler')
+        self.assertTrue(site.startswith('stefbot/tests.py:'), site)
+        self.assertIn('time.sleep(0.3)', logs.output[0])
+        self.assertEqual(len(monitor.blocks), 1)  # Одна блокировка - одна запись
+        self.assertGreaterEqual(loopmonitor.LOOP_BLOCKS.value(site=site), 1)
+        self.assertGreaterEqual(quantiles[('1.0',)], 0.25)
+        self.assertLess(quantiles[('0.5',)], 0.05)
+        self.assertEqual(loopmonitor._lag_quantiles(), {})  # Остановленный монитор не отчитывается
+
+    def test_monitor_follows_settings(self):
+        async def run():
+            monitor = loopmonitor.start_loop_monitor()
+            debug = asyncio.get_running_loop().get_debug()
+            if monitor is not None:
+                await monitor.stop()
+            return monitor, debug
+
+        with override_settings(LOOP_MONITOR=''):
+            self.assertEqual(asyncio.run(run()), (None, False))
+        with override_settings(LOOP_MONITOR='debug'), self.assertLogs('stefbot.loopmonitor', level='INFO'):
+            monitor, debug = asyncio.run(run())
+        self.assertTrue(debug)
+        self.assertTrue(monitor.debug)
 
-# Create your tests here.
@@ -0,0 +1,267 @@
+import abc
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+import httpx
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Трассировка: корневой span открывается на апдейт или доставку, дочерние - в
+# хелперах БД, при открытии файлов и на каждом запросе к Bot API. Решение о
+# сэмплировании принимается у корня; вне трассы span() ничего не делает.
+
+SERVICE_NAME = 'stefbot'
+EXPORT_BATCH_SIZE = 256
+EXPORT_INTERVAL = 1  # Секунд, за которые копится пачка на экспорт
+MAX_QUEUED_SPANS = 10_000  # Дальше span отбрасываются, а не копятся в памяти
+
+_current = contextvars.ContextVar('stefbot_span', default=None)
+_sampler = random.Random()
+
+DROPPED_SPANS = metrics.Counter('stefbot_trace_spans_dropped_total', "Span, не попавшие в экспорт")
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, name, trace_id, parent_id='', attributes=None):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = {key: value for key, value in (attributes or {}).items() if value is not None}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = ''
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self):
+        """Заголовок W3C Trace Context: им трасса продолжается в другом процессе."""
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def parse_traceparent(value):
+    """(trace_id, span_id, sampled) из заголовка traceparent или None."""
+    parts = (value or '').split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == '01'
+
+
+@contextmanager
+def _activate(span):
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        _current.reset(token)
+        get_exporter().submit(span)
+
+
+@contextmanager
+def trace(name, parent=None, **attributes):
+    """Корневой span апдейта или доставки.
+
+    Внутри другой трассы становится ее дочерним span. ``parent`` - traceparent
+    из другого процесса: трасса продолжается с его решением о сэмплировании.
+    Иначе трасса пишется с вероятностью TRACE_SAMPLE_RATE. Отдает Span или None.
+    """
+    current = _current.get()
+    if current is not None:
+        with _activate(Span(name, current.trace_id, current.span_id, attributes)) as child:
+            yield child
+        return
+    remote = parse_traceparent(parent)
+    if remote is not None:
+        trace_id, parent_id, sampled = remote
+    else:
+        trace_id, parent_id = secrets.token_hex(16), ''
+        sampled = _sampler.random() < settings.TRACE_SAMPLE_RATE
+    if not sampled:
+        yield None
+        return
+    with _activate(Span(name, trace_id, parent_id, attributes)) as root:
+        yield root
+
+
+@contextmanager
+def span(name, **attributes):
+    """Дочерний span текущей трассы; вне трассы отдает None и ничего не пишет."""
+    current = _current.get()
+    if current is None:
+        yield None
+        return
+    with _activate(Span(name, current.trace_id, current.span_id, attributes)) as child:
+        yield child
+
+
+def current_span():
+    return _current.get()
+
+
+def traceparent():
+    """traceparent текущего span, чтобы продолжить трассу в воркере; '' вне трассы."""
+    current = _current.get()
+    return current.traceparent if current is not None else ''
+
+
+class BatchExporter(abc.ABC):
+    """Копит законченные span и пишет их пачками в фоновом потоке.
+
+    Обработчик не ждет диска или сети: ``submit`` только кладет span в очередь.
+    Наследник обязан реализовать ``write``, иначе не создастся.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=MAX_QUEUED_SPANS)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, span):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            DROPPED_SPANS.inc()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stefbot-tracing', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + EXPORT_INTERVAL
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                DROPPED_SPANS.inc(len(batch))
+                logger.error(f"❌ Не удалось выгрузить трассы: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Ждет, пока выгрузятся все span из очереди."""
+        if self._thread is not None:
+            self._queue.join()
+
+    @abc.abstractmethod
+    def write(self, spans):
+        """Выгружает пачку span; вызывается из фонового потока."""
+
+
+class JsonLinesExporter(BatchExporter):
+    """Span построчно в JSON-файл: ``jq 'select(.trace_id == "...")' traces.jsonl``."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def write(self, spans):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as file:
+            for span in spans:
+                file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n')
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class OTLPExporter(BatchExporter):
+    """OTLP/HTTP с JSON-телом: Jaeger, Tempo или OpenTelemetry Collector на ``endpoint``."""
+
+    def __init__(self, endpoint, timeout=10):
+        super().__init__()
+        self.url = endpoint.rstrip('/') + '/v1/traces'
+        self.timeout = timeout
+
+    def payload(self, spans):
+        return {'resourceSpans': [{
+            'resource': {'attributes': [
+                {'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}},
+                {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+            ]},
+            'scopeSpans': [{
+                'scope': {'name': 'stefbot.tracing'},
+                'spans': [{
+                    'traceId': span.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': span.parent_id,
+                    'name': span.name,
+                    'kind': 1,  # INTERNAL
+                    'startTimeUnixNano': str(span.start_ns),
+                    'endTimeUnixNano': str(span.end_ns),
+                    'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in span.attributes.items()],
+                    'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+                } for span in spans],
+            }],
+        }]}
+
+    def write(self, spans):
+        httpx.post(self.url, json=self.payload(spans), timeout=self.timeout).raise_for_status()
+
+
+_exporter = None
+
+
+def get_exporter():
+    """Экспортер из настроек: OTLP при TRACE_OTLP_ENDPOINT, иначе файл TRACE_FILE."""
+    global _exporter
+    if _exporter is None:
+        if settings.TRACE_OTLP_ENDPOINT:
+            _exporter = OTLPExporter(settings.TRACE_OTLP_ENDPOINT)
+        else:
+            _exporter = JsonLinesExporter(settings.TRACE_FILE)
+    return _exporter
+
+
+def set_exporter(exporter):
+    """Подменяет экспортер (тесты, бенчмарки); None - снова из настроек."""
+    global _exporter
+    _exporter = exporter
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+import weakref
+from django.conf import settings
+from django.utils.module_loading import import_string
+from telegram import Update
+from telegram.ext import Application
+from . import metrics, tracing
+from .loopmonitor import start_loop_monitor
+from .repository import track_db_time
+
+logger = logging.getLogger(__name__)
+
+UPDATE_CONCURRENCY = 32  # Сколько апдейтов разных пользователей обрабатывается одновременно
+MAX_PENDING_UPDATES = 4096  # Потолок задач в Application; ожидающие очереди пользователя слотов не занимают
+QUEUE_REPORT_INTERVAL = 60  # Секунд между записями о глубине очереди
+
+# Вид апдейта - метка метрик. callback_data приходит от клиента, поэтому
+# неизвестные значения сводятся к 'other', а не плодят серии. Длинные
+# префиксы идут раньше: orders_next_... не должен стать 'orders'.
+CALLBACK_KINDS = (
+    'orders_next', 'orders_prev', 'orders_page', 'orders', 'order',
+    'models', 'model', 'back_to_main', 'buy', 'confirm_payment',
+)
+COMMAND_KINDS = ('start',)
+
+_running = weakref.WeakSet()  # Запущенные Application процесса - для метрик очереди
+
+
+def build_application(**kwargs):
+    """Application бота из фабрики BOT_APPLICATION_FACTORY."""
+    return import_string(settings.BOT_APPLICATION_FACTORY)(**kwargs)
+
+
+def _queue_depth():
+    total = {'queued': 0, 'waiting': 0, 'running': 0}
+    for application in list(_running):
+        depth = application.queue_depth()
+        for state in total:
+            total[state] += depth[state]
+    return {(state,): count for state, count in total.items()}
+
+
+UPDATE_SECONDS = metrics.Histogram(
+    'stefbot_update_seconds', "Обработка апдейта, включая ожидание своей очереди пользователя", ('kind',),
+)
+UPDATE_DB_SECONDS = metrics.Histogram(
+    'stefbot_update_db_seconds', "Время в пуле потоков БД за один апдейт", ('kind',),
+)
+UPDATE_QUEUE = metrics.Gauge(
+    'stefbot_update_queue', "Апдейты в Application: queued - не разобраны, waiting - ждут очереди "
+    "пользователя или слота, running - в обработке", ('state',), function=_queue_depth,
+)
+
+
+def update_key(update):
+    """Ключ очереди: апдейты одного пользователя обрабатываются строго по порядку."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+def update_kind(update):
+    """Вид апдейта для метрик: префикс callback_data, команда или 'message'."""
+    if not isinstance(update, Update):
+        return 'other'
+    if update.callback_query is not None:
+        data = update.callback_query.data or ''
+        for kind in CALLBACK_KINDS:
+            if data == kind or data.startswith(f'{kind}_'):
+                return kind
+        return 'other'
+    text = update.message.text if update.message is not None else None
+    if text and text.startswith('/'):
+        command = text[1:].split(' ', 1)[0].split('@')[0]
+        return command if command in COMMAND_KINDS else 'command'
+    return 'message'
+
+
+class UserOrderedScheduler:
+    """Параллельная обработка апдейтов с порядком внутри пользователя.
+
+    У каждого пользователя цепочка: следующий апдейт ждет завершения
+    предыдущего и только потом берет один из ``limit`` слотов. Поэтому
+    двойное нажатие не обгоняет первое, а один медленный покупатель занимает
+    лишь свой слот.
+    """
+
+    def __init__(self, limit=UPDATE_CONCURRENCY):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.chains = {}
+        self.waiting = 0
+        self.running = 0
+        self.processed = 0
+
+    async def run(self, key, process):
+        previous = self.chains.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self.chains[key] = done
+        self.waiting += 1
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            await self.semaphore.acquire()
+        except BaseException:
+            self.waiting -= 1
+            self._release(key, done)
+            raise
+
+        self.waiting -= 1
+        self.running += 1
+        try:
+            return await process()
+        finally:
+            self.running -= 1
+            self.processed += 1
+            self.semaphore.release()
+            self._release(key, done)
+
+    def _release(self, key, done):
+        done.set_result(None)
+        if self.chains.get(key) is done:
+            del self.chains[key]
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'waiting': self.waiting,
+            'users': len(self.chains),
+            'processed': self.processed,
+        }
+
+
+class OrderedApplication(Application):
+    """Application, который раздает апдейты через UserOrderedScheduler.
+
+    Собирается через ``Application.builder().application_class(...)`` вместе
+    с ``concurrent_updates(MAX_PENDING_UPDATES)``.
+    """
+
+    def __init__(self, *, update_concurrency=UPDATE_CONCURRENCY, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = UserOrderedScheduler(update_concurrency)
+        self._reporter = None
+        self._loop_monitor = None
+
+    async def start(self):
+        await super().start()
+        _running.add(self)
+        self._reporter = asyncio.create_task(report_queue_depth(self))
+        self._loop_monitor = start_loop_monitor()
+
+    async def stop(self):
+        _running.discard(self)
+        if self._reporter is not None:
+            self._reporter.cancel()
+            self._reporter = None
+        if self._loop_monitor is not None:
+            await self._loop_monitor.stop()
+            self._loop_monitor = None
+        await super().stop()
+
+    async def process_update(self, update):
+        kind = update_kind(update)
+        key = update_key(update)
+        started = time.perf_counter()
+        with track_db_time() as db_time, tracing.trace(
+            'update', kind=kind, update_id=getattr(update, 'update_id', None), user=key,
+        ) as span:
+            async def process():
+                if span is not None:
+                    span.set('queue_wait_ms', round((time.perf_counter() - started) * 1000, 3))
+                return await super(OrderedApplication, self).process_update(update)
+
+            try:
+                if key is None:
+                    return await process()
+                return await self.scheduler.run(key, process)
+            finally:
+                UPDATE_SECONDS.observe(time.perf_counter() - started, kind=kind)
+                UPDATE_DB_SECONDS.observe(db_time[0], kind=kind)
+                if span is not None:
+                    span.set('db_ms', round(db_time[0] * 1000, 3))
+
+    def queue_depth(self):
+        """Глубина очередей: еще не разобранные апдейты плюс счетчики планировщика."""
+        return dict(self.scheduler.stats(), queued=self.update_queue.qsize())
+
+
+async def report_queue_depth(application, interval=QUEUE_REPORT_INTERVAL):
+    """Периодически пишет в лог глубину очереди апдейтов."""
+    while True:
+        await asyncio.sleep(interval)
+        depth = application.queue_depth()
+        if depth['queued'] or depth['waiting'] or depth['running']:
+            logger.info(
+                f"📊 Апдейты: в очереди {depth['queued']}, ждут своей очереди {depth['waiting']}, "
+                f"в работе {depth['running']}, пользователей {depth['users']}"
+            )
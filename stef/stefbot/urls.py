@@ -1,7 +1,8 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import TelegramUserViewSet, ModelProfileViewSet, ModelPhotoViewSet, OrderViewSet
-from .views import create_order
+from .views import create_order, metrics_view
+from .webhook import telegram_webhook
 
 router = DefaultRouter()
 router.register(r'users', TelegramUserViewSet)
@@ -12,4 +13,6 @@ router.register(r'orders', OrderViewSet)
 urlpatterns = [
     path('api/', include(router.urls)),
     path('create_order/', create_order, name='create_order'),
+    path('telegram/webhook/', telegram_webhook, name='telegram_webhook'),
+    path('metrics/', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+from .models import TelegramUser
+
+USER_CACHE_SIZE = 10_000  # Пользователей в памяти процесса бота
+USER_CACHE_TTL = 300  # Через сколько секунд запись перечитывается из БД
+
+# /start и "Купить" каждый раз делали get_or_create пользователя, хотя
+# пользователи почти не меняются. Кэш живет в памяти процесса: админка в
+# другом процессе его не видит, поэтому удаление или правку пользователя
+# там бот заметит не позже чем через USER_CACHE_TTL.
+
+
+class UserCache:
+    """LRU-кэш telegram_id -> (pk, username) с ограничением по размеру и TTL."""
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Читает цикл событий, пишут потоки пула БД
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id):
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry[2] < time.monotonic():
+                self._entries.pop(telegram_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def set(self, telegram_id, pk, username):
+        with self._lock:
+            self._entries[telegram_id] = (pk, username, time.monotonic() + self.ttl)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, telegram_id):
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+user_cache = UserCache()
+
+
+def cached_user(telegram_id, username):
+    """Пользователь из кэша без запроса к БД или None.
+
+    Если username в Telegram сменился, возвращает None: его надо записать.
+    """
+    entry = user_cache.get(telegram_id)
+    if entry is None or entry[1] != username:
+        return None
+    return TelegramUser(pk=entry[0], telegram_id=telegram_id, username=username)
+
+
+def upsert_user(telegram_id, username):
+    """Создает пользователя или обновляет его username и кладет в кэш.
+
+    Одновременный первый контакт (два процесса или шарда) безопасен:
+    get_or_create ловит IntegrityError уникального telegram_id и перечитывает строку.
+    """
+    user, created = TelegramUser.objects.get_or_create(
+        telegram_id=telegram_id,
+        defaults={'username': username}
+    )
+    if not created and user.username != username:
+        TelegramUser.objects.filter(pk=user.pk).update(username=username)
+        user.username = username
+    user_cache.set(telegram_id, user.pk, user.username)
+    return user, created
@@ -2,13 +2,23 @@ import logging
 import asyncio
 import os
 from django.conf import settings
-from telegram import Bot, InputMediaPhoto
+from telegram import InputMediaPhoto
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+from .delivery import StreamingInputFile
+from .ratelimit import SharedRateLimiter
 
 logger = logging.getLogger(__name__)
 
 
-TOKEN = ""
-bot = Bot(token=TOKEN)
+TOKEN = settings.TELEGRAM_TOKEN
+rate_limiter = SharedRateLimiter()
+CONNECTION_POOL_SIZE = 16  # Воркер доставки шлет заказы параллельно, по умолчанию у Bot одно соединение
+bot = ExtBot(  # Все отправки идут через общий лимитер
+    token=TOKEN,
+    rate_limiter=rate_limiter,
+    request=HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE),
+)
 
 def get_absolute_url(relative_path):
     """Генерирует абсолютный URL изображения."""
@@ -31,6 +41,7 @@ async def send_telegram_photos(chat_id, photo_paths):
             return
 
         media = []
+        opened = []
         for path in photo_paths[:10]:  # Ограничиваем до 10 фото
             
             # ✅ Убираем дублирующийся `media/`
@@ -41,17 +52,22 @@ async def send_telegram_photos(chat_id, photo_paths):
             logger.info(f"🔍 Проверяем файл: {absolute_path}")
 
             if os.path.exists(absolute_path):
-                with open(absolute_path, 'rb') as photo:
-                    media.append(InputMediaPhoto(photo))  # 📌 **Используем файл напрямую**
-                    logger.info(f"✅ Файл найден и загружен: {absolute_path}")
+                photo = StreamingInputFile(absolute_path, attach=True)
+                opened.append(photo)
+                media.append(InputMediaPhoto(photo))  # 📌 **Файл отправляется потоком**
+                logger.info(f"✅ Файл найден: {absolute_path}")
             else:
                 logger.warning(f"❌ Файл не найден: {absolute_path}")
 
-        if media:
-            await bot.send_media_group(chat_id=chat_id, media=media)
-            logger.info(f"✅ Фото успешно отправлены пользователю {chat_id}")
-        else:
-            logger.warning(f"❌ Не удалось загрузить фотографии для {chat_id}")
+        try:
+            if media:
+                await bot.send_media_group(chat_id=chat_id, media=media)
+                logger.info(f"✅ Фото успешно отправлены пользователю {chat_id}")
+            else:
+                logger.warning(f"❌ Не удалось загрузить фотографии для {chat_id}")
+        finally:
+            for photo in opened:
+                photo.close()
 
     except Exception as e:
         logger.error(f"❌ Ошибка отправки фото: {e}")
@@ -0,0 +1,116 @@
+import struct
+
+TELEGRAM_VIDEO_LIMIT = 50 * 1024 * 1024  # Лимит загрузки файла через Bot API
+
+
+class VideoProbeError(ValueError):
+    """Файл не похож на MP4/MOV или его заголовки повреждены."""
+
+
+def _boxes(file, start, end):
+    """Перебирает боксы ISO BMFF в диапазоне [start, end): (тип, начало данных, конец)."""
+    offset = start
+    while offset + 8 <= end:
+        file.seek(offset)
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack('>I4s', header)
+        data = offset + 8
+        if size == 1:  # 64-битный размер следом за типом
+            size = struct.unpack('>Q', file.read(8))[0]
+            data += 8
+        elif size == 0:  # Бокс до конца файла
+            size = end - offset
+        if size < data - offset:
+            raise VideoProbeError(f"битый размер бокса {kind!r} на {offset}")
+        yield kind, data, offset + size
+        offset += size
+
+
+def _read(file, start, length):
+    file.seek(start)
+    data = file.read(length)
+    if len(data) < length:
+        raise VideoProbeError("заголовок обрезан")
+    return data
+
+
+def _mvhd_duration(file, start):
+    version = _read(file, start, 1)[0]
+    if version == 1:
+        timescale, duration = struct.unpack('>IQ', _read(file, start + 20, 12))
+    else:
+        timescale, duration = struct.unpack('>II', _read(file, start + 12, 8))
+    return duration / timescale if timescale else None
+
+
+def _tkhd_size(file, start, end):
+    """Размер кадра из tkhd с учетом поворота из матрицы трека."""
+    # width и height (16.16) - последние 8 байт, матрица 3x3 - 36 байт перед ними
+    matrix = struct.unpack('>9i', _read(file, end - 44, 36))
+    width, height = (value >> 16 for value in struct.unpack('>II', _read(file, end - 8, 8)))
+    if matrix[0] == 0 and matrix[1] != 0:  # Поворот на 90 или 270 градусов
+        width, height = height, width
+    return width, height
+
+
+def _is_video_track(file, start, end):
+    for kind, data, box_end in _boxes(file, start, end):
+        if kind == b'mdia':
+            for inner, inner_data, _ in _boxes(file, data, box_end):
+                if inner == b'hdlr':
+                    return _read(file, inner_data + 8, 4) == b'vide'
+    return False
+
+
+def probe_mp4(file, size):
+    """Читает метаданные MP4/MOV только по заголовкам, не трогая mdat.
+
+    Возвращает dict: duration (с), width, height, size, faststart - лежит
+    ли moov перед mdat (тогда видео можно смотреть, не скачав целиком).
+    """
+    meta = {'duration': None, 'width': None, 'height': None, 'size': size, 'faststart': False}
+    seen = set()
+    for kind, data, end in _boxes(file, 0, size):
+        seen.add(kind)
+        if kind == b'moov':
+            meta['faststart'] = b'mdat' not in seen
+            for inner, inner_data, inner_end in _boxes(file, data, end):
+                if inner == b'mvhd':
+                    meta['duration'] = _mvhd_duration(file, inner_data)
+                elif inner == b'trak' and meta['width'] is None and _is_video_track(file, inner_data, inner_end):
+                    for track_box, track_data, track_end in _boxes(file, inner_data, inner_end):
+                        if track_box == b'tkhd':
+                            meta['width'], meta['height'] = _tkhd_size(file, track_data, track_end)
+    if b'ftyp' not in seen or b'moov' not in seen:
+        raise VideoProbeError("нет ftyp или moov - это не MP4/MOV")
+    return meta
+
+
+def probe_video(video):
+    """Заполняет метаданные ModelVideo по файлу и отмечает, если отправить его нельзя."""
+    video.duration = video.width = video.height = video.faststart = None
+    video.file_size = None
+    video.send_problem = ''
+    field_file = video.video
+    try:
+        file = field_file.file if not field_file._committed else field_file.open('rb')
+        position = file.tell()
+        try:
+            meta = probe_mp4(file, field_file.size)
+        finally:
+            file.seek(position)  # Новую загрузку storage еще будет читать
+            if field_file._committed:
+                field_file.close()
+    except (OSError, VideoProbeError, struct.error) as e:
+        video.send_problem = f"не удалось прочитать видео: {e}"
+        return
+    video.file_size = meta['size']
+    video.duration = round(meta['duration']) if meta['duration'] is not None else None
+    video.width, video.height = meta['width'], meta['height']
+    video.faststart = meta['faststart']
+    if meta['size'] > TELEGRAM_VIDEO_LIMIT:
+        video.send_problem = (
+            f"больше лимита Telegram: {meta['size'] / 2 ** 20:.0f} МБ > {TELEGRAM_VIDEO_LIMIT // 2 ** 20} МБ"
+        )
@@ -2,10 +2,13 @@ from rest_framework import viewsets
 from .models import TelegramUser, ModelProfile, ModelPhoto, Order
 from .serializers import TelegramUserSerializer, ModelProfileSerializer, ModelPhotoSerializer, OrderSerializer
 from django.shortcuts import get_object_or_404
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from .models import ModelProfile, Order, TelegramUser
 from django.contrib.auth.models import User
+import hmac
 import json
+from . import metrics
 
 class TelegramUserViewSet(viewsets.ModelViewSet):
     queryset = TelegramUser.objects.all()
@@ -23,6 +26,10 @@ class OrderViewSet(viewsets.ModelViewSet):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
 
+    def perform_create(self, serializer):
+        # amount нет в сериализаторе: цена берется из модели, как в create_order
+        serializer.save(amount=serializer.validated_data['model'].price)
+
 def create_order(request):
     if request.method == 'POST':
         data = json.loads(request.body)
@@ -36,4 +43,21 @@ def create_order(request):
 
         order = Order.objects.create(user=user, model=model, amount=amount)
 
-        return JsonResponse({'order_id': order.id, 'status': order.status})
\ No newline at end of file
+        return JsonResponse({'order_id': order.id, 'status': order.status})
+
+
+def metrics_view(request):
+    """Метрики процесса в текстовом формате Prometheus.
+
+    Нужен заголовок ``Authorization: Bearer <METRICS_TOKEN>`` или вход сотрудника
+    в админку. Открыть метрики всем можно только явно: METRICS_PUBLIC.
+    """
+    token = settings.METRICS_TOKEN
+    authorized = (
+        settings.METRICS_PUBLIC
+        or request.user.is_active and request.user.is_staff
+        or token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    )
+    if not authorized:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,85 @@
+import asyncio
+import hmac
+import json
+import logging
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed
+from telegram import Update
+from .repository import db_async
+from .sharding import enqueue_updates
+from .updates import build_application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Application бота живет в каждом процессе uvicorn свой; общее состояние
+# (кэш, лимитер, БД) у них разделяемое, поэтому воркеров может быть несколько.
+_application = None
+_lock = asyncio.Lock()
+
+
+async def get_application():
+    """Создает и запускает Application при первом апдейте в этом процессе."""
+    global _application
+    if _application is not None:
+        return _application
+    async with _lock:
+        if _application is None:
+            application = build_application(webhook=True)
+            await application.initialize()
+            await application.start()
+            _application = application
+            logger.info("🚀 Бот запущен в режиме webhook")
+    return _application
+
+
+async def shutdown_application():
+    global _application
+    async with _lock:
+        if _application is not None:
+            await _application.stop()
+            await _application.shutdown()
+            _application = None
+
+
+async def telegram_webhook(request):
+    """Принимает апдейт от Telegram и ставит его в очередь Application.
+
+    Ответ уходит сразу: обработка идет в фоне, и Telegram не ждет медленных
+    обработчиков (например, отправки альбомов).
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    secret = settings.TELEGRAM_WEBHOOK_SECRET
+    if not secret or not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+        return HttpResponseForbidden()
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    if settings.BOT_SHARDS:
+        # Обработкой занимаются воркеры шардов (run_bot_worker)
+        await db_async(enqueue_updates)([data], settings.BOT_SHARDS)
+        return HttpResponse()
+
+    application = await get_application()
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return HttpResponse()
+
+
+# csrf_exempt в Django 4.2 не поддерживает async-вьюхи, флаг ставится напрямую
+telegram_webhook.csrf_exempt = True
+
+
+async def lifespan(receive, send):
+    """ASGI lifespan: при остановке сервера корректно гасит Application."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown_application()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return